@@ -18,7 +18,7 @@ class VersionComparisonDifferenceAdmin(admin.ModelAdmin):
 class VersionComparisonFileDiffAdmin(admin.ModelAdmin):
     search_fields = ['difference__pn']
     list_filter = ['difference__comparison', 'status']
-    readonly_fields = ['difference', 'get_diff_path']
+    readonly_fields = ['difference', 'cache_key', 'get_diff_path']
     def has_add_permission(self, request, obj=None):
         return False
 
@@ -0,0 +1,580 @@
+# Clear Linux Dissector - directory diff engine
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+#
+# Produces the same kind of output as "git diff --no-index -M" (which is
+# what diff2html on the frontend expects) without spawning any processes.
+
+import os
+import io
+import re
+import stat
+import difflib
+import hashlib
+import json
+import tempfile
+import zlib
+
+
+# Bytes to look at when deciding if a file is binary (same as git)
+BINARY_SNIFF_SIZE = 8000
+
+# Size of chunks to read files in when hashing them
+HASH_BUFSIZE = 64 * 1024
+
+# Minimum similarity for a deleted and added file to be shown as a rename
+RENAME_THRESHOLD = 0.5
+
+# Maximum number of deleted x added file pairs to compare content of when
+# detecting inexact renames (exact renames are always detected)
+RENAME_LIMIT = 1000
+
+# Compression level for compressed diffs (the default of 9 is much slower
+# for very little gain)
+GZIP_LEVEL = 6
+
+# Subdirectory of a DiffCache holding the recorded file hashes for trees
+TREES_DIR_NAME = 'trees'
+
+# Lines that can be shown as context in hunk headers (git's default)
+FUNCNAME_RE = re.compile(b'[A-Za-z_$]')
+
+
+class DiffError(Exception):
+    pass
+
+
+class DiffFile():
+    """
+    A file within one side of the diff. The content isn't kept in memory;
+    files are compared by hashes calculated as they are read in chunks,
+    and only read in full when writing the diff for them.
+    """
+    def __init__(self, path, relpath):
+        self.path = path
+        self.relpath = relpath
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            self.mode = '120000'
+        elif st.st_mode & stat.S_IXUSR:
+            self.mode = '100755'
+        else:
+            self.mode = '100644'
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self._digest = None
+        self._blob_id = None
+        self._binary = None
+
+    def _open(self):
+        if self.mode == '120000':
+            return io.BytesIO(os.fsencode(os.readlink(self.path)))
+        return open(self.path, 'rb')
+
+    def read(self):
+        """
+        Read the entire content of the file
+        """
+        with self._open() as f:
+            return f.read()
+
+    def _hash(self):
+        shash = hashlib.sha256()
+        blobhash = hashlib.sha1(b'blob %d\0' % self.size)
+        with self._open() as f:
+            while True:
+                data = f.read(HASH_BUFSIZE)
+                if not data:
+                    break
+                shash.update(data)
+                blobhash.update(data)
+        self._digest = shash.digest()
+        self._blob_id = blobhash.hexdigest()[:7]
+
+    def digest(self):
+        """
+        SHA-256 digest of the content
+        """
+        if self._digest is None:
+            self._hash()
+        return self._digest
+
+    def blob_id(self):
+        # Abbreviated git blob id, for the "index" line
+        if self._blob_id is None:
+            self._hash()
+        return self._blob_id
+
+    def same_content(self, other):
+        return self.size == other.size and self.digest() == other.digest()
+
+    def is_binary(self):
+        if self._binary is None:
+            with self._open() as f:
+                self._binary = b'\0' in f.read(BINARY_SNIFF_SIZE)
+        return self._binary
+
+
+def _walk(path):
+    """
+    Returns a dict of relative path -> DiffFile for all files under
+    path (or just path itself if it's a file)
+    """
+    files = {}
+    if not os.path.isdir(path):
+        files[os.path.basename(path)] = DiffFile(path, os.path.basename(path))
+        return files
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        with os.scandir(os.path.join(path, reldir)) as it:
+            for entry in it:
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relpath)
+                else:
+                    files[relpath] = DiffFile(entry.path, relpath)
+    return files
+
+
+def _count_changes(lines):
+    """
+    Returns the number of lines added and removed in a single file diff
+    """
+    added = 0
+    removed = 0
+    in_hunks = False
+    for line in lines:
+        if line.startswith(b'@@ '):
+            in_hunks = True
+        elif not in_hunks:
+            continue
+        elif line.startswith(b'+'):
+            added += 1
+        elif line.startswith(b'-'):
+            removed += 1
+    return added, removed
+
+
+def _similarity(from_lines, to_lines):
+    if from_lines is None or to_lines is None:
+        return 0
+    matcher = difflib.SequenceMatcher(None, from_lines, to_lines, autojunk=False)
+    if matcher.real_quick_ratio() < RENAME_THRESHOLD or matcher.quick_ratio() < RENAME_THRESHOLD:
+        return 0
+    return matcher.ratio()
+
+
+def _find_renames(deleted, added, max_file_size=0):
+    """
+    Pair up deleted and added files that are really renames. Returns a
+    list of (from_file, to_file, similarity) and removes the paired files
+    from deleted and added. Files larger than max_file_size (if non-zero)
+    are only considered for exact renames.
+    """
+    renames = []
+    # Exact renames first, these are cheap to find (only files of the
+    # same size can match, so only those need to be hashed)
+    added_sizes = set(diff_file.size for diff_file in added.values())
+    by_content = {}
+    for relpath in sorted(deleted):
+        diff_file = deleted[relpath]
+        if diff_file.size in added_sizes:
+            by_content.setdefault((diff_file.size, diff_file.digest()), []).append(relpath)
+    for relpath in sorted(added):
+        diff_file = added[relpath]
+        if not by_content:
+            break
+        candidates = by_content.get((diff_file.size, diff_file.digest()), None)
+        if candidates:
+            from_relpath = candidates.pop(0)
+            renames.append((deleted.pop(from_relpath), added.pop(relpath), 1.0))
+    if deleted and added and len(deleted) * len(added) <= RENAME_LIMIT:
+        # Only read each file once, and only for as long as we need it
+        file_lines = {}
+        def get_lines(diff_file):
+            if diff_file not in file_lines:
+                if diff_file.is_binary() or (max_file_size and diff_file.size > max_file_size):
+                    file_lines[diff_file] = None
+                else:
+                    file_lines[diff_file] = diff_file.read().splitlines(True)
+            return file_lines[diff_file]
+        scores = []
+        for from_relpath, from_file in deleted.items():
+            for to_relpath, to_file in added.items():
+                similarity = _similarity(get_lines(from_file), get_lines(to_file))
+                if similarity >= RENAME_THRESHOLD:
+                    scores.append((-similarity, from_relpath, to_relpath))
+        # Best matches win
+        for score, from_relpath, to_relpath in sorted(scores):
+            if from_relpath in deleted and to_relpath in added:
+                renames.append((deleted.pop(from_relpath), added.pop(to_relpath), -score))
+    return renames
+
+
+class DirectoryDiff():
+    """
+    Writes a unified diff between two files or directory trees to a file,
+    in git's format, detecting renames and skipping binary files. The
+    content of files larger than max_file_size is skipped, and no
+    more files are written once the output reaches max_size (0 means no
+    limit in both cases).
+    """
+    def __init__(self, from_path, to_path, from_label=None, to_label=None, context=3, max_file_size=0, max_size=0):
+        self.from_path = from_path
+        self.to_path = to_path
+        self.from_label = from_label or from_path
+        self.to_label = to_label or to_path
+        self.context = context
+        self.max_file_size = max_file_size
+        self.max_size = max_size
+        self.written = 0
+        self.truncated = False
+
+    def _label(self, label, diff_file):
+        if diff_file is None:
+            return '/dev/null'
+        if os.path.isdir(self.from_path if label == 'a' else self.to_path):
+            base = self.from_label if label == 'a' else self.to_label
+            return os.path.join(base, diff_file.relpath)
+        return self.from_label if label == 'a' else self.to_label
+
+    def _oversized(self, diff_file):
+        return bool(diff_file and self.max_file_size and diff_file.size > self.max_file_size)
+
+    def _add_funcname(self, line, from_lines):
+        # Like git, show the closest line before the hunk that looks like
+        # the start of a function (or section) in the hunk header
+        from_range = line.split(b' ')[1][1:].split(b',')
+        start = int(from_range[0])
+        if len(from_range) == 1 or int(from_range[1]):
+            start -= 1
+        for i in range(start - 1, -1, -1):
+            funcline = from_lines[i]
+            if FUNCNAME_RE.match(funcline):
+                return line.rstrip(b'\n') + b' ' + funcline.rstrip()[:80] + b'\n'
+        return line
+
+    def _file_diff(self, from_file, to_file, similarity=None):
+        """
+        Returns the diff for a single file (or pair of files) as a list
+        of lines (as bytes), or an empty list if there is no difference
+        """
+        from_name = self._label('a', from_file)
+        to_name = self._label('b', to_file)
+        if from_file and to_file and similarity is None:
+            if from_file.mode == to_file.mode and from_file.same_content(to_file):
+                return []
+        lines = [('diff --git a/%s b/%s\n' % (from_name if from_file else to_name, to_name if to_file else from_name)).encode()]
+        if from_file is None:
+            lines.append(('new file mode %s\n' % to_file.mode).encode())
+        elif to_file is None:
+            lines.append(('deleted file mode %s\n' % from_file.mode).encode())
+        elif from_file.mode != to_file.mode:
+            lines.append(('old mode %s\n' % from_file.mode).encode())
+            lines.append(('new mode %s\n' % to_file.mode).encode())
+        if similarity is not None:
+            lines.append(('similarity index %d%%\n' % int(similarity * 100)).encode())
+            lines.append(('rename from %s\n' % from_name).encode())
+            lines.append(('rename to %s\n' % to_name).encode())
+            if similarity == 1.0:
+                return lines
+        if self._oversized(from_file) or self._oversized(to_file):
+            return lines
+        if from_file and to_file and from_file.same_content(to_file):
+            # Mode change only
+            return lines
+        index = 'index %s..%s' % (from_file.blob_id() if from_file else '0000000',
+                                  to_file.blob_id() if to_file else '0000000')
+        if from_file and to_file and from_file.mode == to_file.mode:
+            index += ' %s' % from_file.mode
+        lines.append((index + '\n').encode())
+        if (from_file and from_file.is_binary()) or (to_file and to_file.is_binary()):
+            return lines
+        # The content is only needed for as long as it takes to diff it
+        from_lines = from_file.read().splitlines(True) if from_file else []
+        to_lines = to_file.read().splitlines(True) if to_file else []
+        hunks = difflib.diff_bytes(difflib.unified_diff,
+                                   from_lines,
+                                   to_lines,
+                                   ('a/%s' % from_name if from_file else from_name).encode(),
+                                   ('b/%s' % to_name if to_file else to_name).encode(),
+                                   n=self.context)
+        for line in hunks:
+            if line.startswith(b'@@ '):
+                line = self._add_funcname(line, from_lines)
+            if line.endswith(b'\n'):
+                lines.append(line)
+            else:
+                lines.append(line + b'\n')
+                lines.append(b'\\ No newline at end of file\n')
+        return lines
+
+    def write(self, outfile, compress=False, indexfile=None):
+        """
+        Write the diff to outfile (a path), gzip-compressed if compress is
+        True. If indexfile is specified, also write a JSON index of the
+        files in the diff to it (giving the path, status, offset and length
+        within outfile and number of lines added and removed for each file).
+        Returns True if there were any differences.
+        """
+        for path in (self.from_path, self.to_path):
+            if not os.path.lexists(path):
+                raise DiffError('Unable to generate diff: %s does not exist' % path)
+        if os.path.isdir(self.from_path) != os.path.isdir(self.to_path):
+            raise DiffError('Unable to generate diff: cannot compare a file with a directory')
+        from_files = _walk(self.from_path)
+        to_files = _walk(self.to_path)
+        if not os.path.isdir(self.from_path):
+            # Comparing two files, names don't matter
+            from_files = {'': f for f in from_files.values()}
+            to_files = {'': f for f in to_files.values()}
+
+        entries = []
+        for relpath in from_files.keys() & to_files.keys():
+            entries.append((relpath, from_files[relpath], to_files[relpath], None))
+        deleted = {relpath: from_files[relpath] for relpath in from_files.keys() - to_files.keys()}
+        added = {relpath: to_files[relpath] for relpath in to_files.keys() - from_files.keys()}
+        for from_file, to_file, similarity in _find_renames(deleted, added, self.max_file_size):
+            entries.append((to_file.relpath, from_file, to_file, similarity))
+        for relpath, from_file in deleted.items():
+            entries.append((relpath, from_file, None, None))
+        for relpath, to_file in added.items():
+            entries.append((relpath, None, to_file, None))
+        entries.sort(key=lambda entry: entry[0])
+
+        changed = False
+        files = []
+        # Write to a unique temporary file so that concurrent writers of the
+        # same output don't interfere with each other
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(outfile), prefix='.', suffix='.temp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                offset = 0
+                for _, from_file, to_file, similarity in entries:
+                    lines = self._file_diff(from_file, to_file, similarity)
+                    if not lines:
+                        continue
+                    changed = True
+                    data = b''.join(lines)
+                    if self.max_size and self.written + len(data) > self.max_size:
+                        self.truncated = True
+                        break
+                    self.written += len(data)
+                    if compress:
+                        # Each file gets its own gzip member, so that it can
+                        # be served on its own (a series of members is
+                        # still a valid gzip stream for the whole diff)
+                        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                        data = compressor.compress(data) + compressor.flush()
+                    f.write(data)
+                    diff_file = to_file or from_file
+                    added, removed = _count_changes(lines)
+                    if from_file is None:
+                        status = 'A'
+                    elif to_file is None:
+                        status = 'D'
+                    elif similarity is not None:
+                        status = 'R'
+                    else:
+                        status = 'M'
+                    files.append({'path': diff_file.relpath or self._label('b' if to_file else 'a', diff_file),
+                                  'status': status,
+                                  'offset': offset,
+                                  'length': len(data),
+                                  'added': added,
+                                  'removed': removed})
+                    offset += len(data)
+            os.chmod(tmpfile, 0o644)
+            os.replace(tmpfile, outfile)
+        except:
+            try:
+                os.remove(tmpfile)
+            except FileNotFoundError:
+                pass
+            raise
+        if indexfile:
+            index = {'compressed': compress, 'truncated': self.truncated, 'files': files}
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(indexfile), prefix='.', suffix='.temp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(index, f, separators=(',', ':'))
+                os.chmod(tmpfile, 0o644)
+                os.replace(tmpfile, indexfile)
+            except:
+                try:
+                    os.remove(tmpfile)
+                except FileNotFoundError:
+                    pass
+                raise
+        return changed
+
+def tree_hash(path, file_hashes=None):
+    """
+    Returns a hash of the content (file names, modes and data) of a file
+    or directory tree. If file_hashes is specified, it is a dict of
+    relative path -> [size, mtime, hash] as left by a previous call for
+    the same path; files whose size and modification time match aren't
+    read again, and the dict is updated in place.
+    """
+    tree = hashlib.sha256()
+    files = _walk(path)
+    if not os.path.isdir(path):
+        files = {'': f for f in files.values()}
+    for relpath in sorted(files):
+        diff_file = files[relpath]
+        tree.update(('%s\0%s\0' % (relpath, diff_file.mode)).encode())
+        if file_hashes is None:
+            tree.update(diff_file.digest())
+            continue
+        entry = file_hashes.get(relpath, None)
+        if not entry or entry[0] != diff_file.size or entry[1] != diff_file.mtime:
+            entry = [diff_file.size, diff_file.mtime, diff_file.digest().hex()]
+            file_hashes[relpath] = entry
+        tree.update(bytes.fromhex(entry[2]))
+    if file_hashes is not None:
+        for relpath in file_hashes.keys() - files.keys():
+            del file_hashes[relpath]
+    return tree.hexdigest()
+
+
+class DiffCache():
+    """
+    Cache of generated diffs keyed by the content of the trees being
+    compared, so that the same diff can be shared between comparisons.
+    Diffs are stored gzip-compressed, alongside an index of the files
+    in each diff (see DirectoryDiff.write()).
+    Entries (including the recorded tree hashes) are evicted
+    least-recently-used first once the total size of the cache goes over
+    max_size (0 means no limit).
+    """
+    def __init__(self, cachedir, max_size=0):
+        self.cachedir = cachedir
+        self.max_size = max_size
+
+    def tree_hash(self, path):
+        """
+        Returns tree_hash() for path, keeping a record of the hashes of the
+        files within it in the cache so that next time only files that have
+        changed (going by size and modification time) need to be read
+        """
+        hashes_path = os.path.join(self.cachedir, TREES_DIR_NAME, '%s.json' % hashlib.sha256(os.path.abspath(path).encode()).hexdigest())
+        try:
+            with open(hashes_path, 'r') as f:
+                file_hashes = json.load(f)
+        except (FileNotFoundError, ValueError):
+            file_hashes = {}
+        previous = dict(file_hashes)
+        result = tree_hash(path, file_hashes)
+        if file_hashes != previous:
+            os.makedirs(os.path.dirname(hashes_path), exist_ok=True)
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(hashes_path), prefix='.', suffix='.temp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(file_hashes, f, separators=(',', ':'))
+            os.replace(tmpfile, hashes_path)
+        elif file_hashes:
+            # Mark as recently used
+            try:
+                os.utime(hashes_path)
+            except FileNotFoundError:
+                pass
+        return result
+
+    def get_key(self, from_path, to_path, dirdiff):
+        """
+        Get the cache key for diffing from_path against to_path with the
+        specified DirectoryDiff (whose options affect the output)
+        """
+        key = hashlib.sha256()
+        for item in (self.tree_hash(from_path), self.tree_hash(to_path), dirdiff.from_label, dirdiff.to_label,
+                     dirdiff.context, dirdiff.max_file_size, dirdiff.max_size):
+            key.update(('%s\0' % item).encode())
+        return key.hexdigest()
+
+    @staticmethod
+    def get_relative_path(key):
+        return os.path.join(key[:2], '%s.diff.gz' % key)
+
+    def get_path(self, key):
+        return os.path.join(self.cachedir, self.get_relative_path(key))
+
+    def get_index_path(self, key):
+        return os.path.join(self.cachedir, key[:2], '%s.index.json' % key)
+
+    def get_index(self, key):
+        with open(self.get_index_path(key), 'r') as f:
+            return json.load(f)
+
+    def lookup(self, key):
+        """
+        Returns the path to the cached diff for key (marking it as recently
+        used), or None if it isn't in the cache
+        """
+        path = self.get_path(key)
+        if not os.path.exists(self.get_index_path(key)):
+            # Incomplete (or from before indexes were written)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key, dirdiff):
+        """
+        Write the diff to the cache under key and evict old entries as
+        needed. Returns the path to the cached diff.
+        """
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dirdiff.write(path, compress=True, indexfile=self.get_index_path(key))
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        if not self.max_size:
+            return
+        entries = []
+        index_sizes = {}
+        total = 0
+        for subdir in os.scandir(self.cachedir):
+            if not subdir.is_dir(follow_symlinks=False):
+                continue
+            for entry in os.scandir(subdir.path):
+                if subdir.name == TREES_DIR_NAME:
+                    if not entry.name.endswith('.json'):
+                        continue
+                # (.diff files are from before diffs were compressed)
+                elif not entry.name.endswith(('.diff', '.diff.gz', '.index.json')):
+                    continue
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                total += st.st_size
+                if entry.name.endswith('.index.json') and subdir.name != TREES_DIR_NAME:
+                    index_sizes[entry.path] = st.st_size
+                else:
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+        entries.sort()
+        for _, path, size in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            if path.endswith('.json'):
+                # Recorded tree hashes
+                index_path = None
+            else:
+                # The index goes along with the diff
+                index_path = os.path.join(os.path.dirname(path), '%s.index.json' % os.path.basename(path).split('.')[0])
+            for fn in (path, index_path):
+                if not fn:
+                    continue
+                try:
+                    os.remove(fn)
+                except FileNotFoundError:
+                    pass
+            total -= size + index_sizes.get(index_path, 0)
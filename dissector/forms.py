@@ -45,6 +45,21 @@ class VersionComparisonForm(StyledForm):
         return cleaned_data
 
 
+class VersionTimelineForm(StyledForm):
+    branches = forms.ModelMultipleChoiceField(label='Releases', queryset=Branch.objects.none(), help_text='Select two or more releases (they will be shown in the order listed)')
+
+    def __init__(self, *args, request=None, **kwargs):
+        super(VersionTimelineForm, self).__init__(*args, **kwargs)
+        self.fields['branches'].queryset = Branch.objects.filter(comparison=True, imagecomparison_from_set__isnull=True).order_by('sort_priority', 'name')
+        self.request = request
+
+    def clean_branches(self):
+        branches = self.cleaned_data['branches']
+        if len(branches) < 2:
+            raise forms.ValidationError('Please select at least two releases')
+        return branches
+
+
 class ImageComparisonCreateForm(forms.Form):
     name = forms.CharField(max_length=50, help_text="Name for the image comparison")
     file = forms.FileField()
@@ -0,0 +1,508 @@
+# Clear Linux Dissector - image comparison import
+#
+# Copyright (C) 2018-2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+import os
+import tarfile
+import shutil
+import codecs
+import hashlib
+import json
+import tempfile
+from collections import OrderedDict
+
+from layerindex import utils
+
+
+# Number of rows to write in each bulk INSERT
+BULK_BATCH_SIZE = 500
+
+# Directory (under IMAGE_COMPARE_PATCH_DIR) holding the content-addressed
+# patch files that per-comparison patch files are hardlinked to
+BLOB_DIR_NAME = '.blobs'
+
+
+class ImageImportError(Exception):
+    pass
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ImageRecipeWriter():
+    """
+    Collects image comparison recipes and their sources, patches and
+    build dependency information in memory, then writes them out with
+    bulk INSERTs in batches rather than one row at a time.
+    """
+    def __init__(self, batch_size=BULK_BATCH_SIZE, logger=None, pwriter=None):
+        self.batch_size = batch_size
+        self.logger = logger
+        self.pwriter = pwriter
+        self.entries = []
+
+    def add(self, recipe, sources, patches, depends, packageconfig_opts):
+        """
+        Queue an unsaved ImageComparisonRecipe to be written along with
+        its (unsaved) Source and Patch objects, DEPENDS value and
+        PACKAGECONFIG options
+        """
+        recipe.fingerprint = utils.recipe_fingerprint(recipe.sha256sum,
+                                                      [(patch.src_path, patch.applied, patch.sha256sum) for patch in patches],
+                                                      [(source.url, source.sha256sum) for source in sources])
+        self.entries.append((recipe, sources, patches, depends.split(), packageconfig_opts))
+
+    def _insert_recipes(self):
+        from django.db import connection
+        from layerindex.models import Recipe, truncate_charfield_values
+        from dissector.models import ImageComparisonRecipe
+
+        recipes = [entry[0] for entry in self.entries]
+        for recipe in recipes:
+            # bulk_create() doesn't send pre_save, so do this ourselves
+            truncate_charfield_values(ImageComparisonRecipe, recipe)
+
+        # Django can't bulk_create() a multi-table inherited model, so
+        # write the parent rows first and then the child rows
+        parent_fields = [f for f in Recipe._meta.concrete_fields if not f.primary_key]
+        parents = []
+        for recipe in recipes:
+            parent = Recipe()
+            for field in parent_fields:
+                setattr(parent, field.attname, getattr(recipe, field.attname))
+            parents.append(parent)
+        Recipe.objects.bulk_create(parents, batch_size=self.batch_size)
+
+        if not connection.features.can_return_ids_from_bulk_insert:
+            # Fix up the ids by looking the rows up again by layerbranch,
+            # path and filename (rather than relying on how the database
+            # allocates ids). If the same file somehow appears more than
+            # once, rows with the same key were inserted in order.
+            parent_keys = {}
+            for parent in parents:
+                parent_keys.setdefault((parent.layerbranch_id, parent.filepath, parent.filename), []).append(parent)
+            layerbranch_ids = set([recipe.layerbranch_id for recipe in recipes])
+            found = {}
+            for pid, layerbranch_id, filepath, filename in Recipe.objects.filter(layerbranch_id__in=layerbranch_ids).order_by('id').values_list('id', 'layerbranch_id', 'filepath', 'filename'):
+                found.setdefault((layerbranch_id, filepath, filename), []).append(pid)
+            count = sum(len(ids) for ids in found.values())
+            if count != len(parents) or found.keys() != parent_keys.keys():
+                raise ImageImportError('Unexpected number of recipes written (%d, expected %d)' % (count, len(parents)))
+            for key, key_parents in parent_keys.items():
+                if len(found[key]) != len(key_parents):
+                    raise ImageImportError('Unexpected number of recipes written for %s/%s (%d, expected %d)' % (key[1], key[2], len(found[key]), len(key_parents)))
+                for parent, pid in zip(key_parents, found[key]):
+                    parent.id = pid
+
+        for recipe, parent in zip(recipes, parents):
+            recipe.recipe_ptr_id = parent.id
+            recipe.id = parent.id
+        # bulk_create() refuses to write the child rows, so do that with
+        # a plain INSERT through executemany()
+        child_fields = ImageComparisonRecipe._meta.local_concrete_fields
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(ImageComparisonRecipe._meta.db_table),
+                                                  ', '.join([qn(field.column) for field in child_fields]),
+                                                  ', '.join(['%s'] * len(child_fields)))
+        with connection.cursor() as cursor:
+            for batch in _chunks(recipes, self.batch_size):
+                cursor.executemany(sql, [[field.get_db_prep_save(getattr(recipe, field.attname), connection) for field in child_fields] for recipe in batch])
+
+    def _insert_sources_patches(self):
+        from layerindex.models import Source, Patch, truncate_charfield_values
+        sources = []
+        patches = []
+        for recipe, recipe_sources, recipe_patches, _, _ in self.entries:
+            for source in recipe_sources:
+                source.recipe_id = recipe.id
+                truncate_charfield_values(Source, source)
+                sources.append(source)
+            for patch in recipe_patches:
+                patch.recipe_id = recipe.id
+                truncate_charfield_values(Patch, patch)
+                patches.append(patch)
+        Source.objects.bulk_create(sources, batch_size=self.batch_size)
+        Patch.objects.bulk_create(patches, batch_size=self.batch_size)
+
+    def _get_or_create_by_name(self, model, names):
+        # Equivalent of get_or_create(name=...) for a set of names at once
+        nameids = {}
+        for batch in _chunks(names, self.batch_size):
+            for name, objid in model.objects.filter(name__in=batch).order_by('-id').values_list('name', 'id'):
+                nameids[name] = objid
+        missing = [name for name in names if name not in nameids]
+        if missing:
+            model.objects.bulk_create([model(name=name) for name in missing], batch_size=self.batch_size)
+            for batch in _chunks(missing, self.batch_size):
+                for name, objid in model.objects.filter(name__in=batch).order_by('-id').values_list('name', 'id'):
+                    nameids[name] = objid
+        return nameids
+
+    def _insert_depends(self):
+        # Bulk equivalent of recipeparse.handle_recipe_depends()
+        from layerindex.models import StaticBuildDep, PackageConfig, DynamicBuildDep
+
+        static_names = set()
+        for _, _, _, depends, _ in self.entries:
+            static_names.update(depends)
+        static_ids = self._get_or_create_by_name(StaticBuildDep, sorted(static_names))
+        static_links = set()
+        for recipe, _, _, depends, _ in self.entries:
+            for dep in depends:
+                static_links.add((static_ids[dep], recipe.id))
+        StaticRecipes = StaticBuildDep.recipes.through
+        StaticRecipes.objects.bulk_create([StaticRecipes(staticbuilddep_id=depid, recipe_id=recipeid) for depid, recipeid in sorted(static_links)], batch_size=self.batch_size)
+
+        package_configs = []
+        for recipe, _, _, _, packageconfig_opts in self.entries:
+            for key, value in packageconfig_opts.items():
+                if key == "doc":
+                    continue
+                package_config = PackageConfig()
+                package_config.feature = key
+                package_config.recipe_id = recipe.id
+                package_config_vals = value.split(",")
+                try:
+                    package_config.build_deps = package_config_vals[2]
+                except IndexError:
+                    pass
+                try:
+                    package_config.with_option = package_config_vals[0]
+                except IndexError:
+                    pass
+                try:
+                    package_config.without_option = package_config_vals[1]
+                except IndexError:
+                    pass
+                package_configs.append(package_config)
+        if not package_configs:
+            return
+        PackageConfig.objects.bulk_create(package_configs, batch_size=self.batch_size)
+
+        recipe_ids = [entry[0].id for entry in self.entries]
+        pcids = {}
+        for batch in _chunks(recipe_ids, self.batch_size):
+            for pcid, recipe_id, feature in PackageConfig.objects.filter(recipe_id__in=batch).values_list('id', 'recipe_id', 'feature'):
+                pcids[(recipe_id, feature)] = pcid
+
+        dynamic_names = set()
+        for package_config in package_configs:
+            dynamic_names.update(package_config.build_deps.split())
+        dynamic_ids = self._get_or_create_by_name(DynamicBuildDep, sorted(dynamic_names))
+        pc_links = set()
+        recipe_links = set()
+        for package_config in package_configs:
+            for dep in package_config.build_deps.split():
+                pc_links.add((dynamic_ids[dep], pcids[(package_config.recipe_id, package_config.feature)]))
+                recipe_links.add((dynamic_ids[dep], package_config.recipe_id))
+        DynamicPackageConfigs = DynamicBuildDep.package_configs.through
+        DynamicPackageConfigs.objects.bulk_create([DynamicPackageConfigs(dynamicbuilddep_id=depid, packageconfig_id=pcid) for depid, pcid in sorted(pc_links)], batch_size=self.batch_size)
+        DynamicRecipes = DynamicBuildDep.recipes.through
+        DynamicRecipes.objects.bulk_create([DynamicRecipes(dynamicbuilddep_id=depid, recipe_id=recipeid) for depid, recipeid in sorted(recipe_links)], batch_size=self.batch_size)
+
+    def write(self, progress_start=0):
+        """
+        Write out everything that has been queued. Must be called within
+        a transaction. If a ProgressWriter was supplied, progress is
+        reported from progress_start up to 100.
+        """
+        if not self.entries:
+            return
+        if self.logger:
+            self.logger.info('Writing %d recipes' % len(self.entries))
+        stages = [self._insert_recipes, self._insert_sources_patches, self._insert_depends]
+        for i, stage in enumerate(stages):
+            stage()
+            if self.pwriter:
+                self.pwriter.write(progress_start + int((100 - progress_start) * (i + 1) / len(stages)))
+        self.entries = []
+
+
+def get_blob_path(blobdir, sha256sum):
+    return os.path.join(blobdir, sha256sum[:2], sha256sum)
+
+
+def _link_blob(blobdir, tmpfn, sha256sum, outfile):
+    """
+    Make outfile a hardlink to the blob for the given checksum, moving
+    tmpfn (which has the same contents) into the store if the blob isn't
+    already there. Falls back to a plain copy if hardlinks can't be used.
+    """
+    blobfn = get_blob_path(blobdir, sha256sum)
+    try:
+        os.link(blobfn, outfile)
+    except FileNotFoundError:
+        # Not in the store, or just removed by delete_comparison_patches()
+        # (which doesn't lock against us), so put our copy there. Link it
+        # into place first so that the blob never appears unreferenced.
+        os.makedirs(os.path.dirname(blobfn), exist_ok=True)
+        try:
+            os.link(tmpfn, outfile)
+        except OSError:
+            # e.g. filesystem doesn't support hardlinks
+            shutil.move(tmpfn, outfile)
+        else:
+            os.replace(tmpfn, blobfn)
+    except OSError:
+        # e.g. filesystem doesn't support hardlinks
+        shutil.move(tmpfn, outfile)
+    else:
+        os.remove(tmpfn)
+
+
+def delete_comparison_patches(patchdir, comparison_id):
+    """
+    Delete the patch files for an image comparison, along with any blobs
+    in the patch store that are no longer referenced by any comparison
+    """
+    comppatchdir = os.path.join(patchdir, str(comparison_id))
+    if not os.path.isdir(comppatchdir):
+        return
+    blobdir = os.path.join(patchdir, BLOB_DIR_NAME)
+    candidates = set()
+    for root, dirs, files in os.walk(comppatchdir):
+        for fn in files:
+            fullpath = os.path.join(root, fn)
+            if os.stat(fullpath).st_nlink > 1:
+                candidates.add(get_blob_path(blobdir, utils.sha256_file(fullpath)))
+    shutil.rmtree(comppatchdir)
+    for blobfn in candidates:
+        try:
+            # Only the store's own link left, so nothing else uses it
+            if os.stat(blobfn).st_nlink == 1:
+                os.remove(blobfn)
+        except FileNotFoundError:
+            pass
+
+
+def extract_image_tarball(tarball, outdir, blobdir=None):
+    """
+    Extract an image comparison tarball in a single streaming pass,
+    validating each member as we go. Patch files are written straight
+    into outdir (minus the tarball's top-level directory) and data.json
+    is parsed directly out of the stream. If blobdir is specified, patch
+    files are stored there by checksum and hardlinked into outdir, so
+    that identical files are only stored once across comparisons.
+    Returns the parsed JSON data and a dict of sha256 checksums for the
+    files written, keyed by path relative to outdir.
+    """
+    jsdata = None
+    checksums = {}
+    if blobdir:
+        os.makedirs(blobdir, exist_ok=True)
+    with tarfile.open(tarball, "r|gz") as tar:
+        for tarinfo in tar:
+            parts = [part for part in tarinfo.name.split('/') if part and part != '.']
+            if tarinfo.name.startswith('/') or '..' in parts:
+                raise ImageImportError('Invalid image comparison tarball: bad path %s' % tarinfo.name)
+            if tarinfo.isdir():
+                continue
+            elif not tarinfo.isfile():
+                # Disallow symlinks / devices etc.
+                raise ImageImportError('Invalid image comparison tarball: %s is not a regular file' % tarinfo.name)
+            if len(parts) < 2:
+                # Everything of interest is under a single top-level directory
+                continue
+            relpath = os.path.join(*parts[1:])
+            if relpath == 'data.json':
+                with tar.extractfile(tarinfo) as f:
+                    tstream = codecs.getreader("utf-8")(f)
+                    jsdata = json.load(tstream, object_pairs_hook=OrderedDict)
+                continue
+            elif len(parts) < 3:
+                # We only want the files in the per-recipe directories
+                continue
+            outfile = os.path.join(outdir, relpath)
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            if blobdir:
+                tmpfd, writefn = tempfile.mkstemp(dir=blobdir, prefix='.tmp')
+                os.close(tmpfd)
+                # mkstemp() creates the file private, but the web server needs to read it
+                os.chmod(writefn, 0o644)
+            else:
+                writefn = outfile
+            shash = hashlib.sha256()
+            try:
+                with tar.extractfile(tarinfo) as f, open(writefn, 'wb') as outf:
+                    while True:
+                        data = f.read(65536)
+                        if not data:
+                            break
+                        shash.update(data)
+                        outf.write(data)
+            except:
+                if blobdir:
+                    os.remove(writefn)
+                raise
+            checksums[relpath] = shash.hexdigest()
+            if blobdir:
+                _link_blob(blobdir, writefn, checksums[relpath], outfile)
+    return jsdata, checksums
+
+
+def import_image_comparison(tarball, user, name, to_branch, logger, pwriter=None):
+    """
+    Import an uploaded image comparison tarball into the database,
+    returning the resulting ImageComparison
+    """
+    from django.db import transaction
+    from layerindex.models import Branch, LayerItem, LayerBranch, Source, Patch
+    from dissector.models import ImageComparison, ImageComparisonRecipe
+    import settings
+
+    patchdir = getattr(settings, 'IMAGE_COMPARE_PATCH_DIR', None)
+    if not patchdir:
+        raise ImageImportError('IMAGE_COMPARE_PATCH_DIR not set')
+
+    if not os.path.exists(tarball):
+        raise ImageImportError('Uploaded file %s not found' % tarball)
+
+    # FIXME recipe file links may not work because versions may not match up (might have built an older version)
+
+    jsdata = None
+    with transaction.atomic():
+        branch = Branch()
+        origname = name.replace(' ', '_')
+        branchname = origname
+        i = 1
+        while Branch.objects.filter(name=branchname).exists():
+            i += 1
+            branchname = '%s_%d' % (origname, i)
+        branch.name = branchname
+        branch.bitbake_branch = 'N/A'
+        branch.short_description = 'Image comparison %s' % name
+        if i > 1:
+            branch.short_description += ' (%d)' % i
+        branch.updates_enabled = False
+        branch.comparison = True
+        branch.hidden = True
+        branch.save()
+
+        # Have a function to create layers on the fly so that we don't create any we don't need to
+        layerbranches = {}
+        def get_layerbranch(layername, local_path):
+            layerbranch = layerbranches.get(layername, None)
+            if layerbranch:
+                return layerbranch
+            actualname = layername
+            if layername == 'meta':
+                actualname = settings.CORE_LAYER_NAME
+            jslayer = jsdata['layers'][layername]
+            layer, created = LayerItem.objects.get_or_create(name=actualname)
+            if created:
+                layer.status = 'X'
+                layer.layer_type = 'M'
+                layer.summary = 'N/A'
+                layer.description = 'N/A'
+                layer.vcs_url = jslayer['vcs_url']
+                layer.comparison = True
+                layer.save()
+            layerbranch = LayerBranch()
+            layerbranch.layer = layer
+            layerbranch.branch = branch
+            layerbranch.vcs_subdir = jslayer.get('vcs_subdir', '')
+            layerbranch.actual_branch = jslayer.get('actual_branch', '')
+            layerbranch.local_path = local_path
+            layerbranch.save()
+            layerbranches[layername] = layerbranch
+            return layerbranch
+
+        comparison = ImageComparison()
+        comparison.user = user
+        comparison.name = name
+        comparison.from_branch = branch
+        comparison.to_branch = to_branch
+        comparison.save()
+
+        local_path = str(comparison.id)
+
+        # Extract patch files straight into their final location
+        comppatchdir = os.path.join(patchdir, local_path)
+        os.makedirs(comppatchdir)
+        try:
+            logger.info('Extracting %s' % os.path.basename(tarball))
+            jsdata, checksums = extract_image_tarball(tarball, comppatchdir, os.path.join(patchdir, BLOB_DIR_NAME))
+            if not jsdata:
+                raise ImageImportError('No data.json found in image comparison tarball')
+
+            writer = ImageRecipeWriter(logger=logger, pwriter=pwriter)
+            cover_index = utils.CoverIndex(comparison.to_branch)
+            total = len(jsdata['recipes'])
+            logger.info('Importing %d recipes' % total)
+            for count, (pn, jsrecipe) in enumerate(jsdata['recipes'].items()):
+                logger.debug('Importing %s' % pn)
+                recipe = ImageComparisonRecipe()
+                recipe.comparison = comparison
+                recipe.layerbranch = get_layerbranch(jsrecipe['layer'], local_path)
+                recipe.filepath = os.path.dirname(jsrecipe['filepath'])
+                recipe.filename = os.path.basename(jsrecipe['filepath'])
+                for key,value in jsrecipe.items():
+                    if key in ['filepath', 'layer', 'inherits', 'patches', 'source_urls', 'DEPENDS', 'PACKAGECONFIG', 'packageconfig_opts']:
+                        continue
+                    if key.startswith('EXTRA_OE'):
+                        continue
+                    keylower = key.lower()
+                    if value and hasattr(recipe, keylower):
+                        setattr(recipe, keylower, value)
+                recipe.inherits = ' '.join(jsrecipe.get('inherits', []))
+                for confvar in ['EXTRA_OEMESON', 'EXTRA_OECMAKE', 'EXTRA_OESCONS', 'EXTRA_OECONF']:
+                    recipe.configopts = jsrecipe.get(confvar, '')
+                    if recipe.configopts:
+                        break
+                else:
+                    recipe.configopts = ''
+
+                # Cover info
+                cover_recipe = cover_index.get(recipe.layerbranch.layer.name, pn)
+                if cover_recipe:
+                    recipe.cover_pn = cover_recipe.pn
+                    # FIXME cover_layerbranch needs to be handled specially
+                    recipe.cover_layerbranch = cover_recipe.layerbranch
+                    # FIXME cover_status might not match
+                    recipe.cover_status = cover_recipe.cover_status
+
+                recipe.sha256sum = jsrecipe.get('filepath', '')
+
+                sources = []
+                for jsurl in jsrecipe.get('source_urls', []):
+                    source = Source()
+                    source.url = jsurl
+                    sources.append(source)
+                patches = []
+                for jspatch in jsrecipe.get('patches', []):
+                    patch = Patch()
+                    patch.path = jspatch[1]
+                    # FIXME handle bbappends - this is will only work for patches in the original recipe (also fetched patches)
+                    patch.src_path = os.path.relpath(patch.path, recipe.filepath)
+                    patchrelpath = os.path.join(pn, os.path.basename(patch.path))
+                    try:
+                        patchfn = os.path.join(comppatchdir, patchrelpath)
+                        patch.read_status_from_file(patchfn)
+                        patch.sha256sum = checksums.get(patchrelpath, None) or utils.sha256_file(patchfn)
+                    except Exception as e:
+                        logger.warning('Failed to read patch status for %s: %s' % (patch.path, e))
+                    patches.append(patch)
+
+                # Take care of dependencies
+                depends = jsrecipe.get('DEPENDS', '')
+                packageconfig_opts = jsrecipe.get('packageconfig_opts', {})
+                writer.add(recipe, sources, patches, depends, packageconfig_opts)
+
+                if pwriter:
+                    pwriter.write(int(count / total * 50))
+
+            writer.write(progress_start=50)
+            for layerbranch in layerbranches.values():
+                layerbranch.update_fingerprint()
+                layerbranch.save()
+        except:
+            # Don't leave the patches lying around if the import gets rolled back
+            delete_comparison_patches(patchdir, comparison.id)
+            raise
+
+    return comparison
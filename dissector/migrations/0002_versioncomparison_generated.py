@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dissector', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='versioncomparison',
+            name='generated',
+            field=models.DateTimeField(blank=True, help_text='Time at which the stored differences were last brought up-to-date', null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dissector', '0002_versioncomparison_generated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagecomparisonrecipe',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='versioncomparison',
+            name='from_fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='versioncomparison',
+            name='to_fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0045_fingerprints'),
+        ('dissector', '0003_fingerprints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionTimeline',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('branch_key', models.CharField(max_length=255, unique=True)),
+                ('status', models.CharField(choices=[('I', 'In progress'), ('F', 'Failed'), ('S', 'Succeeded')], default='I', max_length=1)),
+                ('generated', models.DateTimeField(blank=True, null=True)),
+                ('fingerprint', models.CharField(blank=True, max_length=64)),
+                ('data', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='VersionTimelineBranch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order', models.IntegerField()),
+                ('branch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='layerindex.Branch')),
+                ('timeline', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dissector.VersionTimeline')),
+            ],
+            options={
+                'ordering': ['timeline', 'order'],
+            },
+        ),
+        migrations.AddField(
+            model_name='versiontimeline',
+            name='branches',
+            field=models.ManyToManyField(through='dissector.VersionTimelineBranch', to='layerindex.Branch'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:45
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dissector', '0004_versiontimeline'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='versioncomparisondifference',
+            index_together=set([('comparison', 'change_type', 'pn')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dissector', '0006_versioncomparisonfilediff_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='versioncomparisondifference',
+            name='files_changed',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='versioncomparisondifference',
+            name='lines_added',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='versioncomparisondifference',
+            name='lines_removed',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
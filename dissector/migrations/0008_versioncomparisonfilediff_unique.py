@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_file_diffs(apps, schema_editor):
+    # Keep the most recent successful diff for each difference (or the
+    # most recent one if none succeeded)
+    VersionComparisonFileDiff = apps.get_model('dissector', 'VersionComparisonFileDiff')
+    duplicates = VersionComparisonFileDiff.objects.values('difference').annotate(count=models.Count('id')).filter(count__gt=1)
+    for item in duplicates:
+        fdiffs = list(VersionComparisonFileDiff.objects.filter(difference=item['difference']).order_by('-id'))
+        keep = ([fdiff for fdiff in fdiffs if fdiff.status == 'S'] or fdiffs)[0]
+        VersionComparisonFileDiff.objects.filter(difference=item['difference']).exclude(id=keep.id).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dissector', '0007_versioncomparisondifference_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_file_diffs, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='versioncomparisonfilediff',
+            name='difference',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='dissector.VersionComparisonDifference'),
+        ),
+    ]
@@ -37,12 +37,10 @@ class ImageComparison(models.Model):
 def delete_image_compare_patches(sender, instance, *args, **kwargs):
     # Ensure that patches imported with an image comparison get deleted when it is deleted
     import settings
-    import shutil
+    from dissector.imageimport import delete_comparison_patches
     patchdir = getattr(settings, 'IMAGE_COMPARE_PATCH_DIR', '')
     if patchdir:
-        comppatchdir = os.path.join(patchdir, str(instance.id))
-        if os.path.isdir(comppatchdir):
-            shutil.rmtree(comppatchdir)
+        delete_comparison_patches(patchdir, instance.id)
 
 
 class ImageComparisonRecipe(Recipe):
@@ -60,6 +58,7 @@ class ImageComparisonRecipe(Recipe):
     cover_status = models.CharField(max_length=1, choices=COVER_STATUS_CHOICES, default='U')
     cover_comment = models.TextField(blank=True)
     sha256sum = models.CharField(max_length=64, blank=True)
+    fingerprint = models.CharField(max_length=64, blank=True)
 
     def get_cover_recipe(self):
         if self.cover_layerbranch and self.cover_pn:
@@ -87,6 +86,51 @@ class VersionComparison(models.Model):
     from_branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='versioncomparison_from_set')
     to_branch = models.ForeignKey(Branch, on_delete=models.CASCADE, related_name='versioncomparison_to_set')
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='I')
+    generated = models.DateTimeField(blank=True, null=True, help_text='Time at which the stored differences were last brought up-to-date')
+    from_fingerprint = models.CharField(max_length=64, blank=True)
+    to_fingerprint = models.CharField(max_length=64, blank=True)
+
+    def needs_update(self):
+        """
+        Returns True if either branch may have been re-imported since the
+        stored differences were generated
+        """
+        from layerindex.models import ComparisonRecipeUpdate
+        if self.status != 'S' or not self.generated:
+            return False
+        from_layerbranch = self.from_branch.layerbranch_set.first()
+        to_layerbranch = self.to_branch.layerbranch_set.first()
+        if from_layerbranch and to_layerbranch and from_layerbranch.fingerprint and to_layerbranch.fingerprint:
+            # Content fingerprints are maintained by the importers, so if
+            # they haven't changed then neither has the result
+            return (from_layerbranch.fingerprint, to_layerbranch.fingerprint) != (self.from_fingerprint, self.to_fingerprint)
+        layerbranches = []
+        for branch in [self.from_branch, self.to_branch]:
+            if branch.is_image_comparison():
+                # Image comparisons never get re-imported
+                continue
+            layerbranch = branch.layerbranch_set.first()
+            if layerbranch:
+                if layerbranch.vcs_last_fetch and layerbranch.vcs_last_fetch > self.generated:
+                    return True
+                layerbranches.append(layerbranch)
+        if not layerbranches:
+            return False
+        return ComparisonRecipeUpdate.objects.filter(recipe__layerbranch__in=layerbranches).filter(models.Q(update__finished__isnull=True) | models.Q(update__finished__gt=self.generated)).exists()
+
+    def get_differences(self):
+        """
+        Returns the differences in display order: additions, version
+        changes, modifications and then removals, each sorted by name
+        """
+        from django.db.models.functions import Lower
+        order = models.Case(
+            models.When(change_type='A', then=models.Value(0)),
+            models.When(change_type='M', then=models.Value(2)),
+            models.When(change_type='R', then=models.Value(3)),
+            default=models.Value(1),
+            output_field=models.IntegerField())
+        return self.versioncomparisondifference_set.annotate(display_order=order).order_by('display_order', Lower('pn'), 'id')
 
     def __str__(self):
         return '%s to %s' % (self.from_branch, self.to_branch)
@@ -108,6 +152,15 @@ class VersionComparisonDifference(models.Model):
     change_type = models.CharField(max_length=1, choices=CHANGE_TYPE_CHOICES)
     oldvalue = models.CharField(max_length=255, blank=True)
     newvalue = models.CharField(max_length=255, blank=True)
+    # Size of the package source diff (filled in when the diff is generated)
+    files_changed = models.IntegerField(null=True, blank=True)
+    lines_added = models.IntegerField(null=True, blank=True)
+    lines_removed = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        index_together = [
+            ['comparison', 'change_type', 'pn'],
+        ]
 
     def from_recipe(self):
         if self.comparison.from_branch.is_image_comparison():
@@ -177,32 +230,161 @@ class VersionComparisonDifference(models.Model):
             return 'Modified %s' % self.pn
 
 
+class VersionTimeline(models.Model):
+    STATUS_CHOICES = (
+        ('I', 'In progress'),
+        ('F', 'Failed'),
+        ('S', 'Succeeded'),
+    )
+    branches = models.ManyToManyField(Branch, through='VersionTimelineBranch')
+    # Ordered list of branch ids, so that a timeline can be looked up directly
+    branch_key = models.CharField(max_length=255, unique=True)
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='I')
+    generated = models.DateTimeField(blank=True, null=True)
+    fingerprint = models.CharField(max_length=64, blank=True)
+    # Compact version matrix as JSON - see versioncompare.generate_version_timeline()
+    data = models.TextField(blank=True)
+
+    @staticmethod
+    def get_branch_key(branches):
+        return ','.join([str(branch.id) for branch in branches])
+
+    def ordered_branches(self):
+        return [tbranch.branch for tbranch in self.versiontimelinebranch_set.select_related('branch').order_by('order')]
+
+    def needs_update(self):
+        from dissector.versioncompare import get_timeline_fingerprint
+        if self.status != 'S':
+            return False
+        return get_timeline_fingerprint(self.ordered_branches()) != self.fingerprint
+
+    def get_matrix(self):
+        """
+        Returns a dict of pn -> list of (release index, version) tuples
+        for each release in which the version of the package changed
+        (None meaning the package is not present)
+        """
+        import json
+        if not self.data:
+            return {}
+        return dict([(pn, [tuple(entry) for entry in changes]) for pn, changes in json.loads(self.data)['packages'].items()])
+
+    def package_history(self, pn):
+        """
+        Returns a list of (branch, version, changed) tuples for a package,
+        one for each release in order
+        """
+        changes = dict(self.get_matrix().get(pn, []))
+        history = []
+        version = None
+        for i, branch in enumerate(self.ordered_branches()):
+            changed = i in changes
+            if changed:
+                version = changes[i]
+            history.append((branch, version, changed))
+        return history
+
+    def release_summary(self):
+        """
+        Returns a list of (branch, added, removed, upgraded, downgraded,
+        changed) tuples, one for each release after the first, each list
+        containing pn or (pn, old version, new version) items
+        """
+        from distutils.version import LooseVersion
+        branches = self.ordered_branches()
+        summary = [(branch, [], [], [], [], []) for branch in branches[1:]]
+        for pn, changes in sorted(self.get_matrix().items(), key=lambda item: item[0].lower()):
+            version = None
+            for index, newversion in changes:
+                if index > 0:
+                    _, added, removed, upgraded, downgraded, changed = summary[index - 1]
+                    if version is None:
+                        added.append(pn)
+                    elif newversion is None:
+                        removed.append(pn)
+                    else:
+                        change_list = changed
+                        if version and newversion and ', ' not in version + newversion:
+                            try:
+                                if LooseVersion(newversion) > LooseVersion(version):
+                                    change_list = upgraded
+                                elif LooseVersion(version) > LooseVersion(newversion):
+                                    change_list = downgraded
+                            except TypeError:
+                                # Versions not comparable
+                                pass
+                        change_list.append((pn, version, newversion))
+                version = newversion
+        return summary
+
+    def __str__(self):
+        return ' - '.join([str(branch) for branch in self.ordered_branches()])
+
+
+class VersionTimelineBranch(models.Model):
+    timeline = models.ForeignKey(VersionTimeline, on_delete=models.CASCADE)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE)
+    order = models.IntegerField()
+
+    class Meta:
+        ordering = ['timeline', 'order']
+
+    def __str__(self):
+        return '%s: %s' % (self.timeline_id, self.branch)
+
+
 class VersionComparisonFileDiff(models.Model):
     STATUS_CHOICES = (
         ('I', 'In progress'),
         ('F', 'Failed'),
         ('S', 'Succeeded'),
     )
-    difference = models.ForeignKey(VersionComparisonDifference, on_delete=models.CASCADE)
+    # One per difference, so that whoever creates it first generates the diff
+    difference = models.OneToOneField(VersionComparisonDifference, on_delete=models.CASCADE)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='I')
+    cache_key = models.CharField(max_length=64, blank=True, db_index=True)
+
+    @staticmethod
+    def get_cache():
+        import settings
+        from dissector.diff import DiffCache
+        internal_dir = getattr(settings, 'IMAGE_COMPARE_PATCH_DIR')
+        return DiffCache(os.path.join(internal_dir, 'version-compare', '.cache'),
+                         getattr(settings, 'VERSION_COMPARE_DIFF_CACHE_SIZE', 0))
 
     def get_diff_path(self):
         import settings
+        if self.cache_key:
+            return self.get_cache().get_path(self.cache_key)
         internal_dir = getattr(settings, 'IMAGE_COMPARE_PATCH_DIR')
         return os.path.join(internal_dir, 'version-compare', str(self.difference.comparison.id), '%d.diff' % self.id)
 
+    def get_index_path(self):
+        if self.cache_key:
+            return self.get_cache().get_index_path(self.cache_key)
+        return None
+
     def get_redirect_path(self):
         import settings
+        from dissector.diff import DiffCache
         internal_prefix = getattr(settings, 'IMAGE_COMPARE_PATCH_INTERNAL_URL_PREFIX')
+        if self.cache_key:
+            # Cached diffs are compressed - the web server is expected to
+            # pick up the .gz file itself (see gzip_static in docker/nginx.conf)
+            # so that it can decompress it for clients that can't handle that
+            relpath = os.path.splitext(DiffCache.get_relative_path(self.cache_key))[0]
+            return os.path.join(internal_prefix, 'version-compare', '.cache', relpath)
         return os.path.join(internal_prefix, 'version-compare', str(self.difference.comparison.id), '%d.diff' % self.id)
 
     def __str__(self):
         return '%s (%s)' % (str(self.difference), self.get_status_display())
 
 @receiver(models.signals.post_delete, sender=VersionComparisonFileDiff)
-def delete_image_compare_patches(sender, instance, *args, **kwargs):
-    # Ensure generated diffs get deleted
-
+def delete_version_comparison_diff(sender, instance, *args, **kwargs):
+    # Ensure generated diffs get deleted (cached diffs are shared, so
+    # they're left to be evicted from the cache instead)
+    if instance.cache_key:
+        return
     fdiff_file = instance.get_diff_path()
     try:
         os.remove(fdiff_file)
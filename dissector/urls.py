@@ -12,7 +12,8 @@ from dissector.views import FrontPageView, ImageCompareView, ImageCompareDetailV
     ImageCompareRecipeSearchView, ImageCompareRecipeDetailView, ImageCompareRecipeSelectView, \
     ImageCompareRecipeSelectDetailView, image_compare_patch_view, \
     VersionCompareSelectView, VersionCompareView, VersionCompareRecipeDetailView, VersionCompareFileDiffView, \
-    version_compare_diff_view, VersionCompareContentView, version_compare_regenerate_view, ComparisonImportView
+    version_compare_diff_view, VersionCompareContentView, version_compare_regenerate_view, ComparisonImportView, \
+    VersionTimelineSelectView, VersionTimelineView, VersionTimelineContentView, VersionTimelinePackageView
 
 
 
@@ -77,4 +78,21 @@ urlpatterns = [
     url(r'^versioncompare/diff_file/(?P<diff_id>[-\w]+)/$',
         version_compare_diff_view,
         name="version_comparison_diff_ajax"),
+
+    url(r'^versiontimeline/$',
+        VersionTimelineSelectView.as_view(
+            template_name='dissector/versiontimelineselect.html'),
+        name="version_timeline_select"),
+    url(r'^versiontimeline/(?P<pk>[-\w]+)/$',
+        VersionTimelineView.as_view(
+            template_name='dissector/versiontimeline.html'),
+        name="version_timeline"),
+    url(r'^versiontimeline/(?P<pk>[-\w]+)/content/$',
+        VersionTimelineContentView.as_view(
+            template_name='dissector/versiontimelinecontent.html'),
+        name="version_timeline_ajax"),
+    url(r'^versiontimeline/(?P<pk>[-\w]+)/package/(?P<pn>[^/]+)/$',
+        VersionTimelinePackageView.as_view(
+            template_name='dissector/versiontimelinepackage.html'),
+        name="version_timeline_package"),
 ]
@@ -0,0 +1,397 @@
+# Clear Linux Dissector - version comparison engine
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+from datetime import datetime
+from distutils.version import LooseVersion
+
+
+# Number of ids to put in each IN (...) query
+QUERY_BATCH_SIZE = 500
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class ComparisonSide():
+    """
+    Recipe data for one side of a version comparison, loaded in bulk
+    """
+    def __init__(self, branch, layerbranch, use_cover_pn):
+        from layerindex.models import ClassicRecipe
+        from dissector.models import ImageComparisonRecipe
+        self.branch = branch
+        self.layerbranch = layerbranch
+        if branch.is_image_comparison():
+            self.queryset = ImageComparisonRecipe.objects.filter(layerbranch=layerbranch)
+        else:
+            self.queryset = ClassicRecipe.objects.filter(layerbranch=layerbranch, deleted=False)
+        # When comparing an image against a distro, the image recipes
+        # are matched up using the distro recipe name covering them
+        self.keyfield = 'cover_pn' if use_cover_pn else 'pn'
+        self.fingerprint = layerbranch.fingerprint if layerbranch else ''
+        # key -> list of (id, pv, sha256sum, fingerprint), in id order
+        self.recipes = {}
+        for values in self.queryset.order_by('id').values_list('id', self.keyfield, 'pv', 'sha256sum', 'fingerprint'):
+            self.recipes.setdefault(values[1], []).append(values[:1] + values[2:])
+
+    def keys(self):
+        return set(self.recipes.keys())
+
+
+def _load_patches(recipe_ids):
+    """
+    Returns a dict of recipe id -> (set of applied patch src_paths,
+    dict of src_path -> sha256sum of first patch with that src_path)
+    """
+    from layerindex.models import Patch
+    patches = {}
+    for batch in _chunks(recipe_ids, QUERY_BATCH_SIZE):
+        qs = Patch.objects.filter(recipe_id__in=batch).order_by('recipe', 'apply_order', 'id')
+        for recipe_id, src_path, applied, sha256sum in qs.values_list('recipe_id', 'src_path', 'applied', 'sha256sum'):
+            applied_paths, checksums = patches.setdefault(recipe_id, (set(), {}))
+            if applied:
+                applied_paths.add(src_path)
+            checksums.setdefault(src_path, sha256sum)
+    return patches
+
+
+def _load_sources(recipe_ids):
+    """
+    Returns a dict of recipe id -> dict of url -> sha256sum of first
+    source with that url
+    """
+    from layerindex.models import Source
+    sources = {}
+    for batch in _chunks(recipe_ids, QUERY_BATCH_SIZE):
+        qs = Source.objects.filter(recipe_id__in=batch).order_by('id')
+        for recipe_id, url, sha256sum in qs.values_list('recipe_id', 'url', 'sha256sum'):
+            sources.setdefault(recipe_id, {}).setdefault(url, sha256sum)
+    return sources
+
+
+def _is_modified(from_recipe, to_recipe, patches, sources):
+    from_id, _, from_sha256sum, _ = from_recipe
+    to_id, _, to_sha256sum, _ = to_recipe
+    if from_sha256sum != to_sha256sum:
+        return True
+
+    # Check patches
+    from_applied, from_patches = patches.get(from_id, (set(), {}))
+    to_applied, to_patches = patches.get(to_id, (set(), {}))
+    if from_applied.symmetric_difference(to_applied):
+        return True
+    for src_path in from_applied.union(to_applied):
+        if from_patches[src_path] != to_patches[src_path]:
+            return True
+
+    # Check sources
+    from_sources = sources.get(from_id, {})
+    to_sources = sources.get(to_id, {})
+    if set(from_sources.keys()).symmetric_difference(to_sources.keys()):
+        return True
+    for url in from_sources:
+        if from_sources[url] != to_sources[url]:
+            return True
+
+    return False
+
+
+def compare_items(from_side, to_side, items):
+    """
+    Compare the recipes with the specified keys (which must be present
+    on both sides), returning (version changes, modifications) as lists
+    of (pn, change_type, oldvalue, newvalue) tuples in the order they
+    should be stored
+    """
+    changes = []
+    candidates = []
+    for item in sorted(items, key=lambda s: s.lower()):
+        from_recipes = from_side.recipes[item]
+        to_recipes = to_side.recipes[item]
+        if len(from_recipes) == 1 and len(to_recipes) == 1:
+            from_pv = from_recipes[0][1]
+            to_pv = to_recipes[0][1]
+            if from_pv and to_pv and from_pv != to_pv:
+                from_ver = LooseVersion(from_pv)
+                to_ver = LooseVersion(to_pv)
+                if to_ver > from_ver:
+                    changes.append((item, 'U', from_pv, to_pv))
+                elif from_ver > to_ver:
+                    changes.append((item, 'D', from_pv, to_pv))
+            else:
+                candidates.append(item)
+        else:
+            changes.append((item, 'V', ', '.join([r[1] for r in from_recipes]), ', '.join([r[1] for r in to_recipes])))
+
+    modified = set()
+    # If both recipes have content fingerprints we don't need to look
+    # at the patches and sources
+    unfingerprinted = []
+    for item in candidates:
+        from_fingerprint = from_side.recipes[item][0][3]
+        to_fingerprint = to_side.recipes[item][0][3]
+        if from_fingerprint and to_fingerprint:
+            if from_fingerprint != to_fingerprint:
+                modified.add(item)
+        else:
+            unfingerprinted.append(item)
+    if unfingerprinted:
+        recipe_ids = []
+        for item in unfingerprinted:
+            recipe_ids.append(from_side.recipes[item][0][0])
+            recipe_ids.append(to_side.recipes[item][0][0])
+        patches = _load_patches(recipe_ids)
+        sources = _load_sources(recipe_ids)
+        for item in unfingerprinted:
+            if _is_modified(from_side.recipes[item][0], to_side.recipes[item][0], patches, sources):
+                modified.add(item)
+    modifications = [(item, 'M', '', '') for item in candidates if item in modified]
+
+    return changes, modifications
+
+
+def write_differences(vercmp, from_layerbranch, to_layerbranch, changes):
+    """
+    Write the specified (pn, change_type, oldvalue, newvalue) tuples out
+    as VersionComparisonDifference records with bulk INSERTs
+    """
+    from layerindex.models import truncate_charfield_values
+    from dissector.models import VersionComparisonDifference
+    diffs = []
+    for pn, change_type, oldvalue, newvalue in changes:
+        diff = VersionComparisonDifference()
+        diff.comparison = vercmp
+        diff.pn = pn
+        diff.from_layerbranch = from_layerbranch
+        diff.to_layerbranch = to_layerbranch
+        diff.change_type = change_type
+        diff.oldvalue = oldvalue
+        diff.newvalue = newvalue
+        # bulk_create() doesn't send pre_save, so do this ourselves
+        truncate_charfield_values(VersionComparisonDifference, diff)
+        diffs.append(diff)
+    VersionComparisonDifference.objects.bulk_create(diffs, batch_size=QUERY_BATCH_SIZE)
+
+
+def get_comparison_sides(vercmp):
+    from_branch = vercmp.from_branch
+    to_branch = vercmp.to_branch
+    from_image = from_branch.is_image_comparison()
+    to_image = to_branch.is_image_comparison()
+    from_side = ComparisonSide(from_branch, from_branch.layerbranch_set.first(), from_image and not to_image)
+    to_side = ComparisonSide(to_branch, to_branch.layerbranch_set.first(), to_image and not from_image)
+    return from_side, to_side
+
+
+def generate_version_comparison(vercmp):
+    """
+    Compute the differences between the two branches of a
+    VersionComparison and store them. Must be called within a
+    transaction.
+    """
+    vercmp.generated = datetime.now()
+    from_side, to_side = get_comparison_sides(vercmp)
+    vercmp.from_fingerprint = from_side.fingerprint
+    vercmp.to_fingerprint = to_side.fingerprint
+    from_pns = from_side.keys()
+    to_pns = to_side.keys()
+
+    added = sorted([item for item in to_pns - from_pns if item], key=lambda s: s.lower())
+    removed = sorted([item for item in from_pns - to_pns if item], key=lambda s: s.lower())
+    changes, modifications = compare_items(from_side, to_side, from_pns & to_pns)
+
+    # Keep the same order as before: additions, version changes,
+    # modifications, then removals
+    results = [(item, 'A', '', '') for item in added]
+    results.extend(changes)
+    results.extend(modifications)
+    results.extend([(item, 'R', '', '') for item in removed])
+    write_differences(vercmp, from_side.layerbranch, to_side.layerbranch, results)
+
+
+def get_updated_pns(vercmp, since):
+    """
+    Get the names of recipes on either side of a comparison that have
+    had their metadata updated by an import since the specified time
+    """
+    from django.db.models import Q
+    from layerindex.models import ComparisonRecipeUpdate
+    layerbranches = []
+    for branch in [vercmp.from_branch, vercmp.to_branch]:
+        # Image comparison branches aren't re-imported, and the names
+        # used for them against a distro come from the distro side anyway
+        if not branch.is_image_comparison():
+            layerbranches.append(branch.layerbranch_set.first())
+    if not layerbranches:
+        return set()
+    qs = ComparisonRecipeUpdate.objects.filter(recipe__layerbranch__in=layerbranches, meta_updated=True)
+    qs = qs.filter(Q(update__finished__isnull=True) | Q(update__finished__gt=since))
+    return set(qs.values_list('recipe__pn', flat=True))
+
+
+def update_version_comparison(vercmp):
+    """
+    Bring the stored differences for a VersionComparison up-to-date
+    after one or both of its branches have been re-imported, recomputing
+    only the recipes that have changed. Must be called within a
+    transaction.
+    """
+    from dissector.models import VersionComparisonDifference
+    since = vercmp.generated
+    vercmp.generated = datetime.now()
+    from_side, to_side = get_comparison_sides(vercmp)
+    fingerprints = (from_side.fingerprint, to_side.fingerprint)
+    if all(fingerprints) and fingerprints == (vercmp.from_fingerprint, vercmp.to_fingerprint):
+        # Neither side's content has changed
+        return
+    vercmp.from_fingerprint, vercmp.to_fingerprint = fingerprints
+    from_pns = from_side.keys()
+    to_pns = to_side.keys()
+    added = set([item for item in to_pns - from_pns if item])
+    removed = set([item for item in from_pns - to_pns if item])
+    common = from_pns & to_pns
+
+    stored = {}
+    for diff_id, pn, change_type in vercmp.versioncomparisondifference_set.values_list('id', 'pn', 'change_type'):
+        stored.setdefault(change_type, {})[pn] = diff_id
+    stored_added = stored.get('A', {})
+    stored_removed = stored.get('R', {})
+
+    # Recipes only recorded as deleted (not in ComparisonRecipeUpdate) show
+    # up as a change in which names are present. Stored multiple-version
+    # entries are always recomputed since one of the versions may have gone.
+    recompute = get_updated_pns(vercmp, since)
+    recompute.update(stored_added.keys())
+    recompute.update(stored_removed.keys())
+    recompute.update(stored.get('V', {}).keys())
+    recompute &= common
+
+    delete_ids = []
+    for pn, diff_id in stored_added.items():
+        if pn not in added:
+            delete_ids.append(diff_id)
+    for pn, diff_id in stored_removed.items():
+        if pn not in removed:
+            delete_ids.append(diff_id)
+    for change_type in 'UDVM':
+        for pn, diff_id in stored.get(change_type, {}).items():
+            if pn in recompute or pn not in common:
+                delete_ids.append(diff_id)
+    for batch in _chunks(delete_ids, QUERY_BATCH_SIZE):
+        # Not a bulk delete, so that any generated file diffs get cleaned up
+        VersionComparisonDifference.objects.filter(id__in=batch).delete()
+
+    changes, modifications = compare_items(from_side, to_side, recompute)
+    results = [(item, 'A', '', '') for item in added if item not in stored_added]
+    results.extend(changes)
+    results.extend(modifications)
+    results.extend([(item, 'R', '', '') for item in removed if item not in stored_removed])
+    write_differences(vercmp, from_side.layerbranch, to_side.layerbranch, results)
+
+
+def get_timeline_fingerprint(branches):
+    """
+    Get a fingerprint for the content of a series of branches, so that we
+    can tell if a stored timeline is out of date
+    """
+    import hashlib
+    shash = hashlib.sha256()
+    for branch in branches:
+        layerbranch = branch.layerbranch_set.first()
+        if layerbranch:
+            # Fall back to the last import time if the branch predates fingerprints
+            value = layerbranch.fingerprint or str(layerbranch.vcs_last_fetch)
+        else:
+            value = ''
+        shash.update(('%s %s\n' % (branch.id, value)).encode('utf-8'))
+    return shash.hexdigest()
+
+
+def generate_version_timeline(timeline):
+    """
+    Compute the version matrix for a VersionTimeline in a single pass
+    over the recipes of each release, and store it. Only the releases in
+    which a package's version changes are stored, as
+    {"packages": {pn: [[release index, version or null], ...]}}
+    where a null version means the package is not present.
+    """
+    import json
+    from layerindex.models import ClassicRecipe
+    branches = timeline.ordered_branches()
+    timeline.generated = datetime.now()
+    timeline.fingerprint = get_timeline_fingerprint(branches)
+    packages = {}
+    current = {}
+    for index, branch in enumerate(branches):
+        versions = {}
+        qs = ClassicRecipe.objects.filter(layerbranch__in=branch.layerbranch_set.all()[:1], deleted=False)
+        for pn, pv in qs.order_by('id').values_list('pn', 'pv'):
+            if pn:
+                versions.setdefault(pn, []).append(pv)
+        for pn, pvs in versions.items():
+            version = ', '.join(pvs)
+            if current.get(pn, None) != version:
+                packages.setdefault(pn, []).append([index, version])
+        for pn in set(current.keys()) - set(versions.keys()):
+            packages[pn].append([index, None])
+        current = dict([(pn, ', '.join(pvs)) for pn, pvs in versions.items()])
+    timeline.data = json.dumps({'packages': packages}, separators=(',', ':'))
+
+
+def generate_file_diff(fdiff):
+    """
+    Generate the diff of the package sources for a
+    VersionComparisonFileDiff, or pick it up from the diff cache if the
+    same diff has already been generated
+    """
+    import os
+    import settings
+    from dissector import diff
+    from_path, to_path = fdiff.difference.get_comparison_paths()
+    if not from_path:
+        raise Exception('Unable to generate diff: invalid from path')
+    if not to_path:
+        raise Exception('Unable to generate diff: invalid to path')
+    srcdir = getattr(settings, 'VERSION_COMPARE_SOURCE_DIR')
+    dirdiff = diff.DirectoryDiff(from_path, to_path,
+                                 from_label=os.path.relpath(from_path, srcdir),
+                                 to_label=os.path.relpath(to_path, srcdir),
+                                 max_file_size=getattr(settings, 'VERSION_COMPARE_DIFF_MAX_FILE_SIZE', 0),
+                                 max_size=getattr(settings, 'VERSION_COMPARE_DIFF_MAX_SIZE', 0))
+    # The same diff is often needed by more than one comparison, so
+    # share it if someone has already generated it
+    cache = fdiff.get_cache()
+    cache_key = cache.get_key(from_path, to_path, dirdiff)
+    if not cache.lookup(cache_key):
+        cache.store(cache_key, dirdiff)
+    fdiff.cache_key = cache_key
+    # Record the size of the diff so that the comparison can be sorted by it
+    set_difference_stats(fdiff.difference, cache.get_index(cache_key))
+
+
+def set_difference_stats(difference, index):
+    """
+    Store the number of files changed and lines added / removed from a
+    diff index on a VersionComparisonDifference
+    """
+    difference.files_changed = len(index['files'])
+    difference.lines_added = sum(entry['added'] for entry in index['files'])
+    difference.lines_removed = sum(entry['removed'] for entry in index['files'])
+    difference.save(update_fields=['files_changed', 'lines_added', 'lines_removed'])
+
+
+def get_pregenerate_differences(vercmp):
+    """
+    Returns the ids of the differences in a version comparison whose
+    diffs can be generated ahead of anyone asking for them (i.e. those
+    that have package sources available and no diff yet)
+    """
+    qs = vercmp.versioncomparisondifference_set.filter(change_type__in=['U', 'D', 'M'], versioncomparisonfilediff__isnull=True)
+    qs = qs.select_related('comparison__from_branch', 'comparison__to_branch', 'from_layerbranch', 'to_layerbranch')
+    return [difference.id for difference in qs.order_by('id') if difference.package_sources_available()]
@@ -4,7 +4,9 @@
 #
 # Licensed under the MIT license, see COPYING.MIT for details
 
+import json
 import os
+import re
 import sys
 from datetime import datetime
 from itertools import islice
@@ -19,16 +21,18 @@ from django.contrib.auth.models import Permission, User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.sites.models import Site
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.core.urlresolvers import resolve, reverse, reverse_lazy
 from django.db import transaction
-from django.db.models import Count, Q
+from django.db.models import Count, F, Q
 from django.db.models.functions import Lower
 from django.db.models.query import QuerySet
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_list_or_404, get_object_or_404, render
 from django.template.loader import get_template
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.utils.html import escape
 from django.views.decorators.cache import never_cache
@@ -41,12 +45,13 @@ from pkg_resources import parse_version
 import settings
 from dissector.forms import (ImageComparisonCreateForm,
                               ImageComparisonRecipeForm,
-                              VersionComparisonForm, ComparisonImportForm)
+                              VersionComparisonForm, VersionTimelineForm,
+                              ComparisonImportForm)
 from dissector.models import (ImageComparison, ImageComparisonRecipe,
                                VersionComparison, VersionComparisonDifference,
-                               VersionComparisonFileDiff)
-from layerindex.models import (Branch, LayerItem, LayerBranch, ClassicRecipe,
-                              Source, Patch)
+                               VersionComparisonFileDiff, VersionTimeline,
+                               VersionTimelineBranch)
+from layerindex.models import Branch, Update
 from layerindex.views import (ClassicRecipeSearchView, ClassicRecipeDetailView,
                               ClassicRecipeLinkWrapper)
 
@@ -67,13 +72,7 @@ class ImageCompareView(FormView):
         return kwargs
 
     def form_valid(self, form):
-        import tarfile
-        import tempfile
-        import shutil
-        import codecs
-        import json
-        import recipeparse
-        from collections import OrderedDict
+        from celery import uuid
         if not self.request.user.is_authenticated():
             raise PermissionDenied
 
@@ -81,159 +80,30 @@ class ImageCompareView(FormView):
         if not patchdir:
             raise Exception('IMAGE_COMPARE_PATCH_DIR not set')
 
-        jsdata = []
-        tmpoutdir = tempfile.mkdtemp(prefix='layerindex-')
+        task_id = uuid()
+        # Save the upload somewhere the task can get to it; the task will
+        # delete it when it's done
         try:
-            def file_cb(fn, tarinfo):
-                if fn == 'data.json':
-                    with tar.extractfile(tarinfo) as f:
-                        tstream = codecs.getreader("utf-8")(f)
-                        jsd = json.load(tstream, object_pairs_hook=OrderedDict)
-                        jsdata.append(jsd)
-
-            with tarfile.open(None, "r:gz", self.request.FILES['file']) as tar:
-                if not utils.check_tar_contents(tar, file_cb):
-                    return HttpResponse('Invalid image comparison tarball')
-                tar.extractall(tmpoutdir)
-
-            # FIXME recipe file links may not work because versions may not match up (might have built an older version)
-
-            comparison = None
-            if jsdata:
-                jsdata = jsdata[0]
-                with transaction.atomic():
-                    branch = Branch()
-                    origname = form.cleaned_data['name'].replace(' ', '_')
-                    name = origname
-                    i = 1
-                    while Branch.objects.filter(name=name).exists():
-                        i += 1
-                        name = '%s_%d' % (origname, i)
-                    branch.name = name
-                    branch.bitbake_branch = 'N/A'
-                    branch.short_description = 'Image comparison %s' % form.cleaned_data['name']
-                    if i > 1:
-                        branch.short_description += ' (%d)' % i
-                    branch.updates_enabled = False
-                    branch.comparison = True
-                    branch.hidden = True
-                    branch.save()
-
-                    # Have a function to create layers on the fly so that we don't create any we don't need to
-                    layerbranches = {}
-                    def get_layerbranch(layername, local_path):
-                        layerbranch = layerbranches.get(layername, None)
-                        if layerbranch:
-                            return layerbranch
-                        actualname = layername
-                        if layername == 'meta':
-                            actualname = settings.CORE_LAYER_NAME
-                        jslayer = jsdata['layers'][layername]
-                        layer, created = LayerItem.objects.get_or_create(name=actualname)
-                        if created:
-                            layer.status = 'X'
-                            layer.layer_type = 'M'
-                            layer.summary = 'N/A'
-                            layer.description = 'N/A'
-                            layer.vcs_url = jslayer['vcs_url']
-                            layer.comparison = True
-                            layer.save()
-                        layerbranch = LayerBranch()
-                        layerbranch.layer = layer
-                        layerbranch.branch = branch
-                        layerbranch.vcs_subdir = jslayer.get('vcs_subdir', '')
-                        layerbranch.actual_branch = jslayer.get('actual_branch', '')
-                        layerbranch.local_path = local_path
-                        layerbranch.save()
-                        layerbranches[layername] = layerbranch
-                        return layerbranch
-
-                    comparison = ImageComparison()
-                    comparison.user = self.request.user
-                    comparison.name = form.cleaned_data['name']
-                    comparison.from_branch = branch
-                    comparison.to_branch = form.cleaned_data['to_branch']
-                    comparison.save()
-
-                    local_path = str(comparison.id)
-
-                    # Copy patch files
-                    extdir = os.path.join(tmpoutdir, os.listdir(tmpoutdir)[0])
-                    comppatchdir = os.path.join(patchdir, local_path)
-                    os.makedirs(comppatchdir)
-                    for entry in os.listdir(extdir):
-                        # We skip out the json file by only copying directories
-                        entrypath = os.path.join(extdir, entry)
-                        if os.path.isdir(entrypath):
-                            shutil.move(entrypath, comppatchdir)
-
-                    for pn, jsrecipe in jsdata['recipes'].items():
-                        recipe = ImageComparisonRecipe()
-                        recipe.comparison = comparison
-                        recipe.layerbranch = get_layerbranch(jsrecipe['layer'], local_path)
-                        recipe.filepath = os.path.dirname(jsrecipe['filepath'])
-                        recipe.filename = os.path.basename(jsrecipe['filepath'])
-                        for key,value in jsrecipe.items():
-                            if key in ['filepath', 'layer', 'inherits', 'patches', 'source_urls', 'DEPENDS', 'PACKAGECONFIG', 'packageconfig_opts']:
-                                continue
-                            if key.startswith('EXTRA_OE'):
-                                continue
-                            keylower = key.lower()
-                            if value and hasattr(recipe, keylower):
-                                setattr(recipe, keylower, value)
-                        recipe.inherits = ' '.join(jsrecipe.get('inherits', []))
-                        for confvar in ['EXTRA_OEMESON', 'EXTRA_OECMAKE', 'EXTRA_OESCONS', 'EXTRA_OECONF']:
-                            recipe.configopts = jsrecipe.get(confvar, '')
-                            if recipe.configopts:
-                                break
-                        else:
-                            recipe.configopts = ''
-
-                        # Cover info
-                        cover_recipe = ClassicRecipe.objects.filter(layerbranch__branch=comparison.to_branch).filter(cover_layerbranch__layer__name=recipe.layerbranch.layer.name).filter(cover_pn=pn).first()
-                        if cover_recipe:
-                            recipe.cover_pn = cover_recipe.pn
-                            # FIXME cover_layerbranch needs to be handled specially
-                            recipe.cover_layerbranch = cover_recipe.layerbranch
-                            # FIXME cover_status might not match
-                            recipe.cover_status = cover_recipe.cover_status
-
-                        recipe.sha256sum = jsrecipe.get('filepath', '')
-
-                        recipe.save()
-
-                        # Take care of dependencies
-                        depends = jsrecipe.get('DEPENDS', '')
-                        packageconfig_opts = jsrecipe.get('packageconfig_opts', {})
-                        recipeparse.handle_recipe_depends(recipe, depends, packageconfig_opts)
-
-                        for jsurl in jsrecipe.get('source_urls', []):
-                            source = Source()
-                            source.recipe = recipe
-                            source.url = jsurl
-                            source.save()
-                        for jspatch in jsrecipe.get('patches', []):
-                            patch = Patch()
-                            patch.recipe = recipe
-                            patch.path = jspatch[1]
-                            # FIXME handle bbappends - this is will only work for patches in the original recipe (also fetched patches)
-                            patch.src_path = os.path.relpath(patch.path, recipe.filepath)
-                            try:
-                                patchfn = os.path.join(comppatchdir, pn, os.path.basename(patch.path))
-                                patch.read_status_from_file(patchfn)
-                                patch.sha256sum = utils.sha256_file(patchfn)
-                            except Exception as e:
-                                print('Failed to read patch status for %s: %s' % (patch.path, e))
-                            patch.save()
-
-        finally:
-            shutil.rmtree(tmpoutdir)
-
-        if comparison:
-            return HttpResponseRedirect(reverse('image_comparison_search', args=(comparison.id,)))
-        else:
-            # FIXME handle this properly
-            return HttpResponse('Invalid JSON data')
+            os.makedirs(settings.TASK_LOG_DIR)
+        except FileExistsError:
+            pass
+        tarball = os.path.join(settings.TASK_LOG_DIR, 'task_%s.tar.gz' % task_id)
+        with open(tarball, 'wb') as f:
+            for chunk in self.request.FILES['file'].chunks():
+                f.write(chunk)
+
+        # Create this here first, because inside the task we don't have all of the required info
+        update = Update(task_id=task_id)
+        update.started = datetime.now()
+        update.triggered_by = self.request.user
+        update.save()
+
+        try:
+            tasks.import_image_comparison.apply_async((tarball, self.request.user.id, form.cleaned_data['name'], form.cleaned_data['to_branch'].id), task_id=task_id)
+        except:
+            os.remove(tarball)
+            raise
+        return HttpResponseRedirect(reverse_lazy('task_status', kwargs={'task_id': task_id}))
 
     def get_context_data(self, **kwargs):
         context = super(ImageCompareView, self).get_context_data(**kwargs)
@@ -411,12 +281,94 @@ class VersionCompareSelectView(FormView):
         return HttpResponseRedirect(reverse_lazy('version_comparison', args=(form.cleaned_data['from_branch'].name, form.cleaned_data['to_branch'].name)))
 
 
+def wait_for_task(request, obj, key):
+    """
+    If the client asked to wait (long polling) and the task for obj is still
+    in progress, block until the task notifies us that it has finished or
+    TASK_LONG_POLL_TIMEOUT expires, then refresh obj from the database.
+    Returns the number of seconds the client should wait before polling
+    again (non-zero if too many requests are already waiting).
+    """
+    if obj.status != 'I' or not request.GET.get('wait', ''):
+        return 0
+    paths = [utils.get_notify_path(settings.TASK_LOG_DIR, key)]
+    # Take the snapshot before re-reading the status so that we can't miss a
+    # notification that arrives in between
+    state = utils.file_state(paths)
+    obj.refresh_from_db()
+    if obj.status == 'I':
+        changed = utils.wait_for_change(paths, getattr(settings, 'TASK_LONG_POLL_TIMEOUT', 10), state,
+                                        max_waiters=getattr(settings, 'TASK_LONG_POLL_MAX_WAITERS', 0))
+        if changed is None:
+            return getattr(settings, 'TASK_LONG_POLL_BUSY_DELAY', 3)
+        obj.refresh_from_db()
+    return 0
+
+
 class VersionCompareContentView(TemplateView):
+    paginate_by = 100
+
     def render_to_response(self, context, **response_kwargs):
-        response = super(VersionCompareContentView, self).render_to_response(context, **response_kwargs)
+        if self.request.GET.get('format', '') == 'json':
+            response = JsonResponse(self.get_json_data(context))
+        else:
+            response = super(VersionCompareContentView, self).render_to_response(context, **response_kwargs)
         response['X-Status'] = context['comparison'].status
+        if context.get('poll_delay', 0):
+            response['X-Poll-Delay'] = context['poll_delay']
         return response
 
+    def get_json_data(self, context):
+        data = {'status': context['comparison'].status}
+        page = context.get('page_obj', None)
+        if page:
+            data['count'] = page.paginator.count
+            data['page'] = page.number
+            data['num_pages'] = page.paginator.num_pages
+            data['counts'] = context['change_type_counts']
+            data['size_count'] = context['size_count']
+            data['results'] = [{'id': diff.id,
+                                'pn': diff.pn,
+                                'change_type': diff.change_type,
+                                'oldvalue': diff.oldvalue,
+                                'newvalue': diff.newvalue,
+                                'files_changed': diff.files_changed,
+                                'lines_added': diff.lines_added,
+                                'lines_removed': diff.lines_removed,
+                                'description': str(diff),
+                                'url': reverse('version_comparison_recipe', args=(diff.id,)) if diff.change_type != 'V' else None}
+                               for diff in page.object_list]
+        return data
+
+    def get_page(self, vercmp, size_available):
+        change_types = [change_type for change_type in self.request.GET.get('change_type', '').split(',') if change_type]
+        query = self.request.GET.get('q', '').strip()
+        try:
+            min_lines = int(self.request.GET.get('min_lines', '') or 0)
+        except ValueError:
+            min_lines = 0
+        qs = vercmp.get_differences()
+        if change_types:
+            qs = qs.filter(change_type__in=change_types)
+        if query:
+            qs = qs.filter(pn__icontains=query)
+        # The size of a change is only known once its diff has been
+        # generated, so until then filtering or sorting by it is meaningless
+        if size_available and (min_lines or self.request.GET.get('sort', '') == 'size'):
+            qs = qs.annotate(lines_changed=F('lines_added') + F('lines_removed'))
+            if min_lines:
+                qs = qs.filter(lines_changed__gte=min_lines)
+            if self.request.GET.get('sort', '') == 'size':
+                # Biggest changes first, those without a diff yet at the end
+                qs = qs.order_by(F('lines_changed').desc(nulls_last=True), Lower('pn'), 'id')
+        paginator = Paginator(qs, self.paginate_by)
+        try:
+            return paginator.page(self.request.GET.get('page', 1))
+        except PageNotAnInteger:
+            return paginator.page(1)
+        except EmptyPage:
+            return paginator.page(paginator.num_pages)
+
     def get_context_data(self, **kwargs):
         context = super(VersionCompareContentView, self).get_context_data(**kwargs)
         from_branch = get_object_or_404(Branch, name=self.kwargs['from'])
@@ -429,16 +381,45 @@ class VersionCompareContentView(TemplateView):
             if not to_branch.imagecomparison_from_set.filter(user=self.request.user).exists():
                 raise PermissionDenied
         vercmp, created = VersionComparison.objects.get_or_create(from_branch=from_branch, to_branch=to_branch)
-        if created or vercmp.status == 'F':
+        # Claim the work by changing the status only if nobody else has
+        # in the meantime, so that concurrent requests don't queue it twice
+        task = None
+        if created:
+            task = tasks.generate_version_comparison
+        elif vercmp.status == 'F':
+            if VersionComparison.objects.filter(id=vercmp.id, status='F').update(status='I'):
+                task = tasks.generate_version_comparison
+            else:
+                vercmp.refresh_from_db()
+        elif vercmp.needs_update():
+            # One of the branches has been re-imported, so just update
+            # the differences for the recipes that have changed
+            if VersionComparison.objects.filter(id=vercmp.id, status='S').update(status='I'):
+                task = tasks.update_version_comparison
+            else:
+                vercmp.refresh_from_db()
+        if task:
             vercmp.status = 'I'
-            vercmp.save()
             try:
-                tasks.generate_version_comparison.apply_async((vercmp.id,))
+                task.apply_async((vercmp.id,))
             except:
                 vercmp.status = 'F'
                 vercmp.save()
                 raise
+        context['poll_delay'] = wait_for_task(self.request, vercmp, 'versioncomparison_%s' % vercmp.id)
         context['comparison'] = vercmp
+        if vercmp.status == 'S':
+            size_count = vercmp.versioncomparisondifference_set.filter(files_changed__isnull=False).count()
+            context['page_obj'] = self.get_page(vercmp, size_count > 0)
+            counts = dict(vercmp.versioncomparisondifference_set.order_by().values_list('change_type').annotate(Count('id')))
+            context['change_type_counts'] = counts
+            context['change_type_total'] = sum(counts.values())
+            context['size_count'] = size_count
+            context['change_type_choices'] = [(value, label, counts[value]) for value, label in VersionComparisonDifference.CHANGE_TYPE_CHOICES if value in counts]
+            context['change_type'] = self.request.GET.get('change_type', '')
+            context['search_keyword'] = self.request.GET.get('q', '')
+            context['sort'] = self.request.GET.get('sort', '')
+            context['min_lines'] = self.request.GET.get('min_lines', '')
         return context
 
 class VersionCompareView(TemplateView):
@@ -480,20 +461,25 @@ class VersionCompareRecipeDetailView(TemplateView):
         context['package_sources_available'] = diff.package_sources_available()
         return context
 
+def generate_file_diff(fdiff):
+    fdiff.status = 'I'
+    fdiff.save()
+    try:
+        tasks.generate_diff.apply_async((fdiff.id,))
+    except:
+        fdiff.status = 'F'
+        fdiff.save()
+        raise
+
 class VersionCompareFileDiffView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super(VersionCompareFileDiffView, self).get_context_data(**kwargs)
         diff = get_object_or_404(VersionComparisonDifference, pk=kwargs['id'])
+        # (if the diff is being pre-generated at the same time, this picks
+        # up that record rather than creating a second one)
         fdiff, created = VersionComparisonFileDiff.objects.get_or_create(difference=diff)
         if created or fdiff.status == 'F':
-            fdiff.status = 'I'
-            fdiff.save()
-            try:
-                tasks.generate_diff.apply_async((fdiff.id,))
-            except:
-                fdiff.status = 'F'
-                fdiff.save()
-                raise
+            generate_file_diff(fdiff)
         context['fdiff'] = fdiff
         return context
 
@@ -503,25 +489,75 @@ def version_compare_diff_view(request, diff_id):
         raise PermissionDenied
 
     fdiff = get_object_or_404(VersionComparisonFileDiff, pk=diff_id)
+    if fdiff.status == 'S' and fdiff.cache_key and not fdiff.get_cache().lookup(fdiff.cache_key):
+        # Evicted from the cache since it was generated
+        generate_file_diff(fdiff)
+    poll_delay = wait_for_task(request, fdiff, 'filediff_%s' % fdiff.id)
     if fdiff.status == 'S':
         actual_file = fdiff.get_diff_path()
         if not os.path.exists(actual_file):
             raise Http404;
 
-        if getattr(settings, 'FILE_SERVE_METHOD', 'direct') == 'nginx':
+        compressed = actual_file.endswith('.gz')
+        if 'index' in request.GET or 'file' in request.GET:
+            # Return the list of files in the diff, or the diff for just one
+            # of them, so that the page doesn't have to load the whole thing
+            index_file = fdiff.get_index_path()
+            if not index_file or not os.path.exists(index_file):
+                raise Http404
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            if 'index' in request.GET:
+                response = JsonResponse(index)
+            else:
+                try:
+                    fileidx = int(request.GET['file'])
+                except ValueError:
+                    raise Http404
+                if fileidx < 0 or fileidx >= len(index['files']):
+                    raise Http404
+                entry = index['files'][fileidx]
+                with open(actual_file, 'rb') as f:
+                    f.seek(entry['offset'])
+                    data = f.read(entry['length'])
+                if not index['compressed']:
+                    response = HttpResponse(data, content_type='text/plain')
+                elif re.search(r'\bgzip\b', request.META.get('HTTP_ACCEPT_ENCODING', '')):
+                    # Each file is a separate gzip member, so it can be sent as-is
+                    response = HttpResponse(data, content_type='text/plain')
+                    response['Content-Encoding'] = 'gzip'
+                else:
+                    import gzip
+                    response = HttpResponse(gzip.decompress(data), content_type='text/plain')
+                if index['compressed']:
+                    patch_vary_headers(response, ('Accept-Encoding',))
+        elif getattr(settings, 'FILE_SERVE_METHOD', 'direct') == 'nginx':
             from django.utils.encoding import smart_str
             response = HttpResponse(content_type='text/plain')
             redirect_path = fdiff.get_redirect_path()
             response['X-Accel-Redirect'] = smart_str(redirect_path)
-            response['Content-Length'] = os.path.getsize(actual_file)
+            if not compressed:
+                response['Content-Length'] = os.path.getsize(actual_file)
         else:
             from django.http import FileResponse
-            response = FileResponse(open(actual_file, 'rb'), content_type='text/plain')
+            if not compressed:
+                response = FileResponse(open(actual_file, 'rb'), content_type='text/plain')
+            elif re.search(r'\bgzip\b', request.META.get('HTTP_ACCEPT_ENCODING', '')):
+                # Send it as-is and let the client decompress it
+                response = FileResponse(open(actual_file, 'rb'), content_type='text/plain')
+                response['Content-Encoding'] = 'gzip'
+            else:
+                import gzip
+                response = FileResponse(gzip.open(actual_file, 'rb'), content_type='text/plain')
+            if compressed:
+                patch_vary_headers(response, ('Accept-Encoding',))
     elif fdiff.status == 'I':
         response = HttpResponse('loading')
     else:
         response = HttpResponse('failed')
     response['X-Status'] = fdiff.status
+    if poll_delay:
+        response['X-Poll-Delay'] = poll_delay
     return response
 
 
@@ -534,6 +570,104 @@ def version_compare_regenerate_view(request, from_branch, to_branch):
     return HttpResponseRedirect(reverse_lazy('version_comparison', kwargs={'from': from_branch, 'to': to_branch}))
 
 
+def generate_timeline(timeline):
+    timeline.status = 'I'
+    timeline.save()
+    try:
+        tasks.generate_version_timeline.apply_async((timeline.id,))
+    except:
+        timeline.status = 'F'
+        timeline.save()
+        raise
+
+
+class VersionTimelineSelectView(FormView):
+    form_class = VersionTimelineForm
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(VersionTimelineSelectView, self).dispatch(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        kwargs = super(VersionTimelineSelectView, self).get_form_kwargs()
+        kwargs.update(request=self.request)
+        return kwargs
+
+    def form_valid(self, form):
+        branches = list(form.cleaned_data['branches'])
+        with transaction.atomic():
+            timeline, created = VersionTimeline.objects.get_or_create(branch_key=VersionTimeline.get_branch_key(branches))
+            if created:
+                for i, branch in enumerate(branches):
+                    VersionTimelineBranch.objects.create(timeline=timeline, branch=branch, order=i)
+        if created:
+            generate_timeline(timeline)
+        return HttpResponseRedirect(reverse_lazy('version_timeline', args=(timeline.id,)))
+
+
+class VersionTimelineView(DetailView):
+    model = VersionTimeline
+    context_object_name = 'timeline'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(VersionTimelineView, self).dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(VersionTimelineView, self).get_context_data(**kwargs)
+        timeline = context['timeline']
+        # Only retry a failed timeline when the page is (re)loaded, rather
+        # than on every poll of the content view
+        if timeline.status == 'F':
+            generate_timeline(timeline)
+        return context
+
+
+class VersionTimelineContentView(DetailView):
+    model = VersionTimeline
+    context_object_name = 'timeline'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(VersionTimelineContentView, self).dispatch(request, *args, **kwargs)
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super(VersionTimelineContentView, self).render_to_response(context, **response_kwargs)
+        response['X-Status'] = context['timeline'].status
+        if context.get('poll_delay', 0):
+            response['X-Poll-Delay'] = context['poll_delay']
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super(VersionTimelineContentView, self).get_context_data(**kwargs)
+        timeline = context['timeline']
+        if timeline.needs_update():
+            # Regenerating is cheap enough that we don't need to do it incrementally
+            generate_timeline(timeline)
+        context['poll_delay'] = wait_for_task(self.request, timeline, 'versiontimeline_%s' % timeline.id)
+        if timeline.status == 'S':
+            context['summary'] = timeline.release_summary()
+        return context
+
+
+class VersionTimelinePackageView(DetailView):
+    model = VersionTimeline
+    context_object_name = 'timeline'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        return super(VersionTimelinePackageView, self).dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(VersionTimelinePackageView, self).get_context_data(**kwargs)
+        history = context['timeline'].package_history(self.kwargs['pn'])
+        if not any([version is not None for _, version, _ in history]):
+            raise Http404
+        context['pn'] = self.kwargs['pn']
+        context['history'] = history
+        return context
+
+
 class ComparisonImportView(FormView):
     form_class = ComparisonImportForm
 
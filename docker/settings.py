@@ -288,6 +288,22 @@ AXES_COOLOFF_TIME = 1
 # Full path to directory to store logs for dynamically executed tasks
 TASK_LOG_DIR = "/opt/layerindex-task-logs"
 
+# Maximum time in seconds that a request for task status will be held open
+# waiting for something to change (long polling). Note that this needs to
+# be less than the web server's worker timeout.
+TASK_LONG_POLL_TIMEOUT = 10
+
+# Each request held open for long polling ties up a web server thread, so
+# this limits how many can be waiting at once in each web server process,
+# leaving the rest of the threads free for other requests. The default
+# suits the container setup (gunicorn with 4 processes of 8 threads each,
+# i.e. up to 16 waiting requests and at least 16 threads for everything
+# else) - if you change the number of threads, adjust this to match. Once
+# the limit is reached, clients are told to wait TASK_LONG_POLL_BUSY_DELAY
+# seconds before asking again instead. 0 means no limit.
+TASK_LONG_POLL_MAX_WAITERS = 4
+TASK_LONG_POLL_BUSY_DELAY = 3
+
 # Full path to directory where rrs tools stores logs
 TOOLS_LOG_DIR = ""
 
@@ -307,6 +323,25 @@ DISSECTOR_BINDIR = "/opt/dissector"
 # Path to package sources for other distros (used when doing release comparisons)
 VERSION_COMPARE_SOURCE_DIR = "/opt/sources"
 
+# Limits for generated package source diffs (in bytes, 0 for no limit).
+# Files larger than the per-file limit are skipped in the same way as binary
+# files; once the total limit is reached no further files are added.
+VERSION_COMPARE_DIFF_MAX_FILE_SIZE = 1024 * 1024
+VERSION_COMPARE_DIFF_MAX_SIZE = 10 * 1024 * 1024
+
+# Maximum total size of the cache of generated diffs (shared between
+# comparisons) before the least recently used ones are evicted (0 for no limit)
+VERSION_COMPARE_DIFF_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Generate the diffs for a version comparison in the background as soon as
+# the comparison has been generated, rather than when someone asks for them.
+# The diffs are split between VERSION_COMPARE_PREGENERATE_CONCURRENCY tasks
+# on the VERSION_COMPARE_PREGENERATE_QUEUE Celery queue (which a worker
+# needs to be consuming, e.g. "celery worker -Q celery,diffs ...")
+VERSION_COMPARE_PREGENERATE_DIFFS = False
+VERSION_COMPARE_PREGENERATE_CONCURRENCY = 2
+VERSION_COMPARE_PREGENERATE_QUEUE = 'diffs'
+
 # Path and URL prefix for handling patches imported with image comparison data
 IMAGE_COMPARE_PATCH_DIR = "/opt/imagecompare-patches"
 IMAGE_COMPARE_PATCH_URL_PREFIX = "/layerindex/imagecompare/patch/"
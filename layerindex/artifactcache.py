@@ -0,0 +1,236 @@
+# Cached fetching of downloaded artifacts
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# Downloads are stored in a local cache named by the SHA-256 checksum of
+# their content, with a record per URL of which content it last gave us
+# along with the ETag / Last-Modified values the server sent. Fetching a
+# URL again is then either free (if we know the checksum we want and have
+# it) or a conditional request that transfers nothing if the content
+# hasn't changed. Interrupted downloads are resumed with a range request.
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import http.client
+import socket
+import urllib.error
+import urllib.request
+
+
+FETCH_TIMEOUT = 60
+FETCH_RETRIES = 3
+COPY_BUFSIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    pass
+
+
+def _sha256_file(path):
+    shash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(COPY_BUFSIZE)
+            if not data:
+                break
+            shash.update(data)
+    return shash.hexdigest()
+
+
+def _write_json(path, data):
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmpname, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class ArtifactCache():
+    """
+    Content-addressed cache of files fetched from URLs
+    """
+    def __init__(self, cachedir, logger=None, retries=FETCH_RETRIES, retry_delay=1):
+        self.cachedir = cachedir
+        self.logger = logger
+        self.retries = retries
+        self.retry_delay = retry_delay
+        for subdir in ['objects', 'urls', 'partial']:
+            os.makedirs(os.path.join(cachedir, subdir), exist_ok=True)
+
+    def _debug(self, msg):
+        if self.logger:
+            self.logger.debug(msg)
+
+    def get_object_path(self, sha256sum):
+        return os.path.join(self.cachedir, 'objects', sha256sum[:2], sha256sum)
+
+    def _get_url_key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _get_record_path(self, url):
+        return os.path.join(self.cachedir, 'urls', self._get_url_key(url) + '.json')
+
+    def _get_partial_path(self, url):
+        return os.path.join(self.cachedir, 'partial', self._get_url_key(url))
+
+    def _check_object(self, sha256sum):
+        # Returns the path to the object if we have it and it's intact
+        objpath = self.get_object_path(sha256sum)
+        if not os.path.exists(objpath):
+            return None
+        if _sha256_file(objpath) != sha256sum:
+            self._debug('Removing corrupted cache object %s' % objpath)
+            os.remove(objpath)
+            return None
+        os.utime(objpath)
+        return objpath
+
+    def lookup(self, url, sha256sum=None):
+        """
+        Get the path to the cached content for a URL without touching the
+        network, or None if there isn't any (or it doesn't have the
+        specified checksum)
+        """
+        if not sha256sum:
+            record = _read_json(self._get_record_path(url))
+            if not record:
+                return None
+            sha256sum = record['sha256sum']
+        return self._check_object(sha256sum)
+
+    def fetch(self, url, sha256sum=None, progress=None):
+        """
+        Fetch a URL (if needed) and return the path to its content in the
+        cache. If sha256sum is specified, the content must have that
+        checksum and if we already have it no request is made at all.
+        progress, if specified, is called with the number of bytes
+        downloaded so far and the total size (or 0 if unknown).
+        """
+        if sha256sum:
+            sha256sum = sha256sum.lower()
+            objpath = self._check_object(sha256sum)
+            if objpath:
+                self._debug('Using cached %s for %s' % (objpath, url))
+                return objpath
+
+        attempt = 0
+        while True:
+            try:
+                return self._fetch(url, sha256sum, progress)
+            except (urllib.error.URLError, http.client.HTTPException, socket.timeout, ConnectionError) as e:
+                if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                    raise FetchError('Failed to fetch %s: %s' % (url, str(e)))
+                attempt += 1
+                if attempt > self.retries:
+                    raise FetchError('Failed to fetch %s: %s' % (url, str(e)))
+                self._debug('Fetching %s failed (%s), retrying' % (url, str(e)))
+                time.sleep(self.retry_delay * attempt)
+
+    def _fetch(self, url, sha256sum, progress):
+        recordpath = self._get_record_path(url)
+        record = _read_json(recordpath)
+        partialpath = self._get_partial_path(url)
+        partialinfo = _read_json(partialpath + '.json')
+        offset = 0
+        if partialinfo and os.path.exists(partialpath):
+            offset = os.path.getsize(partialpath)
+
+        headers = {}
+        if offset:
+            # Resume, but only if the content is the same as what we already have part of
+            validator = partialinfo.get('etag', '')
+            if not validator or validator.startswith('W/'):
+                validator = partialinfo.get('last_modified', '')
+            if validator:
+                headers['Range'] = 'bytes=%d-' % offset
+                headers['If-Range'] = validator
+            else:
+                offset = 0
+        cached = None
+        if not offset and record and not sha256sum:
+            # (if we knew the checksum and had the content we'd never get here)
+            cached = self.lookup(url)
+            if cached:
+                if record.get('etag'):
+                    headers['If-None-Match'] = record['etag']
+                if record.get('last_modified'):
+                    headers['If-Modified-Since'] = record['last_modified']
+
+        rq = urllib.request.Request(url, headers=headers)
+        try:
+            response = urllib.request.urlopen(rq, timeout=FETCH_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and cached:
+                self._debug('%s not modified' % url)
+                return cached
+            elif e.code == 416 and offset:
+                # What we have doesn't fit with what's there now; start again
+                self._discard_partial(url)
+                return self._fetch(url, sha256sum, progress)
+            raise
+
+        with response:
+            status = getattr(response, 'status', 200)
+            etag = response.headers.get('ETag', '')
+            last_modified = response.headers.get('Last-Modified', '')
+            length = int(response.headers.get('Content-Length', '0') or '0')
+            if status == 206:
+                contentrange = response.headers.get('Content-Range', '')
+                try:
+                    start = int(contentrange.split()[1].split('-')[0])
+                except (IndexError, ValueError):
+                    start = -1
+                if start != offset:
+                    self._discard_partial(url)
+                    raise FetchError('Unexpected Content-Range "%s" from %s' % (contentrange, url))
+                self._debug('Resuming %s from %d bytes' % (url, offset))
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+            total = offset + length if length else 0
+            _write_json(partialpath + '.json', {'url': url, 'etag': etag, 'last_modified': last_modified})
+
+            downloaded = offset
+            with open(partialpath, mode) as f:
+                while True:
+                    data = response.read(COPY_BUFSIZE)
+                    if not data:
+                        break
+                    f.write(data)
+                    downloaded += len(data)
+                    if progress:
+                        progress(downloaded, total)
+            if total and downloaded < total:
+                raise http.client.IncompleteRead(b'', total - downloaded)
+
+        actual = _sha256_file(partialpath)
+        if sha256sum and actual != sha256sum:
+            self._discard_partial(url)
+            raise FetchError('Checksum mismatch for %s: expected %s, got %s' % (url, sha256sum, actual))
+        objpath = self.get_object_path(actual)
+        os.makedirs(os.path.dirname(objpath), exist_ok=True)
+        os.replace(partialpath, objpath)
+        self._discard_partial(url)
+        _write_json(recordpath, {'url': url, 'sha256sum': actual, 'etag': etag, 'last_modified': last_modified})
+        return objpath
+
+    def _discard_partial(self, url):
+        partialpath = self._get_partial_path(url)
+        for path in [partialpath, partialpath + '.json']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
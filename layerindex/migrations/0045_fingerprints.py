@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0044_dissector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='classicrecipe',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='layerbranch',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text='Fingerprint of recipe content (comparison branches only)', max_length=64),
+        ),
+    ]
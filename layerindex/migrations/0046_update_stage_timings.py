@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 22:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0045_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='update',
+            name='stage_timings',
+            field=models.TextField(blank=True, help_text='Time taken by each stage of a multi-stage import (JSON)'),
+        ),
+    ]
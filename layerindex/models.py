@@ -103,6 +103,7 @@ class Update(models.Model):
     task_id = models.CharField(max_length=50, blank=True, db_index=True)
     triggered_by = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL)
     retcode = models.IntegerField(default=0)
+    stage_timings = models.TextField(blank=True, help_text='Time taken by each stage of a multi-stage import (JSON)')
 
     def error_count(self):
         sums = self.layerupdate_set.aggregate(errors=models.Sum('errors'))
@@ -112,6 +113,16 @@ class Update(models.Model):
         sums = self.layerupdate_set.aggregate(warnings=models.Sum('warnings'))
         return (sums['warnings'] or 0) + self.log.count('WARNING:')
 
+    def get_stage_timings(self):
+        """
+        Returns a list of dicts (stage, duration, skipped, failed) for
+        each stage of the import that was reached, in order
+        """
+        import json
+        if not self.stage_timings:
+            return []
+        return json.loads(self.stage_timings)
+
     def __str__(self):
         return '%s' % self.started
 
@@ -243,6 +254,7 @@ class LayerBranch(models.Model):
     actual_branch = models.CharField('Actual Branch', max_length=80, blank=True, help_text='Name of the actual branch in the repository matching the core branch')
     yp_compatible_version = models.ForeignKey(YPCompatibleVersion, verbose_name='Yocto Project Compatible version', null=True, blank=True, on_delete=models.SET_NULL, help_text='Which version of the Yocto Project Compatible program has this layer been approved for for?')
     local_path = models.CharField(max_length=255, blank=True, help_text='Local subdirectory where layer data can be found')
+    fingerprint = models.CharField(max_length=64, blank=True, help_text='Fingerprint of recipe content (comparison branches only)')
 
     updated = models.DateTimeField(auto_now=True)
 
@@ -255,6 +267,18 @@ class LayerBranch(models.Model):
     def sorted_recipes(self):
         return self.recipe_set.order_by('pn', '-pv')
 
+    def update_fingerprint(self):
+        """
+        Recalculate the fingerprint over the fingerprints of all of the
+        recipes in this layerbranch (comparison branches only)
+        """
+        if self.branch.is_image_comparison():
+            from dissector.models import ImageComparisonRecipe
+            recipes = ImageComparisonRecipe.objects.filter(layerbranch=self)
+        else:
+            recipes = ClassicRecipe.objects.filter(layerbranch=self, deleted=False)
+        self.fingerprint = utils.layerbranch_fingerprint(recipes.values_list('pn', 'pv', 'fingerprint'))
+
     def active_maintainers(self):
         return self.layermaintainer_set.filter(status='A')
 
@@ -683,6 +707,7 @@ class ClassicRecipe(Recipe):
     deleted = models.BooleanField(default=False)
     needs_attention = models.BooleanField(default=False)
     sha256sum = models.CharField(max_length=64, blank=True)
+    fingerprint = models.CharField(max_length=64, blank=True)
 
     class Meta:
         permissions = (
@@ -690,6 +715,15 @@ class ClassicRecipe(Recipe):
             ("update_comparison_branch", "Can update comparison branches"),
         )
 
+    def update_fingerprint(self):
+        """
+        Recalculate the content fingerprint from the recipe file checksum
+        and those of its patches and sources (the recipe is not saved)
+        """
+        patches = self.patch_set.order_by('apply_order', 'id').values_list('src_path', 'applied', 'sha256sum')
+        sources = self.source_set.order_by('id').values_list('url', 'sha256sum')
+        self.fingerprint = utils.recipe_fingerprint(self.sha256sum, patches, sources)
+
     def get_cover_desc(self):
         desc = self.get_cover_status_display()
         if self.cover_layerbranch:
@@ -0,0 +1,287 @@
+# Reading of RPM package files
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# Rather than running "rpm -qpi" on each package and parsing the output,
+# we read the tags we need straight out of the package header. Only the
+# lead, the header indexes and the data for the requested tags are read,
+# so the cost doesn't depend on the size of the payload or file list.
+# Similarly, payloads are extracted here rather than through
+# "rpm2cpio | cpio".
+
+import os
+import stat
+import bisect
+import struct
+import gzip
+import bz2
+import lzma
+from collections import OrderedDict
+
+
+LEAD_SIZE = 96
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8'
+
+CPIO_NEWC_MAGIC = [b'070701', b'070702']
+CPIO_HEADER_SIZE = 110
+CPIO_TRAILER = 'TRAILER!!!'
+
+COPY_BUFSIZE = 64 * 1024
+
+# Sanity limits (as used by rpm itself)
+HEADER_MAX_INDEX = 0xffff
+HEADER_MAX_DATA = 256 * 1024 * 1024
+
+RPM_STRING_TYPE = 6
+RPM_STRING_ARRAY_TYPE = 8
+RPM_I18NSTRING_TYPE = 9
+
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_SUMMARY = 1004
+RPMTAG_DESCRIPTION = 1005
+RPMTAG_LICENSE = 1014
+RPMTAG_GROUP = 1016
+RPMTAG_URL = 1020
+RPMTAG_SOURCERPM = 1044
+
+# Tags returned by read_rpm_info(), named as in "rpm -qi" output
+INFO_TAGS = OrderedDict([
+    ('Name', RPMTAG_NAME),
+    ('Version', RPMTAG_VERSION),
+    ('Release', RPMTAG_RELEASE),
+    ('Group', RPMTAG_GROUP),
+    ('License', RPMTAG_LICENSE),
+    ('Source RPM', RPMTAG_SOURCERPM),
+    ('URL', RPMTAG_URL),
+    ('Summary', RPMTAG_SUMMARY),
+    ('Description', RPMTAG_DESCRIPTION),
+])
+
+
+class RpmFileError(Exception):
+    pass
+
+
+class UnsupportedPayloadError(RpmFileError):
+    """
+    Raised when a package payload uses a compression or archive format
+    we can't extract
+    """
+    pass
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise RpmFileError('Unexpected end of file')
+    return data
+
+
+def _read_header_index(f):
+    # Returns a dict of tag -> (type, offset, count), the file offset of
+    # the data store and its size
+    intro = _read_exact(f, 16)
+    if intro[:3] != HEADER_MAGIC:
+        raise RpmFileError('Invalid header magic')
+    nindex, hsize = struct.unpack('>II', intro[8:])
+    if nindex > HEADER_MAX_INDEX or hsize > HEADER_MAX_DATA:
+        raise RpmFileError('Header too large')
+    index = _read_exact(f, nindex * 16)
+    entries = {}
+    for i in range(nindex):
+        tag, tagtype, offset, count = struct.unpack_from('>IIII', index, i * 16)
+        entries.setdefault(tag, (tagtype, offset, count))
+    return entries, f.tell(), hsize
+
+
+def _read_main_header_index(f, path):
+    lead = _read_exact(f, LEAD_SIZE)
+    if lead[:4] != LEAD_MAGIC:
+        raise RpmFileError('%s is not an RPM package' % path)
+    # Skip the signature header, which is padded to an 8-byte boundary
+    _, store, hsize = _read_header_index(f)
+    sigend = store + hsize
+    f.seek(sigend + (8 - sigend % 8) % 8)
+    return _read_header_index(f)
+
+
+def read_rpm_header(path, tags):
+    """
+    Read the values of the specified string tags from the main header of
+    an RPM package, returning a dict of tag -> value. STRING and
+    I18NSTRING values are returned as a str (the first translation in the
+    latter case), STRING_ARRAY values as a list. Tags not present in the
+    header are omitted.
+    """
+    with open(path, 'rb') as f:
+        entries, store, hsize = _read_main_header_index(f, path)
+        # The data for a tag runs (at most) up to the start of the next one
+        offsets = sorted(set([offset for _, offset, _ in entries.values()] + [hsize]))
+        values = {}
+        for tag in tags:
+            if tag not in entries:
+                continue
+            tagtype, offset, count = entries[tag]
+            if tagtype not in [RPM_STRING_TYPE, RPM_STRING_ARRAY_TYPE, RPM_I18NSTRING_TYPE]:
+                raise RpmFileError('Tag %d has unsupported type %d' % (tag, tagtype))
+            if offset >= hsize or count < 1:
+                raise RpmFileError('Invalid header entry for tag %d' % tag)
+            end = offsets[bisect.bisect_right(offsets, offset)]
+            f.seek(store + offset)
+            strings = _read_exact(f, end - offset).split(b'\0')
+            if len(strings) <= count:
+                raise RpmFileError('Truncated data for tag %d' % tag)
+            strings = [item.decode('utf-8', errors='replace') for item in strings[:count]]
+            if tagtype == RPM_STRING_ARRAY_TYPE:
+                values[tag] = strings
+            else:
+                values[tag] = strings[0]
+    return values
+
+
+def read_rpm_info(path):
+    """
+    Read the basic information about an RPM package, returning a dict
+    with the same keys as the fields shown by "rpm -qpi". Fields whose
+    tags are not present in the header are returned as an empty string.
+    """
+    values = read_rpm_header(path, INFO_TAGS.values())
+    info = OrderedDict()
+    for name, tag in INFO_TAGS.items():
+        info[name] = values.get(tag, '')
+    return info
+
+
+def _open_payload(f):
+    # Returns a file object for reading the uncompressed payload
+    magic = f.read(6)
+    f.seek(-len(magic), os.SEEK_CUR)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    elif magic.startswith(b'BZh'):
+        return bz2.BZ2File(f)
+    elif magic.startswith(b'\xfd7zXZ\x00'):
+        return lzma.LZMAFile(f, format=lzma.FORMAT_XZ)
+    elif magic.startswith(b'\x5d\x00\x00'):
+        return lzma.LZMAFile(f, format=lzma.FORMAT_ALONE)
+    elif magic.startswith(b'\x28\xb5\x2f\xfd'):
+        try:
+            import zstandard
+        except ImportError:
+            raise UnsupportedPayloadError('zstd compressed payload (zstandard module not installed)')
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    elif magic.startswith(b'0707'):
+        return f
+    else:
+        raise UnsupportedPayloadError('Unknown payload compression')
+
+
+def _read_stream(stream, size):
+    # Decompressors may return less than requested
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise RpmFileError('Unexpected end of payload')
+        data += chunk
+    return data
+
+
+def _copy_stream(stream, size, outfile=None):
+    while size > 0:
+        chunk = stream.read(min(size, COPY_BUFSIZE))
+        if not chunk:
+            raise RpmFileError('Unexpected end of payload')
+        if outfile:
+            outfile.write(chunk)
+        size -= len(chunk)
+
+
+def _get_target_path(destdir, name):
+    relpath = os.path.normpath(name).lstrip('/')
+    if relpath == '..' or relpath.startswith('../'):
+        raise RpmFileError('Refusing to extract %s outside of destination directory' % name)
+    target = os.path.join(destdir, relpath)
+    # Guard against symlinks extracted earlier pointing elsewhere
+    realdir = os.path.realpath(os.path.dirname(target))
+    realdest = os.path.realpath(destdir)
+    if realdir != realdest and not realdir.startswith(realdest + os.sep):
+        raise RpmFileError('Refusing to extract %s outside of destination directory' % name)
+    return target
+
+
+def _remove_existing(path):
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+
+
+def extract_rpm(path, destdir):
+    """
+    Extract the payload of an RPM package into destdir (equivalent to
+    "rpm2cpio <path> | cpio -idm"), returning a list of the files
+    extracted. Raises UnsupportedPayloadError if the payload can't be
+    handled, in which case nothing will have been extracted.
+    """
+    destdir = os.path.abspath(destdir)
+    extracted = []
+    with open(path, 'rb') as f:
+        _, store, hsize = _read_main_header_index(f, path)
+        f.seek(store + hsize)
+        payload = _open_payload(f)
+        # Hard links are stored with the data on the last entry only
+        pending_links = {}
+        while True:
+            hdr = _read_stream(payload, CPIO_HEADER_SIZE)
+            if hdr[:6] not in CPIO_NEWC_MAGIC:
+                if hdr[:6] == b'07070X' and not extracted:
+                    raise UnsupportedPayloadError('Stripped cpio payload')
+                raise RpmFileError('Invalid cpio header in %s' % path)
+            try:
+                (ino, mode, _, _, nlink, mtime, filesize, devmajor, devminor, _, _, namesize, _) = \
+                    [int(hdr[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+            except ValueError:
+                raise RpmFileError('Invalid cpio header in %s' % path)
+            name = _read_stream(payload, namesize)[:-1].decode('utf-8', errors='surrogateescape')
+            _copy_stream(payload, -(CPIO_HEADER_SIZE + namesize) % 4)
+            if name == CPIO_TRAILER:
+                break
+            target = _get_target_path(destdir, name)
+            if stat.S_ISDIR(mode):
+                os.makedirs(target, exist_ok=True)
+            elif stat.S_ISREG(mode):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                linkkey = (ino, devmajor, devminor)
+                if nlink > 1 and filesize == 0:
+                    pending_links.setdefault(linkkey, []).append(target)
+                    continue
+                _remove_existing(target)
+                with open(target, 'wb') as outfile:
+                    _copy_stream(payload, filesize, outfile)
+                os.chmod(target, stat.S_IMODE(mode) & 0o777)
+                os.utime(target, (mtime, mtime))
+                extracted.append(target)
+                for linkpath in pending_links.pop(linkkey, []):
+                    _remove_existing(linkpath)
+                    os.link(target, linkpath)
+                    extracted.append(linkpath)
+            elif stat.S_ISLNK(mode):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                linktarget = _read_stream(payload, filesize).decode('utf-8', errors='surrogateescape')
+                _remove_existing(target)
+                os.symlink(linktarget, target)
+                extracted.append(target)
+            else:
+                # Device nodes etc. aren't going to be found in a source package
+                _copy_stream(payload, filesize)
+            _copy_stream(payload, -filesize % 4)
+        for linkpaths in pending_links.values():
+            for linkpath in linkpaths:
+                _remove_existing(linkpath)
+                open(linkpath, 'wb').close()
+                extracted.append(linkpath)
+    return extracted
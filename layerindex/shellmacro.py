@@ -0,0 +1,610 @@
+# Evaluation of %(...) shell macros found in RPM spec files
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# The shell commands used in spec files are nearly always simple text
+# manipulation of version strings and the like (echo piped into sed, cut,
+# awk or tr), so rather than forking a shell for every one of them we run
+# those natively and only fall back to the shell for anything else.
+
+import re
+import subprocess
+
+
+class NotNativeError(Exception):
+    """
+    Raised when a command can't be evaluated natively (and thus needs to
+    be passed to the shell)
+    """
+    pass
+
+
+# Characters that mean something to the shell that we don't emulate
+SHELL_SPECIAL = '$`;&<>()*?[]{}!\n'
+
+POSIX_CLASSES = {
+    'alnum': 'a-zA-Z0-9',
+    'alpha': 'a-zA-Z',
+    'blank': ' \\t',
+    'digit': '0-9',
+    'lower': 'a-z',
+    'punct': re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'),
+    'space': ' \\t\\n\\r\\f\\v',
+    'upper': 'A-Z',
+    'xdigit': '0-9A-Fa-f',
+}
+
+
+def split_pipeline(cmd):
+    """
+    Split a shell command line into a list of commands (each a list of
+    arguments, with quoting removed) making up a pipeline. Raises
+    NotNativeError if anything beyond simple quoting and pipes is used.
+    """
+    commands = []
+    args = []
+    word = None
+    quote = None
+    i = 0
+    while i < len(cmd):
+        ch = cmd[i]
+        if quote == "'":
+            if ch == "'":
+                quote = None
+            else:
+                word += ch
+        elif quote == '"':
+            if ch == '"':
+                quote = None
+            elif ch in '$`':
+                raise NotNativeError('Expansion within double quotes')
+            elif ch == '\\' and i + 1 < len(cmd) and cmd[i + 1] in '"\\$`':
+                i += 1
+                word += cmd[i]
+            else:
+                word += ch
+        elif ch in '\'"':
+            quote = ch
+            if word is None:
+                word = ''
+        elif ch == '\\':
+            i += 1
+            if i >= len(cmd):
+                raise NotNativeError('Trailing backslash')
+            if word is None:
+                word = ''
+            word += cmd[i]
+        elif ch in ' \t':
+            if word is not None:
+                args.append(word)
+                word = None
+        elif ch == '|':
+            if word is not None:
+                args.append(word)
+                word = None
+            if not args or cmd[i + 1:i + 2] == '|':
+                raise NotNativeError('Unsupported use of |')
+            commands.append(args)
+            args = []
+        elif ch in SHELL_SPECIAL or (ch in '~#' and word is None) or (ch == '=' and word is not None and not commands and not args):
+            # (the last being a variable assignment)
+            raise NotNativeError('Unsupported shell syntax "%s"' % ch)
+        else:
+            if word is None:
+                word = ''
+            word += ch
+        i += 1
+    if quote:
+        raise NotNativeError('Unterminated quote')
+    if word is not None:
+        args.append(word)
+    if not args:
+        raise NotNativeError('Empty command')
+    commands.append(args)
+    return commands
+
+
+def _split_lines(text):
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+
+def _convert_bracket(expr, i):
+    # Convert a POSIX bracket expression starting at expr[i] == '['
+    # to its Python equivalent, returning (converted, index after it)
+    out = '['
+    i += 1
+    if expr[i:i + 1] == '^':
+        out += '^'
+        i += 1
+    if expr[i:i + 1] == ']':
+        out += '\\]'
+        i += 1
+    while i < len(expr):
+        ch = expr[i]
+        if ch == ']':
+            return out + ']', i + 1
+        elif expr.startswith('[:', i):
+            end = expr.find(':]', i + 2)
+            if end < 0 or expr[i + 2:end] not in POSIX_CLASSES:
+                raise NotNativeError('Unsupported bracket expression')
+            out += POSIX_CLASSES[expr[i + 2:end]]
+            i = end + 2
+            continue
+        elif expr.startswith('[.', i) or expr.startswith('[=', i):
+            raise NotNativeError('Unsupported bracket expression')
+        elif ch in '\\[':
+            # Backslash is not special within brackets in POSIX
+            out += '\\' + ch
+        else:
+            out += ch
+        i += 1
+    raise NotNativeError('Unterminated bracket expression')
+
+
+def convert_regex(expr, extended=False, flags=0):
+    """
+    Convert a POSIX basic (or extended) regular expression, as used by
+    sed, to a Python regular expression
+    """
+    # Characters that are special without a backslash in EREs but
+    # only with one in BREs (GNU extensions included)
+    bre_escaped = '(){}+?|'
+    out = ''
+    i = 0
+    while i < len(expr):
+        ch = expr[i]
+        if ch == '\\':
+            i += 1
+            if i >= len(expr):
+                raise NotNativeError('Trailing backslash in regex')
+            ch = expr[i]
+            if ch in bre_escaped:
+                out += re.escape(ch) if extended else ch
+            elif ch.isdigit() and ch != '0':
+                out += '\\' + ch
+            elif ch in 'nt':
+                out += '\\' + ch
+            elif ch in 'wWsSb':
+                out += '\\' + ch
+            elif ch.isalnum():
+                raise NotNativeError('Unsupported regex escape \\%s' % ch)
+            else:
+                out += re.escape(ch)
+        elif ch == '[':
+            converted, i = _convert_bracket(expr, i)
+            out += converted
+            continue
+        elif ch in bre_escaped:
+            out += ch if extended else re.escape(ch)
+        else:
+            out += ch
+        i += 1
+    try:
+        return re.compile(out, flags)
+    except re.error as e:
+        raise NotNativeError('Unable to convert regex "%s": %s' % (expr, str(e)))
+
+
+def _parse_replacement(repl):
+    # Returns a list of literal strings and group numbers
+    parts = []
+    literal = ''
+    i = 0
+    while i < len(repl):
+        ch = repl[i]
+        if ch == '\\' and i + 1 < len(repl):
+            i += 1
+            ch = repl[i]
+            if ch.isdigit():
+                parts.append(literal)
+                parts.append(int(ch))
+                literal = ''
+            elif ch == 'n':
+                literal += '\n'
+            elif ch == 't':
+                literal += '\t'
+            elif ch.isalpha():
+                # e.g. GNU \U / \L case conversion
+                raise NotNativeError('Unsupported replacement escape \\%s' % ch)
+            else:
+                literal += ch
+        elif ch == '&':
+            parts.append(literal)
+            parts.append(0)
+            literal = ''
+        else:
+            literal += ch
+        i += 1
+    parts.append(literal)
+    return parts
+
+
+def _split_sed_script(script):
+    # Split a sed script into s commands, returning a list of
+    # (pattern, replacement, flags)
+    commands = []
+    i = 0
+    while i < len(script):
+        if script[i] in ' \t\n;':
+            i += 1
+            continue
+        if script[i] != 's' or i + 1 >= len(script):
+            raise NotNativeError('Unsupported sed command')
+        delim = script[i + 1]
+        if delim in '\\\n':
+            raise NotNativeError('Invalid sed delimiter')
+        i += 2
+        fields = []
+        for _ in range(2):
+            field = ''
+            while True:
+                if i >= len(script):
+                    raise NotNativeError('Unterminated sed s command')
+                ch = script[i]
+                if ch == '\\' and i + 1 < len(script):
+                    if script[i + 1] == delim:
+                        if delim in '.*[]^$+?(){}|&':
+                            # Whether this is literal or not varies
+                            raise NotNativeError('Escaped special character used as sed delimiter')
+                        field += delim
+                    else:
+                        field += script[i:i + 2]
+                    i += 2
+                    continue
+                elif ch == delim:
+                    i += 1
+                    break
+                field += ch
+                i += 1
+            fields.append(field)
+        flags = ''
+        while i < len(script) and script[i] not in ';\n':
+            flags += script[i]
+            i += 1
+        flags = flags.strip()
+        if not re.match('^(g|I|[0-9]+)*$', flags):
+            raise NotNativeError('Unsupported sed flags "%s"' % flags)
+        commands.append((fields[0], fields[1], flags))
+    return commands
+
+
+def cmd_echo(args, stdin):
+    newline = True
+    if args and args[0] == '-n':
+        newline = False
+        args = args[1:]
+    if (args and re.match('^-[neE]+$', args[0])) or any('\\' in arg for arg in args):
+        # echo's handling of options and escapes varies between shells
+        raise NotNativeError('Unsupported echo usage')
+    return ' '.join(args) + ('\n' if newline else '')
+
+
+def cmd_sed(args, stdin):
+    scripts = []
+    extended = False
+    files = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '-e':
+            if i + 1 >= len(args):
+                raise NotNativeError('Missing sed expression')
+            scripts.append(args[i + 1])
+            i += 1
+        elif arg.startswith('-e'):
+            scripts.append(arg[2:])
+        elif arg in ['-E', '-r', '--regexp-extended']:
+            extended = True
+        elif arg.startswith('-'):
+            raise NotNativeError('Unsupported sed option %s' % arg)
+        else:
+            files.append(arg)
+        i += 1
+    if not scripts and files:
+        scripts.append(files.pop(0))
+    if files or not scripts:
+        raise NotNativeError('Unsupported sed usage')
+
+    substitutions = []
+    for script in scripts:
+        for pattern, repl, flags in _split_sed_script(script):
+            if pattern == '':
+                raise NotNativeError('Empty regex in sed s command')
+            regex = convert_regex(pattern, extended, re.IGNORECASE if 'I' in flags else 0)
+            nth = int(''.join(c for c in flags if c.isdigit()) or '1')
+            substitutions.append((regex, _parse_replacement(repl), nth, 'g' in flags))
+
+    def substitute(regex, parts, nth, globalsub, line):
+        count = 0
+        def repl(match):
+            nonlocal count
+            count += 1
+            if count < nth or (count > nth and not globalsub):
+                return match.group(0)
+            return ''.join(part if isinstance(part, str) else (match.group(part) or '') for part in parts)
+        return regex.sub(repl, line)
+
+    output = ''
+    for line in _split_lines(stdin):
+        for regex, parts, nth, globalsub in substitutions:
+            try:
+                line = substitute(regex, parts, nth, globalsub, line)
+            except IndexError:
+                raise NotNativeError('Invalid group reference in sed replacement')
+        output += line + '\n'
+    return output
+
+
+def _parse_list(spec):
+    # Parse a cut LIST into a function determining if a (1-based)
+    # position is selected
+    ranges = []
+    for item in spec.split(','):
+        try:
+            if '-' in item:
+                start, end = item.split('-', 1)
+                ranges.append((int(start or '1'), int(end) if end else None))
+            else:
+                ranges.append((int(item), int(item)))
+        except ValueError:
+            raise NotNativeError('Invalid cut list "%s"' % spec)
+    return lambda pos: any(pos >= start and (end is None or pos <= end) for start, end in ranges)
+
+
+def cmd_cut(args, stdin):
+    delim = '\t'
+    fields = None
+    chars = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        opt = arg[:2]
+        if opt in ['-d', '-f', '-c', '-b']:
+            value = arg[2:]
+            if not value:
+                if i + 1 >= len(args):
+                    raise NotNativeError('Missing cut option value')
+                i += 1
+                value = args[i]
+            if opt == '-d':
+                if len(value) != 1:
+                    raise NotNativeError('Invalid cut delimiter')
+                delim = value
+            elif opt == '-f':
+                fields = _parse_list(value)
+            else:
+                chars = _parse_list(value)
+        else:
+            raise NotNativeError('Unsupported cut usage %s' % arg)
+        i += 1
+    if (fields is None) == (chars is None):
+        raise NotNativeError('Unsupported cut usage')
+
+    output = ''
+    for line in _split_lines(stdin):
+        if chars:
+            output += ''.join(ch for pos, ch in enumerate(line, 1) if chars(pos)) + '\n'
+        elif delim not in line:
+            output += line + '\n'
+        else:
+            output += delim.join(field for pos, field in enumerate(line.split(delim), 1) if fields(pos)) + '\n'
+    return output
+
+
+def _parse_awk_program(program):
+    # We only handle '{print ...}' where the arguments are fields and
+    # string literals; returns a list of lists of items (one list per
+    # comma-separated argument), where items are ints (field numbers),
+    # None (for $NF) or strings
+    match = re.match(r'^\s*\{\s*print\s+(.*?)\s*;?\s*\}\s*$', program, re.DOTALL)
+    if not match:
+        raise NotNativeError('Unsupported awk program')
+    exprs = []
+    items = []
+    expr = match.group(1)
+    i = 0
+    while i < len(expr):
+        ch = expr[i]
+        if ch in ' \t':
+            i += 1
+        elif ch == ',':
+            exprs.append(items)
+            items = []
+            i += 1
+        elif ch == '$':
+            fmatch = re.match(r'\$([0-9]+|NF)', expr[i:])
+            if not fmatch:
+                raise NotNativeError('Unsupported awk field expression')
+            items.append(None if fmatch.group(1) == 'NF' else int(fmatch.group(1)))
+            i += len(fmatch.group(0))
+        elif ch == '"':
+            end = expr.find('"', i + 1)
+            if end < 0 or '\\' in expr[i + 1:end]:
+                raise NotNativeError('Unsupported awk string')
+            items.append(expr[i + 1:end])
+            i = end + 1
+        else:
+            raise NotNativeError('Unsupported awk expression')
+    exprs.append(items)
+    if not all(exprs):
+        raise NotNativeError('Unsupported awk expression')
+    return exprs
+
+
+def cmd_awk(args, stdin):
+    fs = ' '
+    program = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('-F'):
+            fs = arg[2:]
+            if not fs:
+                if i + 1 >= len(args):
+                    raise NotNativeError('Missing awk field separator')
+                i += 1
+                fs = args[i]
+            if fs == 't' or fs == '\\t':
+                fs = '\t'
+        elif arg.startswith('-') or program is not None:
+            raise NotNativeError('Unsupported awk usage')
+        else:
+            program = arg
+        i += 1
+    if program is None:
+        raise NotNativeError('Missing awk program')
+    exprs = _parse_awk_program(program)
+
+    output = ''
+    for line in _split_lines(stdin):
+        if fs == ' ':
+            fields = line.split()
+        elif len(fs) == 1:
+            fields = line.split(fs) if line else []
+        else:
+            try:
+                fields = re.split(fs, line) if line else []
+            except re.error:
+                raise NotNativeError('Unsupported awk field separator')
+        values = []
+        for items in exprs:
+            value = ''
+            for item in items:
+                if isinstance(item, str):
+                    value += item
+                elif item is None:
+                    value += fields[-1] if fields else ''
+                elif item == 0:
+                    value += line
+                elif item <= len(fields):
+                    value += fields[item - 1]
+            values.append(value)
+        output += ' '.join(values) + '\n'
+    return output
+
+
+def _expand_tr_set(spec):
+    chars = ''
+    i = 0
+    while i < len(spec):
+        ch = spec[i]
+        if ch == '\\' and i + 1 < len(spec):
+            i += 1
+            ch = {'n': '\n', 't': '\t', '\\': '\\'}.get(spec[i], None)
+            if ch is None:
+                raise NotNativeError('Unsupported tr escape')
+        elif ch == '[' and spec.startswith('[:', i):
+            end = spec.find(':]', i)
+            cls = spec[i + 2:end] if end > 0 else None
+            if cls == 'upper':
+                chars += 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+            elif cls == 'lower':
+                chars += 'abcdefghijklmnopqrstuvwxyz'
+            elif cls == 'digit':
+                chars += '0123456789'
+            else:
+                raise NotNativeError('Unsupported tr class')
+            i = end + 2
+            continue
+        elif ch == '[':
+            raise NotNativeError('Unsupported tr set')
+        if spec[i + 1:i + 2] == '-' and i + 2 < len(spec):
+            end = spec[i + 2]
+            if end == '\\':
+                raise NotNativeError('Unsupported tr range')
+            if ord(end) < ord(ch):
+                raise NotNativeError('Invalid tr range')
+            chars += ''.join(chr(c) for c in range(ord(ch), ord(end) + 1))
+            i += 3
+            continue
+        chars += ch
+        i += 1
+    return chars
+
+
+def cmd_tr(args, stdin):
+    delete = False
+    if args and args[0] == '-d':
+        delete = True
+        args = args[1:]
+    if any(arg.startswith('-') and len(arg) > 1 for arg in args):
+        raise NotNativeError('Unsupported tr option')
+    if delete:
+        if len(args) != 1:
+            raise NotNativeError('Unsupported tr usage')
+        return stdin.translate(str.maketrans('', '', _expand_tr_set(args[0])))
+    if len(args) != 2:
+        raise NotNativeError('Unsupported tr usage')
+    set1 = _expand_tr_set(args[0])
+    set2 = _expand_tr_set(args[1])
+    if not set2:
+        raise NotNativeError('Empty tr set')
+    # As with GNU tr, set2 is extended with its last character
+    set2 = set2[:len(set1)].ljust(len(set1), set2[-1])
+    table = {}
+    for ch1, ch2 in zip(set1, set2):
+        # Where a character is repeated, the last mapping wins
+        table[ord(ch1)] = ch2
+    return stdin.translate(table)
+
+
+NATIVE_COMMANDS = {
+    'echo': cmd_echo,
+    'sed': cmd_sed,
+    'cut': cmd_cut,
+    'awk': cmd_awk,
+    'gawk': cmd_awk,
+    'tr': cmd_tr,
+}
+
+
+def run_native(cmd):
+    """
+    Run a shell command natively, returning its output. Raises
+    NotNativeError if the command can't be handled.
+    """
+    stdout = ''
+    for args in split_pipeline(cmd):
+        func = NATIVE_COMMANDS.get(args[0], None)
+        if not func:
+            raise NotNativeError('Unhandled command %s' % args[0])
+        stdout = func(args[1:], stdout)
+    return stdout
+
+
+class ShellMacroEvaluator():
+    """
+    Evaluates the (already expanded) contents of %(...) macros, caching
+    the results so each distinct command is only ever evaluated once.
+    Commands that can be handled natively are; anything else is run
+    through the shell.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.cache = {}
+        self.native_count = 0
+        self.shell_count = 0
+
+    def evaluate(self, cmd):
+        result = self.cache.get(cmd, None)
+        if result is None:
+            try:
+                result = run_native(cmd).rstrip()
+                self.native_count += 1
+            except Exception as e:
+                if self.logger:
+                    self.logger.debug('Running "%s" in shell: %s' % (cmd, str(e)))
+                try:
+                    result = subprocess.check_output(cmd, shell=True).decode('utf-8').rstrip()
+                except Exception as e:
+                    if self.logger:
+                        self.logger.warning('Failed to execute "%s": %s' % (cmd, str(e)))
+                    result = ''
+                self.shell_count += 1
+            self.cache[cmd] = result
+        return result
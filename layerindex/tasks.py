@@ -69,182 +69,185 @@ def run_update_command(self, branch_name, update_command):
         updateobj.log = output
         updateobj.finished = datetime.now()
         updateobj.retcode = retcode
+        # The command may have filled in other fields of the record itself
+        updateobj.save(update_fields=['log', 'finished', 'retcode'])
+        utils.notify_change(settings.TASK_LOG_DIR, 'task_%s' % self.request.id)
+    return {'retcode': retcode, 'output': erroutput}
+
+
+@tasks.task(bind=True)
+def import_image_comparison(self, tarball, user_id, name, to_branch_id):
+    import logging
+    import traceback
+    utils.setup_django()
+    from django.contrib.auth.models import User
+    from django.core.urlresolvers import reverse
+    from layerindex.models import Branch, Update
+    from dissector import imageimport
+    updateobj = Update.objects.get(task_id=self.request.id)
+    updateobj.started = datetime.now()
+    updateobj.save()
+    try:
+        os.makedirs(settings.TASK_LOG_DIR)
+    except FileExistsError:
+        pass
+    logfile = os.path.join(settings.TASK_LOG_DIR, 'task_%s.log' % str(self.request.id))
+    # Log straight to the file that task_log_view reads from
+    logger = logging.getLogger('ImageComparisonImport.%s' % self.request.id)
+    loggerhandler = logging.FileHandler(logfile)
+    loggerhandler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    logger.addHandler(loggerhandler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    pwriter = utils.ProgressWriter(settings.TASK_LOG_DIR, self.request.id, logger=logger)
+    retcode = 0
+    erroutput = None
+    try:
+        user = User.objects.get(id=user_id)
+        to_branch = Branch.objects.get(id=to_branch_id)
+        comparison = imageimport.import_image_comparison(tarball, user, name, to_branch, logger, pwriter)
+        logger.info('Image comparison %s imported successfully: %s' % (comparison, reverse('image_comparison_search', args=(comparison.id,))))
+    except imageimport.ImageImportError as e:
+        logger.error(str(e))
+        erroutput = str(e)
+        retcode = 1
+    except Exception as e:
+        logger.error('Image comparison import failed:\n%s' % traceback.format_exc())
+        erroutput = str(e)
+        retcode = 1
+    finally:
+        logger.removeHandler(loggerhandler)
+        loggerhandler.close()
+        try:
+            os.remove(tarball)
+        except FileNotFoundError:
+            pass
+        with open(logfile, 'r', errors='replace') as f:
+            updateobj.log = f.read()
+        updateobj.finished = datetime.now()
+        updateobj.retcode = retcode
         updateobj.save()
+        utils.notify_change(settings.TASK_LOG_DIR, 'task_%s' % self.request.id)
     return {'retcode': retcode, 'output': erroutput}
 
 
+def queue_pregenerate_diffs(vercmp):
+    from dissector import versioncompare
+    difference_ids = versioncompare.get_pregenerate_differences(vercmp)
+    if not difference_ids:
+        return
+    # Split the diffs up between a limited number of tasks so that they
+    # can't tie up all of the workers
+    concurrency = max(getattr(settings, 'VERSION_COMPARE_PREGENERATE_CONCURRENCY', 2), 1)
+    for i in range(concurrency):
+        batch = difference_ids[i::concurrency]
+        if batch:
+            pregenerate_diffs.apply_async((batch,), queue=getattr(settings, 'VERSION_COMPARE_PREGENERATE_QUEUE', 'celery'))
+
+
 @tasks.task
 def generate_version_comparison(vercmp_id):
-    from distutils.version import LooseVersion
     utils.setup_django()
     from django.db import transaction
-    from layerindex.models import ClassicRecipe
-    from dissector.models import VersionComparison, VersionComparisonDifference, ImageComparisonRecipe
+    from dissector.models import VersionComparison
+    from dissector import versioncompare
+    vercmp = VersionComparison.objects.get(id=vercmp_id)
+    try:
+        with transaction.atomic():
+            versioncompare.generate_version_comparison(vercmp)
+    except:
+        vercmp.status = 'F'
+        vercmp.save()
+        utils.notify_change(settings.TASK_LOG_DIR, 'versioncomparison_%s' % vercmp.id)
+        raise
+    vercmp.status = 'S'
+    vercmp.save()
+    utils.notify_change(settings.TASK_LOG_DIR, 'versioncomparison_%s' % vercmp.id)
+    if getattr(settings, 'VERSION_COMPARE_PREGENERATE_DIFFS', False):
+        queue_pregenerate_diffs(vercmp)
+
+
+@tasks.task
+def update_version_comparison(vercmp_id):
+    utils.setup_django()
+    from django.db import transaction
+    from dissector.models import VersionComparison
+    from dissector import versioncompare
     vercmp = VersionComparison.objects.get(id=vercmp_id)
     try:
-        from_branch = vercmp.from_branch
-        to_branch = vercmp.to_branch
-        from_image = from_branch.is_image_comparison()
-        to_image = to_branch.is_image_comparison()
         with transaction.atomic():
-            from_layerbranch = from_branch.layerbranch_set.first()
-            to_layerbranch = to_branch.layerbranch_set.first()
-            if from_image:
-                from_recipes = ImageComparisonRecipe.objects.filter(layerbranch=from_layerbranch).only('pn')
-            else:
-                from_recipes = ClassicRecipe.objects.filter(layerbranch=from_layerbranch, deleted=False).only('pn')
-
-            if from_image and not to_image:
-                from_pns = set(from_recipes.values_list('cover_pn', flat=True))
-            else:
-                from_pns = set(from_recipes.values_list('pn', flat=True))
-
-            if to_image:
-                to_recipes = ImageComparisonRecipe.objects.filter(layerbranch=to_layerbranch).only('pn')
-            else:
-                to_recipes = ClassicRecipe.objects.filter(layerbranch=to_layerbranch, deleted=False).only('pn')
-
-            if to_image and not from_image:
-                to_pns = set(to_recipes.values_list('cover_pn', flat=True))
-            else:
-                to_pns = set(to_recipes.values_list('pn', flat=True))
-
-            removed = from_pns - to_pns
-            added = to_pns - from_pns
-
-            modifications = []
-            for item in sorted(added, key=lambda s: s.lower()):
-                if not item:
-                    continue
-                diff = VersionComparisonDifference()
-                diff.comparison = vercmp
-                diff.pn = item
-                diff.from_layerbranch = from_layerbranch
-                diff.to_layerbranch = to_layerbranch
-                diff.change_type = 'A'
-                diff.save()
-
-            for item in sorted(from_pns & to_pns, key=lambda s: s.lower()):
-                if from_image and not to_image:
-                    item_from_recipes = from_recipes.filter(cover_pn=item)
-                else:
-                    item_from_recipes = from_recipes.filter(pn=item)
-                if to_image and not from_image:
-                    item_to_recipes = to_recipes.filter(cover_pn=item)
-                else:
-                    item_to_recipes = to_recipes.filter(pn=item)
-                from_pvs = item_from_recipes.values_list('pv', flat=True)
-                to_pvs = item_to_recipes.values_list('pv', flat=True)
-                # Create a diff (we don't necessarily have to save it)
-                diff = VersionComparisonDifference()
-                diff.comparison = vercmp
-                diff.pn = item
-                diff.from_layerbranch = from_layerbranch
-                diff.to_layerbranch = to_layerbranch
-                if len(from_pvs) == 1 and len(to_pvs) == 1:
-                    if from_pvs[0] and to_pvs[0] and from_pvs[0] != to_pvs[0]:
-                        from_ver = LooseVersion(from_pvs[0])
-                        to_ver = LooseVersion(to_pvs[0])
-                        if to_ver > from_ver:
-                            diff.change_type = 'U'
-                            diff.oldvalue = from_pvs[0]
-                            diff.newvalue = to_pvs[0]
-                            diff.save()
-                        elif from_ver > to_ver:
-                            diff.change_type = 'D'
-                            diff.oldvalue = from_pvs[0]
-                            diff.newvalue = to_pvs[0]
-                            diff.save()
-                    else:
-                        item_from_recipe = item_from_recipes.first()
-                        item_to_recipe = item_to_recipes.first()
-                        changed = False
-                        if item_from_recipe.sha256sum != item_to_recipe.sha256sum:
-                            changed = True
-                        else:
-                            # Check patches
-                            from_patches = set(item_from_recipe.patch_set.filter(applied=True).values_list('src_path', flat=True))
-                            to_patches = set(item_to_recipe.patch_set.filter(applied=True).values_list('src_path', flat=True))
-                            if from_patches.symmetric_difference(to_patches):
-                                changed = True
-                            else:
-                                for src_path in from_patches.union(to_patches):
-                                    from_patch = item_from_recipe.patch_set.filter(src_path=src_path).first()
-                                    to_patch = item_to_recipe.patch_set.filter(src_path=src_path).first()
-                                    if from_patch.sha256sum != to_patch.sha256sum:
-                                        changed = True
-                                        break
-                        if not changed:
-                            # Check sources
-                            from_sources = set(item_from_recipe.source_set.all().values_list('url', flat=True))
-                            to_sources = set(item_to_recipe.source_set.all().values_list('url', flat=True))
-                            if from_sources.symmetric_difference(to_sources):
-                                changed = True
-                            else:
-                                for url in from_sources.union(to_sources):
-                                    from_source = item_from_recipe.source_set.filter(url=url).first()
-                                    to_source = item_to_recipe.source_set.filter(url=url).first()
-                                    if from_source.sha256sum != to_source.sha256sum:
-                                        changed = True
-                                        break
-                        if changed:
-                            # Defer saving modifications until after upgrades
-                            diff.change_type = 'M'
-                            modifications.append(diff)
-                else:
-                    diff.change_type = 'V'
-                    diff.oldvalue = ', '.join(from_pvs)
-                    diff.newvalue = ', '.join(to_pvs)
-                    diff.save()
-
-            for diff in modifications:
-                diff.save()
-
-            for item in sorted(removed, key=lambda s: s.lower()):
-                if not item:
-                    continue
-                diff = VersionComparisonDifference()
-                diff.comparison = vercmp
-                diff.pn = item
-                diff.from_layerbranch = from_layerbranch
-                diff.to_layerbranch = to_layerbranch
-                diff.change_type = 'R'
-                diff.save()
+            versioncompare.update_version_comparison(vercmp)
     except:
         vercmp.status = 'F'
         vercmp.save()
+        utils.notify_change(settings.TASK_LOG_DIR, 'versioncomparison_%s' % vercmp.id)
         raise
     vercmp.status = 'S'
     vercmp.save()
+    utils.notify_change(settings.TASK_LOG_DIR, 'versioncomparison_%s' % vercmp.id)
+    if getattr(settings, 'VERSION_COMPARE_PREGENERATE_DIFFS', False):
+        queue_pregenerate_diffs(vercmp)
+
+
+@tasks.task
+def generate_version_timeline(timeline_id):
+    utils.setup_django()
+    from django.db import transaction
+    from dissector.models import VersionTimeline
+    from dissector import versioncompare
+    timeline = VersionTimeline.objects.get(id=timeline_id)
+    try:
+        with transaction.atomic():
+            versioncompare.generate_version_timeline(timeline)
+    except:
+        timeline.status = 'F'
+        timeline.save()
+        utils.notify_change(settings.TASK_LOG_DIR, 'versiontimeline_%s' % timeline.id)
+        raise
+    timeline.status = 'S'
+    timeline.save()
+    utils.notify_change(settings.TASK_LOG_DIR, 'versiontimeline_%s' % timeline.id)
+
+
+@tasks.task
+def pregenerate_diffs(difference_ids):
+    import logging
+    utils.setup_django()
+    from dissector.models import VersionComparisonDifference, VersionComparisonFileDiff
+    from dissector import versioncompare
+    logger = logging.getLogger('layerindex.tasks')
+    for difference in VersionComparisonDifference.objects.filter(id__in=difference_ids).order_by('id'):
+        # Someone may have asked for the diff (or the comparison may have been
+        # updated) since this was queued, in which case leave it alone. There
+        # can only be one per difference, so if someone asks at the same time
+        # get_or_create() gets the IntegrityError and returns their record.
+        fdiff, created = VersionComparisonFileDiff.objects.get_or_create(difference=difference)
+        if not created:
+            continue
+        try:
+            versioncompare.generate_file_diff(fdiff)
+        except Exception as e:
+            logger.warning('Failed to generate diff for %s: %s' % (difference, str(e)))
+            fdiff.status = 'F'
+        else:
+            fdiff.status = 'S'
+        fdiff.save()
+        utils.notify_change(settings.TASK_LOG_DIR, 'filediff_%s' % fdiff.id)
 
 
 @tasks.task
 def generate_diff(file_diff_id):
     utils.setup_django()
     from dissector.models import VersionComparisonFileDiff
+    from dissector import versioncompare
     fdiff = VersionComparisonFileDiff.objects.get(id=file_diff_id)
     try:
-        fdiff_file = fdiff.get_diff_path()
-        try:
-            os.makedirs(os.path.dirname(fdiff_file))
-        except FileExistsError:
-            pass
-        from_path, to_path = fdiff.difference.get_comparison_paths()
-        if not from_path:
-            raise Exception('Unable to generate diff: invalid from path')
-        if not to_path:
-            raise Exception('Unable to generate diff: invalid to path')
-        srcdir = getattr(settings, 'VERSION_COMPARE_SOURCE_DIR')
-        from_path = os.path.relpath(from_path, srcdir)
-        to_path = os.path.relpath(to_path, srcdir)
-        try:
-            utils.runcmd("git diff --no-index -M %s %s | sed '/^Binary files/d' > %s" % (shlex.quote(from_path), shlex.quote(to_path), shlex.quote(fdiff_file)), destdir=srcdir, shell=True)
-        except subprocess.CalledProcessError as e:
-            if e.returncode != 1:
-                raise
+        versioncompare.generate_file_diff(fdiff)
     except:
         fdiff.status = 'F'
         fdiff.save()
+        utils.notify_change(settings.TASK_LOG_DIR, 'filediff_%s' % fdiff.id)
         raise
     fdiff.status = 'S'
     fdiff.save()
+    utils.notify_change(settings.TASK_LOG_DIR, 'filediff_%s' % fdiff.id)
@@ -16,31 +16,123 @@ import json
 import shutil
 import tempfile
 import tarfile
+import time
+import hashlib
 
 sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
 
 import utils
+import artifactcache
 
 logger = utils.logger_create('ClearImport')
 
 
-def import_derivative(args, tempdir):
-    def extract_tar(tarballfn):
-        with tarfile.open(tarballfn, 'r') as tar:
-            if not utils.check_tar_contents(tar):
-                logger.error('Invalid source tarball')
-                return None
-            tar.extractall(tempdir)
-        for entry in os.listdir(tempdir):
-            pth = os.path.join(tempdir, entry)
-            if os.path.isdir(pth):
-                return pth
-        logger.error('No directory found after extracting source tarball')
+def get_cache_dir(args):
+    if args.cache_dir:
+        return args.cache_dir
+    return os.path.join(args.outdir, '.cache')
+
+
+def read_stamp(stampfile):
+    try:
+        with open(stampfile, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
         return None
 
+
+class ImportStageError(Exception):
+    pass
+
+
+def _write_json(path, data):
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmpname, path)
+
+
+def _json_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ImportPipeline():
+    """
+    Runs an import as a series of stages, recording a checkpoint for each
+    one (a hash of its inputs, its outputs and how long it took) so that
+    if a later stage fails, a rerun can skip over the stages that have
+    already completed with the same inputs. The hash for each stage also
+    covers the inputs and outputs of all of the stages before it, so
+    anything after a stage that has to run again is run again as well.
+    """
+    def __init__(self, checkpointfile, restart=False):
+        self.checkpointfile = checkpointfile
+        self.checkpoints = {}
+        if not restart:
+            self.checkpoints = read_stamp(checkpointfile) or {}
+        self.timings = []
+        self.resume_only = []
+        self.upstream = ''
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.checkpointfile), exist_ok=True)
+        _write_json(self.checkpointfile, self.checkpoints)
+
+    def run(self, name, inputs, func, validate=None, checkpoint=True, resume_only=False):
+        """
+        Run a stage, unless it has a checkpoint with the same inputs and
+        validate (if specified) says its outputs are still usable.
+        Returns the stage's outputs (which must be serialisable to
+        JSON). resume_only stages are only skipped when
+        resuming an import that didn't complete.
+        """
+        inputhash = _json_hash({'upstream': self.upstream, 'inputs': inputs})
+        if resume_only:
+            self.resume_only.append(name)
+        if checkpoint:
+            stagecp = self.checkpoints.get(name)
+            if stagecp and stagecp['inputs'] == inputhash and (validate is None or validate(stagecp['outputs'])):
+                logger.info('Stage %s already completed, skipping' % name)
+                self.timings.append({'stage': name, 'duration': 0, 'skipped': True, 'failed': False})
+                self.upstream = _json_hash([inputhash, stagecp['outputs']])
+                return stagecp['outputs']
+            if name in self.checkpoints:
+                del self.checkpoints[name]
+                self._save()
+        logger.debug('Running stage %s' % name)
+        timing = {'stage': name, 'duration': 0, 'skipped': False, 'failed': True}
+        self.timings.append(timing)
+        starttime = time.time()
+        try:
+            outputs = func()
+        finally:
+            timing['duration'] = round(time.time() - starttime, 2)
+        timing['failed'] = False
+        logger.info('Stage %s completed in %.1fs' % (name, timing['duration']))
+        if checkpoint:
+            self.checkpoints[name] = {'inputs': inputhash, 'outputs': outputs, 'duration': timing['duration']}
+            self._save()
+        self.upstream = _json_hash([inputhash, outputs])
+        return outputs
+
+    def finish(self):
+        """
+        Mark the import as completed, so that stages that only need to
+        be skipped when resuming will run next time
+        """
+        for name in self.resume_only:
+            self.checkpoints.pop(name, None)
+        self._save()
+
+    def write_timings(self, update_id):
+        utils.setup_django()
+        from layerindex.models import Update
+        Update.objects.filter(id=update_id).update(stage_timings=json.dumps(self.timings))
+
+
+def fetch_derivative(args):
     if '://' in args.derivative:
-        def reporthook(blocknum, blocksize, total):
-            downloaded = blocknum * blocksize
+        def reporthook(downloaded, total):
             if total > 0:
                 percent = downloaded * 100 / total
                 s = "\r %d%% %s / %s    " % (
@@ -49,18 +141,42 @@ def import_derivative(args, tempdir):
                 if downloaded >= total:
                     sys.stderr.write("\n")
             else:
-                sys.stderr.write("Downloaded %s\n" % utils.human_filesize(downloaded))
+                sys.stderr.write("\r Downloaded %s    " % utils.human_filesize(downloaded))
 
-        tarball = os.path.join(tempdir, 'tmpsrc.tar.gz')
+        # Fetched tarballs are kept so that re-importing the same one doesn't
+        # need to download it again (or at all, if we know its checksum)
+        cache = artifactcache.ArtifactCache(get_cache_dir(args), logger=logger)
         logger.info('Retrieving source tarball')
-        urllib.request.urlretrieve(args.derivative, tarball, reporthook)
-        srcpath = extract_tar(tarball)
-        if not srcpath:
-            return None, None, None, None
+        try:
+            tarball = cache.fetch(args.derivative, sha256sum=args.checksum, progress=reporthook)
+        except artifactcache.FetchError as e:
+            raise ImportStageError(str(e))
+        # Objects in the cache are named by their checksum
+        return {'tarball': tarball, 'key': os.path.basename(tarball)}
     elif args.derivative.endswith(('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
-        srcpath = extract_tar(args.derivative)
-        if not srcpath:
-            return None, None, None, None
+        st = os.stat(args.derivative)
+        return {'tarball': args.derivative, 'key': '%s:%d:%d' % (os.path.abspath(args.derivative), st.st_size, st.st_mtime)}
+    else:
+        return {'tarball': None, 'key': os.path.abspath(args.derivative)}
+
+
+def import_derivative(args, tarball, workdir):
+    def extract_tar(tarballfn):
+        if os.path.exists(workdir):
+            shutil.rmtree(workdir)
+        os.makedirs(workdir)
+        with tarfile.open(tarballfn, 'r') as tar:
+            if not utils.check_tar_contents(tar):
+                raise ImportStageError('Invalid source tarball')
+            tar.extractall(workdir)
+        for entry in os.listdir(workdir):
+            pth = os.path.join(workdir, entry)
+            if os.path.isdir(pth):
+                return pth
+        raise ImportStageError('No directory found after extracting source tarball')
+
+    if tarball:
+        srcpath = extract_tar(tarball)
     else:
         srcpath = args.derivative
 
@@ -69,12 +185,10 @@ def import_derivative(args, tempdir):
         with open(os.path.join(srcpath, 'src', 'build', imagefile), 'r') as f:
             dt = json.load(f)
     except FileNotFoundError:
-        logger.error('Tarball unpacked but did not contain src/build/release-image-config.json - is this actually a Clear Linux derivative source tarball?')
-        return None, None, None, None
+        raise ImportStageError('Tarball unpacked but did not contain src/build/release-image-config.json - is this actually a Clear Linux derivative source tarball?')
     bundles = dt.get('Bundles', [])
     if not bundles:
-        logger.error('No bundles found in %s' % imagefile)
-        return None, None, None, None
+        raise ImportStageError('No bundles found in %s' % imagefile)
     localbundles = {}
     stdbundles = []
     for bundle in bundles:
@@ -91,101 +205,142 @@ def import_derivative(args, tempdir):
 
     release = str(dt.get('Version', ''))
     if not release:
-        logger.error('No version specified in %s' % imagefile)
-        return None, None, None, None
+        raise ImportStageError('No version specified in %s' % imagefile)
 
-    return release, stdbundles, localbundles, srcpath
+    return {'release': release, 'stdbundles': stdbundles, 'localbundles': localbundles, 'srcpath': srcpath}
 
 
-def import_clear(args):
-    tmpsrcdir = None
-    tempdir = tempfile.mkdtemp()
-    try:
-        if args.derivative:
-            release, stdbundles, localbundles, srcpath = import_derivative(args, tempdir)
-            if not release:
-                return 1
-        elif args.release:
-            release = args.release
-        else:
-            logger.debug('Checking latest Clear Linux release...')
-            rq = urllib.request.Request('https://cdn.download.clearlinux.org/releases/current/clear/latest')
-            data = urllib.request.urlopen(rq).read()
-            release = data.decode('utf-8').strip()
+def run_dissector(args, release, stdbundles):
+    pkgsrcdir = os.path.join(args.outdir, release, 'source')
+    env = os.environ.copy()
+    if args.clear_tool_path:
+        if not os.path.exists(os.path.join(args.clear_tool_path, 'dissector')):
+            raise ImportStageError('No dissector executable found in specified path')
+        env['PATH'] = args.clear_tool_path + ':' + env['PATH']
+    cmd = ['dissector', '-clear_version', release]
+    if args.bundles_url:
+        cmd += ['-bundles_url', args.bundles_url]
+    if args.repo_url:
+        cmd += ['-repo_url', args.repo_url]
+    if args.derivative:
+        cmd += stdbundles
+    else:
+        cmd.append('-all')
 
-        if args.layer:
-            layername = args.layer
+    if not args.derivative:
+        # Releases don't change once published, so if we've already fetched
+        # everything for this one (for any branch) there's no need to do it again
+        stampfile = os.path.join(args.outdir, release, '.dissector-complete')
+        if not args.refetch and os.path.exists(pkgsrcdir) and read_stamp(stampfile) == cmd:
+            logger.info('Release %s has already been fetched' % release)
         else:
-            # Use same name as branch
-            layername = args.branch
+            if os.path.exists(stampfile):
+                os.remove(stampfile)
+            logger.debug('Executing %s' % cmd)
+            return_code = subprocess.call(cmd, env=env, cwd=os.path.abspath(args.outdir))
+            if return_code != 0:
+                raise ImportStageError('Call to dissector failed')
+            with open(stampfile, 'w') as f:
+                json.dump(cmd, f)
+        return {'pkgsrcdir': pkgsrcdir}
 
-        logger.debug('Fetching Clear Linux release %s' % release)
-
-        pkgsrcdir = os.path.join(args.outdir, release, 'source')
-        if args.derivative:
-            if os.path.exists(pkgsrcdir):
-                tmpsrcdir = tempfile.mkdtemp(dir=os.path.join(args.outdir, release))
-                shutil.move(pkgsrcdir, tmpsrcdir)
-
-        env = os.environ.copy()
-        if args.clear_tool_path:
-            if not os.path.exists(os.path.join(args.clear_tool_path, 'dissector')):
-                logger.error('No dissector executable found in specified path')
-                return 1
-            env['PATH'] = args.clear_tool_path + ':' + env['PATH']
-        cmd = ['dissector', '-clear_version', release]
-        if args.bundles_url:
-            cmd += ['-bundles_url', args.bundles_url]
-        if args.repo_url:
-            cmd += ['-repo_url', args.repo_url]
-        if args.derivative:
-            cmd += stdbundles
-        else:
-            cmd.append('-all')
+    # For a derivative the dissector writes to the same place as it
+    # would for the upstream release, so move that out of the way
+    tmpsrcdir = None
+    if os.path.exists(pkgsrcdir):
+        tmpsrcdir = tempfile.mkdtemp(dir=os.path.join(args.outdir, release))
+        shutil.move(pkgsrcdir, tmpsrcdir)
+    try:
         logger.debug('Executing %s' % cmd)
         return_code = subprocess.call(cmd, env=env, cwd=os.path.abspath(args.outdir))
         if return_code != 0:
-            logger.error('Call to dissector failed')
-            return 1
+            raise ImportStageError('Call to dissector failed')
+        # Now move the source tree somewhere more permanent (so we can do file diffs)
+        pkgnewsrcdir = os.path.join(args.outdir, 'derivative_%s' % args.branch)
+        if os.path.exists(pkgnewsrcdir):
+            shutil.rmtree(pkgnewsrcdir)
+        shutil.move(pkgsrcdir, pkgnewsrcdir)
+    finally:
+        if tmpsrcdir:
+            if os.path.exists(pkgsrcdir):
+                shutil.rmtree(pkgsrcdir)
+            shutil.move(os.path.join(tmpsrcdir, 'source'), pkgsrcdir)
+            os.rmdir(tmpsrcdir)
+    return {'pkgsrcdir': pkgnewsrcdir}
+
+
+def run_tool(args, cmd, errmsg):
+    cwd = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    # The update record doesn't affect the result, so it isn't part of
+    # the stage inputs (and a different one can be used when resuming)
+    if args.update:
+        cmd = cmd + ['-u', args.update]
+    logger.debug('Executing %s' % cmd)
+    return_code = subprocess.call(cmd, cwd=cwd)
+    if return_code != 0:
+        raise ImportStageError(errmsg)
+    return {}
+
 
+def import_clear(args):
+    if args.layer:
+        layername = args.layer
+    else:
+        # Use same name as branch
+        layername = args.branch
+
+    checkpointfile = os.path.join(args.outdir, '.checkpoints', '%s.json' % args.branch)
+    pipeline = ImportPipeline(checkpointfile, restart=args.refetch)
+    try:
         if args.derivative:
-            # Now move the source tree somewhere more permanent (so we can do file diffs)
-            pkgnewsrcdir = os.path.join(args.outdir, 'derivative_%s' % args.branch)
-            if os.path.exists(pkgnewsrcdir):
-                shutil.rmtree(pkgnewsrcdir)
-            shutil.move(pkgsrcdir, pkgnewsrcdir)
-            pkgsrcdir = pkgnewsrcdir
-
-        cwd = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-        pkgdir = os.path.join(args.outdir, release, 'source')
+            fetched = pipeline.run('fetch', {}, lambda: fetch_derivative(args), checkpoint=False)
+            workdir = os.path.join(args.outdir, '.work', args.branch)
+            derivative = pipeline.run('extract', {'source': fetched['key']},
+                                      lambda: import_derivative(args, fetched['tarball'], workdir),
+                                      validate=lambda outputs: os.path.isdir(outputs['srcpath']),
+                                      checkpoint=bool(fetched['tarball']))
+            release = derivative['release']
+            stdbundles = derivative['stdbundles']
+            srcpath = derivative['srcpath']
+        else:
+            def get_release():
+                if args.release:
+                    return args.release
+                logger.debug('Checking latest Clear Linux release...')
+                rq = urllib.request.Request('https://cdn.download.clearlinux.org/releases/current/clear/latest')
+                data = urllib.request.urlopen(rq).read()
+                return data.decode('utf-8').strip()
+            release = pipeline.run('fetch', {}, get_release, checkpoint=False)
+            stdbundles = None
+
+        logger.debug('Fetching Clear Linux release %s' % release)
+        dissected = pipeline.run('dissector',
+                                 {'release': release, 'stdbundles': stdbundles, 'derivative': bool(args.derivative), 'bundles_url': args.bundles_url, 'repo_url': args.repo_url},
+                                 lambda: run_dissector(args, release, stdbundles),
+                                 validate=lambda outputs: os.path.isdir(outputs['pkgsrcdir']))
+        pkgsrcdir = dissected['pkgsrcdir']
+
         if args.derivative:
             cmd = ['layerindex/tools/import_otherdistro.py', 'import-clear-derivative', args.branch, layername, pkgsrcdir, srcpath, '--description', '%s %s' % (args.name, release), '--relative-path', args.outdir]
         else:
             cmd = ['layerindex/tools/import_otherdistro.py', 'import-pkgspec', args.branch, layername, pkgsrcdir, '--description', '%s %s' % (args.name, release), '--relative-path', args.outdir]
-        if args.update:
-            cmd += ['-u', args.update]
+        runcmd = cmd[:]
         if args.debug:
-            cmd.insert(1, '-d')
-        logger.debug('Executing %s' % cmd)
-        return_code = subprocess.call(cmd, cwd=cwd)
-        if return_code != 0:
-            logger.error('Importing data failed')
-            return 1
-    finally:
-        shutil.rmtree(tempdir)
-        if tmpsrcdir and os.path.exists(tmpsrcdir):
-            shutil.move(tmpsrcdir, pkgsrcdir)
+            runcmd.insert(1, '-d')
+        pipeline.run('import', {'cmd': cmd}, lambda: run_tool(args, runcmd, 'Importing data failed'), resume_only=True)
 
-    if not args.no_status:
-        skiplist = ['helloworld']
-        cmd = ['layerindex/tools/update_classic_status.py', '-b', args.branch, '-l', layername, '-d', '-s', ','.join(skiplist)]
+        if not args.no_status:
+            skiplist = ['helloworld']
+            cmd = ['layerindex/tools/update_classic_status.py', '-b', args.branch, '-l', layername, '-d', '-s', ','.join(skiplist)]
+            pipeline.run('status', {'cmd': cmd}, lambda: run_tool(args, cmd, 'Updating recipe links failed'), resume_only=True)
+
+        pipeline.finish()
+    except ImportStageError as e:
+        logger.error(str(e))
+        return 1
+    finally:
         if args.update:
-            cmd += ['-u', args.update]
-        logger.debug('Executing %s' % cmd)
-        return_code = subprocess.call(cmd, cwd=cwd)
-        if return_code != 0:
-            logger.error('Updating recipe links failed')
-            return 1
+            pipeline.write_timings(args.update)
 
     return 0
 
@@ -205,6 +360,9 @@ def main():
     parser.add_argument('--bundles-url', help='Base URL for downloading release archives of clr-bundles')
     parser.add_argument('--repo-url', help='Base URL for downloading releases')
     parser.add_argument('--no-status', help='Skip updating status', action='store_true')
+    parser.add_argument('--checksum', help='Expected SHA-256 checksum of derivative source tarball (when fetching from a URL)')
+    parser.add_argument('--cache-dir', help='Directory to cache downloaded files in (default ".cache" under output directory)')
+    parser.add_argument('--refetch', help='Run all stages of the import, even those already completed by a previous run', action='store_true')
 
     args = parser.parse_args()
 
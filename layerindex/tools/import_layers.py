@@ -132,7 +132,7 @@ def main():
             jsdata = json.loads(data.decode('utf-8'))
 
             layerbranch_idmap = {}
-            exclude_fields = ['id', 'layer', 'branch', 'vcs_last_fetch', 'vcs_last_rev', 'vcs_last_commit', 'yp_compatible_version', 'updated']
+            exclude_fields = ['id', 'layer', 'branch', 'vcs_last_fetch', 'vcs_last_rev', 'vcs_last_commit', 'yp_compatible_version', 'updated', 'fingerprint']
             for layerbranchjs in jsdata:
                 branch = branch_idmap.get(layerbranchjs['branch'], None)
                 if not branch:
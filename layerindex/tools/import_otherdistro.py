@@ -20,6 +20,9 @@ import shutil
 import subprocess
 import string
 import shlex
+import multiprocessing
+import multiprocessing.pool
+from collections import OrderedDict
 from distutils.version import LooseVersion
 
 sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
@@ -27,14 +30,31 @@ sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), 'lib
 
 import utils
 import recipeparse
+import shellmacro
+import rpmfile
 
 logger = utils.logger_create('LayerIndexOtherDistro')
 
+# Results of %(...) macros are cached here (per process)
+macro_evaluator = shellmacro.ShellMacroEvaluator(logger=logger)
+
+# Number of recipes to write to the database at once
+BULK_BATCH_SIZE = 500
+
+# Number of spec files to hand to each parsing process at a time
+PARSE_CHUNK_SIZE = 8
+
 
 class DryRunRollbackException(Exception):
     pass
 
 
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def get_gourl(goipath):
     # Much more crude than the original implementation
     gourl = goipath
@@ -43,358 +63,551 @@ def get_gourl(goipath):
     return gourl
 
 
-def update_recipe_file(path, recipe, repodir, raiseexceptions=False):
-    from layerindex.models import Patch, Source
-    from django.db import DatabaseError
-
+def parse_spec_file(path, repodir, filename):
+    """
+    Parse an RPM spec file, returning a dict of recipe field values, plus
+    'patches' (a list of dicts of Patch field values) and 'sources' (a list
+    of (url, sha256sum) tuples, where sha256sum is None for remote sources).
+    Doesn't touch the database, so this can be run in a separate process.
+    """
     # yes, yes, I know this is all crude as hell, but it gets the job done.
     # At the end of the day we are scraping the spec file, we aren't trying to build it
 
     pnum_re = re.compile('-p[\s]*([0-9]+)')
     configure_re = re.compile('[/%]configure\s')
 
-    try:
-        logger.debug('Updating recipe %s' % path)
-        recipe.pn = os.path.splitext(recipe.filename)[0]
-        with open(path, 'r', errors='surrogateescape') as f:
-            indesc = False
-            desc = []
-            patches = []
-            sources = []
-            values = {}
-            defines = {'__awk': 'awk',
-                      '__python3': 'python3',
-                      '__python2': 'python',
-                      '__python': 'python',
-                      '__sed': 'sed',
-                      '__perl': 'perl',
-                      '__id_u': 'id -u',
-                      '__cat': 'cat',
-                      '__grep': 'grep',
-                      '_bindir': '/usr/bin',
-                      '_sbindir': '/usr/sbin',
-                      '_datadir': '/usr/share',
-                      '_docdir': '%{datadir}/doc',
-                      '_defaultdocdir': '%{datadir}/doc',
-                      '_pkgdocdir': '%{_docdir}/%{name}'
-                     }
-            globaldefs = {}
-
-            def expand(expr):
-                inmacro = 0
-                inshell = 0
-                lastch = None
-                macroexpr = ''
-                shellexpr = ''
-                outstr = ''
-                for i, ch in enumerate(expr):
-                    if inshell:
-                        if ch == '(':
-                            inshell += 1
-                        elif ch == ')':
-                            inshell -= 1
-                            if inshell == 0:
-                                try:
-                                    shellcmd = expand(shellexpr)
-                                    expanded = subprocess.check_output(shellcmd, shell=True).decode('utf-8').rstrip()
-                                except Exception as e:
-                                    logger.warning('Failed to execute "%s": %s' % (shellcmd, str(e)))
-                                    expanded = ''
+    logger.debug('Parsing %s' % path)
+    data = {'pn': os.path.splitext(filename)[0]}
+    with open(path, 'r', errors='surrogateescape') as f:
+        indesc = False
+        desc = []
+        patches = []
+        sources = []
+        values = {}
+        defines = {'__awk': 'awk',
+                  '__python3': 'python3',
+                  '__python2': 'python',
+                  '__python': 'python',
+                  '__sed': 'sed',
+                  '__perl': 'perl',
+                  '__id_u': 'id -u',
+                  '__cat': 'cat',
+                  '__grep': 'grep',
+                  '_bindir': '/usr/bin',
+                  '_sbindir': '/usr/sbin',
+                  '_datadir': '/usr/share',
+                  '_docdir': '%{datadir}/doc',
+                  '_defaultdocdir': '%{datadir}/doc',
+                  '_pkgdocdir': '%{_docdir}/%{name}'
+                 }
+        globaldefs = {}
+
+        def expand(expr):
+            inmacro = 0
+            inshell = 0
+            lastch = None
+            macroexpr = ''
+            shellexpr = ''
+            outstr = ''
+            for i, ch in enumerate(expr):
+                if inshell:
+                    if ch == '(':
+                        inshell += 1
+                    elif ch == ')':
+                        inshell -= 1
+                        if inshell == 0:
+                            try:
+                                expanded = macro_evaluator.evaluate(expand(shellexpr))
+                            except Exception as e:
+                                logger.warning('Failed to expand "%s": %s' % (shellexpr, str(e)))
+                                expanded = ''
+                            if expanded:
+                                outstr += expanded
+                            lastch = ch
+                            continue
+                    shellexpr += ch
+                elif inmacro:
+                    if ch == '}':
+                        inmacro -= 1
+                        if inmacro == 0:
+                            if macroexpr.startswith('?'):
+                                macrosplit = macroexpr[1:].split(':')
+                                macrokey = macrosplit[0].lower()
+                                if macrokey in globaldefs or macrokey in defines or macrokey in values:
+                                    if len(macrosplit) > 1:
+                                        outstr += expand(macrosplit[1])
+                                    else:
+                                        expanded = expand(values.get(macrokey, '') or defines.get(macrokey, '') or globaldefs.get(macrokey, ''))
+                                        if expanded:
+                                            outstr += expanded
+                            elif macroexpr.startswith('!?'):
+                                macrosplit = macroexpr[2:].split(':')
+                                macrokey = macrosplit[0].lower()
+                                if len(macrosplit) > 1:
+                                    if not (macrokey in globaldefs or macrokey in defines or macrokey in values):
+                                        outstr += expand(macrosplit[1])
+                            else:
+                                macrokey = macroexpr.lower()
+                                expanded = expand(values.get(macrokey, '') or defines.get(macrokey, '') or globaldefs.get(macrokey, ''))
                                 if expanded:
                                     outstr += expanded
-                                lastch = ch
-                                continue
-                        shellexpr += ch
-                    elif inmacro:
-                        if ch == '}':
-                            inmacro -= 1
-                            if inmacro == 0:
-                                if macroexpr.startswith('?'):
-                                    macrosplit = macroexpr[1:].split(':')
-                                    macrokey = macrosplit[0].lower()
-                                    if macrokey in globaldefs or macrokey in defines or macrokey in values:
-                                        if len(macrosplit) > 1:
-                                            outstr += expand(macrosplit[1])
-                                        else:
-                                            expanded = expand(values.get(macrokey, '') or defines.get(macrokey, '') or globaldefs.get(macrokey, ''))
-                                            if expanded:
-                                                outstr += expanded
-                                elif macroexpr.startswith('!?'):
-                                    macrosplit = macroexpr[2:].split(':')
-                                    macrokey = macrosplit[0].lower()
-                                    if len(macrosplit) > 1:
-                                        if not (macrokey in globaldefs or macrokey in defines or macrokey in values):
-                                            outstr += expand(macrosplit[1])
                                 else:
-                                    macrokey = macroexpr.lower()
-                                    expanded = expand(values.get(macrokey, '') or defines.get(macrokey, '') or globaldefs.get(macrokey, ''))
-                                    if expanded:
-                                        outstr += expanded
-                                    else:
-                                        outstr += '%{' + macroexpr + '}'
-                                lastch = ch
-                                continue
-                        macroexpr += ch
-                    if ch == '{':
-                        if lastch == '%':
-                            if inmacro == 0:
-                                macroexpr = ''
-                                outstr = outstr[:-1]
-                            inmacro += 1
-                    elif ch == '(':
-                        if lastch == '%':
-                            if inshell == 0:
-                                shellexpr = ''
-                                outstr = outstr[:-1]
-                            inshell += 1
-                    if inmacro == 0 and inshell == 0:
-                        if ch == '%':
-                            # Handle unbracketed expressions (in which case we eat the rest of the expression)
-                            if expr[i+1] not in ['{', '%']:
-                                macrokey = expr[i+1:].split()[0]
-                                if macrokey in globaldefs or macrokey in defines or macrokey in values:
-                                    expanded = expand(values.get(macrokey, '') or defines.get(macrokey, '') or globaldefs.get(macrokey, ''))
-                                    if expanded:
-                                        outstr += expanded
-                                        break
-                        if ch == '%' and lastch == '%':
-                            # %% is a literal %, so skip this one (and don't allow this to happen again if the next char is a %)
-                            lastch = ''
+                                    outstr += '%{' + macroexpr + '}'
+                            lastch = ch
                             continue
-                        outstr += ch
-                    lastch = ch
-                return outstr
-
-            def eval_cond(cond, condtype):
-                negate = False
-                if condtype == '%if':
-                    if cond.startswith('(') and cond.endswith(')'):
-                        cond = cond[1:-1].strip()
-                    if cond.startswith('!'):
-                        cond = cond[1:].lstrip()
-                        negate = True
-                    res = False
-                    try:
-                        if int(cond):
-                            res = True
-                    except ValueError:
-                        pass
-                elif condtype in ['%ifos', '%ifnos']:
-                    if condtype == '%ifnos':
-                        negate = True
-                    # Assume linux
-                    res = ('linux' in cond.split())
-                elif condtype in ['%ifarch', '%ifnarch']:
-                    if condtype == '%ifnarch':
-                        negate = True
-                    res = ('x86_64' in cond.split())
-                else:
-                    raise Exception('Unhandled conditional type "%s"' % condtype)
-                if negate:
-                    return not res
-                else:
-                    return res
-
-            applypatches = {}
-            autopatch = None
-            conds = []
-            reading = True
-            inprep = False
-            applyextra = []
-            configopts = ''
-            inconf = False
-            pastpackage = False
-            for line in f:
-                if inconf:
-                    line = line.rstrip()
-                    configopts += line.rstrip('\\')
-                    if not line.endswith('\\'):
-                        inconf = False
-                    continue
-                if line.startswith('%install'):
-                    # Assume it's OK to stop when we hit %install
-                    break
-                if line.startswith('%autopatch') or line.startswith('%autosetup'):
-                    pnum = pnum_re.search(line)
-                    if pnum:
-                        autopatch = pnum.groups()[0]
-                    else:
-                        autopatch = -1
-                elif line.startswith(('%gometa', '%gocraftmeta')):
-                    goipath = globaldefs.get('goipath', '')
-                    if not goipath:
-                        goipath = globaldefs.get('gobaseipath', '')
-                    if goipath:
-                        # We could use a python translation of the full logic from
-                        # the RPM macros to get this - but it turns out the spec files
-                        # (in Fedora at least) already use these processed names, so
-                        # there's no point
-                        globaldefs['goname'] = os.path.splitext(os.path.basename(path))[0]
-                        globaldefs['gourl'] = get_gourl(goipath)
-                elif line.startswith('%if') and ' ' in line:
-                    conds.append(reading)
-                    splitline = line.split()
-                    cond = expand(' '.join(splitline[1:]))
-                    if not eval_cond(cond, splitline[0]):
-                        reading = False
-                elif line.startswith('%else'):
-                    reading = not reading
-                elif line.startswith('%endif'):
-                    reading = conds.pop()
-                if not reading:
-                    continue
-                if line.startswith(('%define', '%global')):
-                    linesplit = line.split()
-                    name = linesplit[1].lower()
-                    value = ' '.join(linesplit[2:])
-                    if value.lower() == '%{' + name + '}':
-                        # STOP THE INSANITY!
-                        # (as seen in cups/cups.spec in Fedora)
+                    macroexpr += ch
+                if ch == '{':
+                    if lastch == '%':
+                        if inmacro == 0:
+                            macroexpr = ''
+                            outstr = outstr[:-1]
+                        inmacro += 1
+                elif ch == '(':
+                    if lastch == '%':
+                        if inshell == 0:
+                            shellexpr = ''
+                            outstr = outstr[:-1]
+                        inshell += 1
+                if inmacro == 0 and inshell == 0:
+                    if ch == '%':
+                        # Handle unbracketed expressions (in which case we eat the rest of the expression)
+                        if expr[i+1] not in ['{', '%']:
+                            macrokey = expr[i+1:].split()[0]
+                            if macrokey in globaldefs or macrokey in defines or macrokey in values:
+                                expanded = expand(values.get(macrokey, '') or defines.get(macrokey, '') or globaldefs.get(macrokey, ''))
+                                if expanded:
+                                    outstr += expanded
+                                    break
+                    if ch == '%' and lastch == '%':
+                        # %% is a literal %, so skip this one (and don't allow this to happen again if the next char is a %)
+                        lastch = ''
                         continue
-                    if line.startswith('%global'):
-                        globaldefs[name] = expand(value)
-                    else:
-                        defines[name] = value
-                    continue
-                elif line.startswith('%undefine'):
-                    linesplit = line.split()
-                    name = linesplit[1].lower()
-                    if name in globaldefs:
-                        del globaldefs[name]
-                    if name in defines:
-                        del defines[name]
+                    outstr += ch
+                lastch = ch
+            return outstr
+
+        def eval_cond(cond, condtype):
+            negate = False
+            if condtype == '%if':
+                if cond.startswith('(') and cond.endswith(')'):
+                    cond = cond[1:-1].strip()
+                if cond.startswith('!'):
+                    cond = cond[1:].lstrip()
+                    negate = True
+                res = False
+                try:
+                    if int(cond):
+                        res = True
+                except ValueError:
+                    pass
+            elif condtype in ['%ifos', '%ifnos']:
+                if condtype == '%ifnos':
+                    negate = True
+                # Assume linux
+                res = ('linux' in cond.split())
+            elif condtype in ['%ifarch', '%ifnarch']:
+                if condtype == '%ifnarch':
+                    negate = True
+                res = ('x86_64' in cond.split())
+            else:
+                raise Exception('Unhandled conditional type "%s"' % condtype)
+            if negate:
+                return not res
+            else:
+                return res
+
+        applypatches = {}
+        autopatch = None
+        conds = []
+        reading = True
+        inprep = False
+        applyextra = []
+        configopts = ''
+        inconf = False
+        pastpackage = False
+        for line in f:
+            if inconf:
+                line = line.rstrip()
+                configopts += line.rstrip('\\')
+                if not line.endswith('\\'):
+                    inconf = False
+                continue
+            if line.startswith('%install'):
+                # Assume it's OK to stop when we hit %install
+                break
+            if line.startswith('%autopatch') or line.startswith('%autosetup'):
+                pnum = pnum_re.search(line)
+                if pnum:
+                    autopatch = pnum.groups()[0]
+                else:
+                    autopatch = -1
+            elif line.startswith(('%gometa', '%gocraftmeta')):
+                goipath = globaldefs.get('goipath', '')
+                if not goipath:
+                    goipath = globaldefs.get('gobaseipath', '')
+                if goipath:
+                    # We could use a python translation of the full logic from
+                    # the RPM macros to get this - but it turns out the spec files
+                    # (in Fedora at least) already use these processed names, so
+                    # there's no point
+                    globaldefs['goname'] = os.path.splitext(os.path.basename(path))[0]
+                    globaldefs['gourl'] = get_gourl(goipath)
+            elif line.startswith('%if') and ' ' in line:
+                conds.append(reading)
+                splitline = line.split()
+                cond = expand(' '.join(splitline[1:]))
+                if not eval_cond(cond, splitline[0]):
+                    reading = False
+            elif line.startswith('%else'):
+                reading = not reading
+            elif line.startswith('%endif'):
+                reading = conds.pop()
+            if not reading:
+                continue
+            if line.startswith(('%define', '%global')):
+                linesplit = line.split()
+                name = linesplit[1].lower()
+                value = ' '.join(linesplit[2:])
+                if value.lower() == '%{' + name + '}':
+                    # STOP THE INSANITY!
+                    # (as seen in cups/cups.spec in Fedora)
                     continue
-                elif line.startswith('%package'):
-                    pastpackage = True
-                elif line.startswith('%patch'):
-                    patchsplit = line.split()
-                    if '-P' in line:
-                        # Old style
-                        patchid = re.search('-P[\s]*([0-9]+)', line)
-                        if patchid:
-                            patchid = patchid.groups()[0]
-                        else:
-                            # FIXME not sure if this is correct...
-                            patchid = 0
+                if line.startswith('%global'):
+                    globaldefs[name] = expand(value)
+                else:
+                    defines[name] = value
+                continue
+            elif line.startswith('%undefine'):
+                linesplit = line.split()
+                name = linesplit[1].lower()
+                if name in globaldefs:
+                    del globaldefs[name]
+                if name in defines:
+                    del defines[name]
+                continue
+            elif line.startswith('%package'):
+                pastpackage = True
+            elif line.startswith('%patch'):
+                patchsplit = line.split()
+                if '-P' in line:
+                    # Old style
+                    patchid = re.search('-P[\s]*([0-9]+)', line)
+                    if patchid:
+                        patchid = patchid.groups()[0]
                     else:
-                        patchid = int(patchsplit[0][6:])
-                    applypatches[patchid] = ' '.join(patchsplit[1:])
-                elif line.startswith('%cmake'):
-                    if line.rstrip().endswith('\\'):
-                        inconf = True
-                    configopts = line[7:].rstrip().rstrip('\\')
-                    continue
-                elif configure_re.search(line):
-                    if line.rstrip().endswith('\\'):
-                        inconf = True
-                    configopts = line.split('configure', 1)[1].rstrip().rstrip('\\')
-                    continue
-                elif line.startswith('meson'):
-                    if line.rstrip().endswith('\\'):
-                        inconf = True
-                    configopts = line[6:].rstrip().rstrip('\\')
-                    continue
-                elif line.startswith('%prep'):
-                    inprep = True
-                    continue
-                elif line.strip() == '%description':
-                    indesc = True
-                    continue
-                if indesc:
-                    # We want to stop parsing the description when we hit another macro,
-                    # but we do want to allow bracketed macro expressions within the description
-                    # (e.g. %{name})
-                    if line.startswith('%') and len(line) > 1 and line[1] != '{' and line[1].islower():
-                        indesc = False
-                    elif not line.startswith('#'):
-                        desc.append(line)
-                    continue
-                if inprep:
-                    if line.startswith(('%build', '%install')):
-                        inprep = False
-                    elif 'git apply' in line:
-                        applyextra.append(line)
-
-                if not pastpackage and ':' in line and not line.startswith('%'):
-                    key, value = line.split(':', 1)
-                    key = key.rstrip().lower()
-                    value = value.strip()
-                    values[key] = expand(value)
-
-        for key, value in values.items():
-            if key == 'name':
-                recipe.pn = expand(value)
-            elif key == 'version':
-                recipe.pv = expand(value)
-            elif key == 'summary':
-                recipe.summary = expand(value.strip('"\''))
-            elif key == 'group':
-                recipe.section = expand(value)
-            elif key == 'url':
-                recipe.homepage = expand(value)
-            elif key == 'license':
-                recipe.license = expand(value)
-            elif key.startswith('patch'):
-                patches.append((int(key[5:] or '0'), expand(value)))
-            elif key.startswith('source'):
-                sources.append(expand(value))
-
-        recipe.configopts = utils.squashspaces(configopts)
-
-        if desc and desc[0][0] in string.printable:
-            recipe.description = expand(' '.join(desc).rstrip())
+                        # FIXME not sure if this is correct...
+                        patchid = 0
+                else:
+                    patchid = int(patchsplit[0][6:])
+                applypatches[patchid] = ' '.join(patchsplit[1:])
+            elif line.startswith('%cmake'):
+                if line.rstrip().endswith('\\'):
+                    inconf = True
+                configopts = line[7:].rstrip().rstrip('\\')
+                continue
+            elif configure_re.search(line):
+                if line.rstrip().endswith('\\'):
+                    inconf = True
+                configopts = line.split('configure', 1)[1].rstrip().rstrip('\\')
+                continue
+            elif line.startswith('meson'):
+                if line.rstrip().endswith('\\'):
+                    inconf = True
+                configopts = line[6:].rstrip().rstrip('\\')
+                continue
+            elif line.startswith('%prep'):
+                inprep = True
+                continue
+            elif line.strip() == '%description':
+                indesc = True
+                continue
+            if indesc:
+                # We want to stop parsing the description when we hit another macro,
+                # but we do want to allow bracketed macro expressions within the description
+                # (e.g. %{name})
+                if line.startswith('%') and len(line) > 1 and line[1] != '{' and line[1].islower():
+                    indesc = False
+                elif not line.startswith('#'):
+                    desc.append(line)
+                continue
+            if inprep:
+                if line.startswith(('%build', '%install')):
+                    inprep = False
+                elif 'git apply' in line:
+                    applyextra.append(line)
+
+            if not pastpackage and ':' in line and not line.startswith('%'):
+                key, value = line.split(':', 1)
+                key = key.rstrip().lower()
+                value = value.strip()
+                values[key] = expand(value)
+
+    for key, value in values.items():
+        if key == 'name':
+            data['pn'] = expand(value)
+        elif key == 'version':
+            data['pv'] = expand(value)
+        elif key == 'summary':
+            data['summary'] = expand(value.strip('"\''))
+        elif key == 'group':
+            data['section'] = expand(value)
+        elif key == 'url':
+            data['homepage'] = expand(value)
+        elif key == 'license':
+            data['license'] = expand(value)
+        elif key.startswith('patch'):
+            patches.append((int(key[5:] or '0'), expand(value)))
+        elif key.startswith('source'):
+            sources.append(expand(value))
+
+    data['configopts'] = utils.squashspaces(configopts)
+
+    if desc and desc[0][0] in string.printable:
+        data['description'] = expand(' '.join(desc).rstrip())
+    else:
+        logger.warning('%s: description appears to be garbage' % path)
+        data['description'] = ''
+    data['sha256sum'] = utils.sha256_file(path)
+
+    data['patches'] = []
+    for index, patchfn in patches:
+        patch = {'path': os.path.join(os.path.relpath(os.path.dirname(path), repodir), patchfn),
+                 'src_path': patchfn,
+                 'apply_order': index,
+                 'applied': True}
+        if autopatch is not None:
+            patch['striplevel'] = int(autopatch)
+        elif index in applypatches:
+            pnum = pnum_re.search(applypatches[index])
+            if pnum:
+                patch['striplevel'] = int(pnum.groups()[0])
+            else:
+                patch['striplevel'] = -1
         else:
-            logger.warning('%s: description appears to be garbage' % path)
-            recipe.description = ''
-        recipe.sha256sum = utils.sha256_file(path)
-        recipe.save()
+            for line in applyextra:
+                if patchfn in line:
+                    patch['striplevel'] = 1
+                    break
+            else:
+                # Not being applied
+                logger.debug('Not applying %s %s' % (index, patchfn))
+                patch['applied'] = False
+        try:
+            patch['sha256sum'] = utils.sha256_file(os.path.join(os.path.dirname(path), patchfn))
+        except FileNotFoundError:
+            patch['sha256sum'] = ''
+        data['patches'].append(patch)
+
+    data['sources'] = []
+    for src in sources:
+        sha256sum = None
+        if not '://' in src:
+            sourcepath = os.path.join(os.path.dirname(path), src)
+            if os.path.exists(sourcepath):
+                sha256sum = utils.sha256_file(sourcepath)
+            else:
+                sha256sum = ''
+        data['sources'].append((src, sha256sum))
 
-        saved_patches = []
-        for index, patchfn in patches:
-            patchpath = os.path.join(os.path.relpath(os.path.dirname(path), repodir), patchfn)
-            patch, _ = Patch.objects.get_or_create(recipe=recipe, path=patchpath)
-            if autopatch is not None:
-                patch.striplevel = int(autopatch)
-            elif index in applypatches:
-                pnum = pnum_re.search(applypatches[index])
-                if pnum:
-                    patch.striplevel = int(pnum.groups()[0])
-                else:
-                    patch.striplevel = -1
+    return data
+
+
+def _parse_spec_job(job):
+    # Wrapper for running parse_spec_file() in a process pool
+    specfile, reldir = job
+    try:
+        return parse_spec_file(specfile, reldir, os.path.basename(specfile)), None
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        return None, str(e)
+
+
+def parse_spec_files(specfiles, reldir, jobs=1):
+    """
+    Parse a list of spec files, in parallel if jobs > 1. Yields a
+    (data, error) tuple for each spec file in order as soon as it's ready,
+    where data is as returned by parse_spec_file() (or None if it failed,
+    in which case error is the error message).
+    """
+    jobargs = [(specfile, reldir) for specfile in specfiles]
+    yield from _run_jobs(_parse_spec_job, jobargs, jobs, chunksize=PARSE_CHUNK_SIZE)
+
+
+def _run_jobs(func, jobargs, jobs, chunksize=1):
+    # Run func over jobargs in a process pool (unless there's no point),
+    # yielding the results in order
+    if jobs > 1 and len(jobargs) > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            yield from pool.imap(func, jobargs, chunksize=chunksize)
+    else:
+        for jobarg in jobargs:
+            yield func(jobarg)
+
+
+def apply_spec_data(recipe, data):
+    """
+    Set the fields of a recipe from the data parsed from its spec file
+    """
+    for field in ['pn', 'pv', 'summary', 'section', 'homepage', 'license', 'configopts', 'description', 'sha256sum']:
+        if field in data:
+            setattr(recipe, field, data[field])
+
+
+def write_spec_recipes(items):
+    """
+    Save a batch of recipes along with their patches and sources. items
+    is a list of (recipe, data) tuples where data is as returned by
+    parse_spec_file() and has already been applied to the recipe with
+    apply_spec_data(). Existing patch and source records are updated
+    rather than replaced, since other records refer to them.
+    """
+    from layerindex.models import Patch, Source
+
+    existing_ids = [recipe.id for recipe, _ in items if recipe.id]
+    existing_patches = {}
+    existing_sources = {}
+    # Any duplicates (beyond the first) of existing records get deleted
+    duplicate_ids = {Patch: [], Source: []}
+    for batch in _chunks(existing_ids, BULK_BATCH_SIZE):
+        for patch in Patch.objects.filter(recipe_id__in=batch).order_by('id'):
+            if existing_patches.setdefault((patch.recipe_id, patch.path), patch) is not patch:
+                duplicate_ids[Patch].append(patch.id)
+        for srcobj in Source.objects.filter(recipe_id__in=batch).order_by('id'):
+            if existing_sources.setdefault((srcobj.recipe_id, srcobj.url), srcobj) is not srcobj:
+                duplicate_ids[Source].append(srcobj.id)
+
+    new_patches = []
+    new_sources = []
+    keep_ids = set()
+    # Existing patches and sources that actually need writing
+    changed_ids = set()
+    for recipe, data in items:
+        patches = OrderedDict()
+        for patchdata in data['patches']:
+            patch = patches.get(patchdata['path'], None)
+            if not patch:
+                patch = existing_patches.get((recipe.id, patchdata['path']), None) or Patch(path=patchdata['path'])
+                patches[patchdata['path']] = patch
+            for field, value in patchdata.items():
+                if getattr(patch, field) != value:
+                    setattr(patch, field, value)
+                    changed_ids.add((Patch, patch.id))
+        sources = OrderedDict()
+        for url, sha256sum in data['sources']:
+            srcobj = sources.get(url, None)
+            if not srcobj:
+                srcobj = existing_sources.get((recipe.id, url), None) or Source(url=url)
+                sources[url] = srcobj
+            if sha256sum is not None and srcobj.sha256sum != sha256sum:
+                srcobj.sha256sum = sha256sum
+                changed_ids.add((Source, srcobj.id))
+        recipe.fingerprint = utils.recipe_fingerprint(recipe.sha256sum,
+                    [(patch.src_path, patch.applied, patch.sha256sum) for patch in sorted(patches.values(), key=lambda patch: patch.apply_order)],
+                    [(srcobj.url, srcobj.sha256sum) for srcobj in sources.values()])
+        recipe.save()
+        for obj in list(patches.values()) + list(sources.values()):
+            if obj.id:
+                if (obj.__class__, obj.id) in changed_ids:
+                    obj.save()
+                keep_ids.add((obj.__class__, obj.id))
             else:
-                for line in applyextra:
-                    if patchfn in line:
-                        patch.striplevel = 1
-                        break
+                obj.recipe = recipe
+                if isinstance(obj, Patch):
+                    new_patches.append(obj)
                 else:
-                    # Not being applied
-                    logger.debug('Not applying %s %s' % (index, patchfn))
-                    patch.applied = False
-            patch.src_path = patchfn
-            patch.apply_order = index
-            try:
-                patch.sha256sum = utils.sha256_file(os.path.join(os.path.dirname(path), patchfn))
-            except FileNotFoundError:
-                patch.sha256sum = ''
-            patch.save()
-            saved_patches.append(patch.id)
-        recipe.patch_set.exclude(id__in=saved_patches).delete()
-
-        existing_ids = list(recipe.source_set.values_list('id', flat=True))
-        for src in sources:
-            srcobj, _ = Source.objects.get_or_create(recipe=recipe, url=src)
-            if not '://' in src:
-                sourcepath = os.path.join(os.path.dirname(path), src)
-                if os.path.exists(sourcepath):
-                    srcobj.sha256sum = utils.sha256_file(sourcepath)
-                else:
-                    srcobj.sha256sum = ''
-            srcobj.save()
-            if srcobj.id in existing_ids:
-                existing_ids.remove(srcobj.id)
-        # Need to delete like this because some spec files have a lot of sources!
-        for idv in existing_ids:
-            Source.objects.filter(id=idv).delete()
+                    new_sources.append(obj)
+
+    # Some spec files have a lot of sources, so do this in bulk
+    for model, existing in ((Patch, existing_patches), (Source, existing_sources)):
+        stale_ids = [obj.id for obj in existing.values() if (model, obj.id) not in keep_ids]
+        stale_ids.extend(duplicate_ids[model])
+        for batch in _chunks(stale_ids, BULK_BATCH_SIZE):
+            model.objects.filter(id__in=batch).delete()
+    Patch.objects.bulk_create(new_patches, batch_size=BULK_BATCH_SIZE)
+    Source.objects.bulk_create(new_sources, batch_size=BULK_BATCH_SIZE)
+
+
+def record_recipe_updates(updateobj, recipe_ids):
+    """
+    Record that the metadata of the specified recipes was updated as part
+    of updateobj (if any), in bulk
+    """
+    from layerindex.models import ComparisonRecipeUpdate
+
+    if not updateobj:
+        return
+    for batch in _chunks(set(recipe_ids), BULK_BATCH_SIZE):
+        rupdates = ComparisonRecipeUpdate.objects.filter(update=updateobj, recipe_id__in=batch)
+        updated_ids = set(rupdates.values_list('recipe_id', flat=True))
+        rupdates.update(meta_updated=True)
+        ComparisonRecipeUpdate.objects.bulk_create([ComparisonRecipeUpdate(update=updateobj, recipe_id=recipe_id, meta_updated=True) for recipe_id in batch if recipe_id not in updated_ids])
+
+
+def write_package_recipes(layerbranch, packages, updateobj, batch_size=BULK_BATCH_SIZE):
+    """
+    Create or update recipes for binary packages, looking them up by pn.
+    packages is an iterable of (pn, fields, name) tuples where fields is
+    a dict of recipe field values and name is what to call the package
+    in log messages. Recipes that haven't changed aren't written at all.
+    """
+    from layerindex.models import ClassicRecipe, Patch, Source
+
+    for batch in _chunks(packages, batch_size):
+        recipemap = {}
+        for recipe in ClassicRecipe.objects.filter(layerbranch=layerbranch, pn__in=[pn for pn, _, _ in batch]).order_by('id'):
+            recipemap.setdefault(recipe.pn, recipe)
+        # Packages don't have patches or sources of their own, but the
+        # recipe may have been imported from a spec file previously
+        existing_ids = [recipe.id for recipe in recipemap.values()]
+        patches = {}
+        for recipe_id, src_path, applied, sha256sum in Patch.objects.filter(recipe_id__in=existing_ids).order_by('apply_order', 'id').values_list('recipe_id', 'src_path', 'applied', 'sha256sum'):
+            patches.setdefault(recipe_id, []).append((src_path, applied, sha256sum))
+        sources = {}
+        for recipe_id, url, sha256sum in Source.objects.filter(recipe_id__in=existing_ids).order_by('id').values_list('recipe_id', 'url', 'sha256sum'):
+            sources.setdefault(recipe_id, []).append((url, sha256sum))
+
+        updated_ids = []
+        for pn, fields, name in batch:
+            recipe = recipemap.get(pn, None)
+            if not recipe:
+                logger.info('Importing %s' % name)
+                recipe = ClassicRecipe(layerbranch=layerbranch, pn=pn)
+                recipemap[pn] = recipe
+            elif recipe.deleted:
+                logger.info('Restoring and updating %s' % name)
+            else:
+                logger.info('Updating %s' % name)
+            oldvalues = [getattr(recipe, field) for field in fields] + [recipe.deleted, recipe.fingerprint]
+            for field, value in fields.items():
+                setattr(recipe, field, value)
+            recipe.deleted = False
+            recipe.fingerprint = utils.recipe_fingerprint(recipe.sha256sum, patches.get(recipe.id, []), sources.get(recipe.id, []))
+            if not recipe.id or oldvalues != [getattr(recipe, field) for field in fields] + [recipe.deleted, recipe.fingerprint]:
+                recipe.save()
+                updated_ids.append(recipe.id)
+        record_recipe_updates(updateobj, updated_ids)
+
+
+def mark_recipes_deleted(layerrecipes, entries):
+    """
+    Mark the recipes with the specified (filepath, filename) entries as
+    deleted, in bulk
+    """
+    delete_ids = [recipe_id for recipe_id, filepath, filename in layerrecipes.filter(deleted=False).values_list('id', 'filepath', 'filename') if (filepath, filename) in entries]
+    for batch in _chunks(delete_ids, BULK_BATCH_SIZE):
+        layerrecipes.filter(id__in=batch).update(deleted=True)
+
+
+def update_recipe_file(path, recipe, repodir, raiseexceptions=False):
+    from django.db import DatabaseError
+
+    try:
+        logger.debug('Updating recipe %s' % path)
+        recipe.pn = os.path.splitext(recipe.filename)[0]
+        data = parse_spec_file(path, repodir, recipe.filename)
+        apply_spec_data(recipe, data)
+        write_spec_recipes([(recipe, data)])
     except DatabaseError:
         raise
     except KeyboardInterrupt:
@@ -461,64 +674,219 @@ def get_update_obj(args):
     return updateobj
 
 
-def import_specdir(metapath, layerbranch, existing, updateobj, pwriter, pn_overwrite=False):
+def get_spec_key(specfile, reldir, pn_overwrite=False):
+    """
+    Get the key that identifies the recipe for a spec file
+    """
+    specfn = os.path.basename(specfile)
+    if pn_overwrite:
+        return os.path.splitext(specfn)[0]
+    else:
+        return (os.path.relpath(os.path.dirname(specfile), reldir), specfn)
+
+
+def _file_checksum(path):
+    # Same as what parse_spec_file() records for a missing file
+    try:
+        return utils.sha256_file(path)
+    except FileNotFoundError:
+        return ''
+    except OSError:
+        return None
+
+
+class SpecChangeChecker():
+    """
+    Determines whether spec files are unchanged since they were last
+    imported, by comparing the checksums of the spec file and of the
+    patches and local sources it referenced against those stored for
+    the recipe.
+    """
+    def __init__(self, layerbranch, reldir, pn_overwrite=False):
+        from layerindex.models import ClassicRecipe, Patch, Source
+
+        self.reldir = reldir
+        self.pn_overwrite = pn_overwrite
+        self.recipes = {}
+        recipeqs = ClassicRecipe.objects.filter(layerbranch=layerbranch, deleted=False).order_by('id')
+        for recipe_id, pn, filepath, filename, sha256sum in recipeqs.values_list('id', 'pn', 'filepath', 'filename', 'sha256sum'):
+            if pn_overwrite:
+                key = pn
+            else:
+                key = (filepath, filename)
+            self.recipes.setdefault(key, (recipe_id, filepath, filename, sha256sum))
+        self.patches = {}
+        for recipe_id, path, sha256sum in Patch.objects.filter(recipe__layerbranch=layerbranch).values_list('recipe_id', 'path', 'sha256sum'):
+            self.patches.setdefault(recipe_id, []).append((path, sha256sum))
+        self.sources = {}
+        for recipe_id, url, sha256sum in Source.objects.filter(recipe__layerbranch=layerbranch).exclude(url__contains='://').values_list('recipe_id', 'url', 'sha256sum'):
+            self.sources.setdefault(recipe_id, []).append((url, sha256sum))
+
+    def is_unchanged(self, specfile):
+        recipe = self.recipes.get(get_spec_key(specfile, self.reldir, self.pn_overwrite), None)
+        if not recipe:
+            return False
+        recipe_id, filepath, filename, sha256sum = recipe
+        if (filepath, filename) != (os.path.relpath(os.path.dirname(specfile), self.reldir), os.path.basename(specfile)):
+            return False
+        if not sha256sum or _file_checksum(specfile) != sha256sum:
+            return False
+        for path, sha256sum in self.patches.get(recipe_id, []):
+            if _file_checksum(os.path.join(self.reldir, path)) != sha256sum:
+                return False
+        for url, sha256sum in self.sources.get(recipe_id, []):
+            if _file_checksum(os.path.join(os.path.dirname(specfile), url)) != sha256sum:
+                return False
+        return True
+
+
+class SpecRecipeWriter():
+    """
+    Takes the results of parsing spec files (in order) and writes the
+    corresponding recipes to the database in batches, so that the number
+    of queries doesn't scale with the number of patches and sources.
+    """
+    def __init__(self, layerbranch, existing, updateobj, reldir, pn_overwrite=False, batch_size=BULK_BATCH_SIZE):
+        self.layerbranch = layerbranch
+        self.existing = existing
+        self.updateobj = updateobj
+        self.reldir = reldir
+        self.pn_overwrite = pn_overwrite
+        self.batch_size = batch_size
+        self.pending = []
+        self.pending_keys = set()
+        self.recipes = []
+
+    def add(self, specfile, data, error=None):
+        key = get_spec_key(specfile, self.reldir, self.pn_overwrite)
+        if key in self.pending_keys:
+            # Two spec files for the same recipe; the first needs to be
+            # written before we look up the recipe for the second
+            self.flush()
+        self.pending.append((specfile, data, error))
+        self.pending_keys.add(key)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        from layerindex.models import ClassicRecipe
+
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.pending_keys = set()
+
+        recipeqs = ClassicRecipe.objects.filter(layerbranch=self.layerbranch)
+        keys = [get_spec_key(specfile, self.reldir, self.pn_overwrite) for specfile, _, _ in pending]
+        if self.pn_overwrite:
+            recipeqs = recipeqs.filter(pn__in=keys)
+            keyfunc = lambda recipe: recipe.pn
+        else:
+            recipeqs = recipeqs.filter(filename__in=[specfn for _, specfn in keys])
+            keyfunc = lambda recipe: (recipe.filepath, recipe.filename)
+        recipemap = {}
+        for recipe in recipeqs.order_by('id'):
+            recipemap.setdefault(keyfunc(recipe), recipe)
+
+        items = []
+        recipes = []
+        for key, (specfile, data, error) in zip(keys, pending):
+            specfn = os.path.basename(specfile)
+            specpath = os.path.relpath(os.path.dirname(specfile), self.reldir)
+            recipe = recipemap.get(key, None)
+            if not recipe:
+                logger.info('Importing %s' % specfn)
+                recipe = ClassicRecipe(layerbranch=self.layerbranch)
+            elif recipe.deleted:
+                logger.info('Restoring and updating %s' % specpath)
+                recipe.deleted = False
+            else:
+                logger.info('Updating %s' % specpath)
+            recipe.filename = specfn
+            recipe.filepath = specpath
+            recipe.pn = os.path.splitext(specfn)[0]
+            if data:
+                apply_spec_data(recipe, data)
+                items.append((recipe, data))
+            else:
+                if not recipe.pn:
+                    recipe.pn = recipe.filename[:-3].split('_')[0]
+                logger.error("Unable to read %s: %s", specfile, error)
+                recipe.save()
+            recipes.append(recipe)
+            self.existing.discard((specpath, specfn))
+        write_spec_recipes(items)
+
+        record_recipe_updates(self.updateobj, [recipe.id for recipe in recipes])
+        self.recipes.extend(recipes)
+
+
+def import_specdir(metapath, layerbranch, existing, updateobj, pwriter, pn_overwrite=False, jobs=1, force=False):
     dirlist = os.listdir(metapath)
-    total = len(dirlist)
-    speccount = 0
-    for count, entry in enumerate(dirlist):
+    specfiles = []
+    for entry in dirlist:
         if os.path.exists(os.path.join(metapath, entry, 'dead.package')):
             logger.info('Skipping dead package %s' % entry)
             continue
-        specfiles = glob.glob(os.path.join(metapath, entry, '*.spec'))
-        if specfiles:
-            import_specfiles(specfiles, layerbranch, existing, updateobj, metapath, pn_overwrite=pn_overwrite)
-            speccount += len(specfiles)
+        entryspecs = glob.glob(os.path.join(metapath, entry, '*.spec'))
+        if entryspecs:
+            specfiles.extend(entryspecs)
         else:
             logger.warn('Missing spec file in %s' % os.path.join(metapath, entry))
+
+    speccount = len(specfiles)
+    if not force:
+        # Most spec files don't change from one import to the next, and
+        # for those there's nothing to parse or write
+        checker = SpecChangeChecker(layerbranch, metapath, pn_overwrite=pn_overwrite)
+        changed = []
+        for specfile in specfiles:
+            if checker.is_unchanged(specfile):
+                logger.debug('Skipping unchanged %s' % specfile)
+                existing.discard((os.path.relpath(os.path.dirname(specfile), metapath), os.path.basename(specfile)))
+            else:
+                changed.append(specfile)
+        if len(changed) < speccount:
+            logger.info('Skipping %d unchanged spec files' % (speccount - len(changed)))
+        specfiles = changed
+
+    # Parsing is the expensive part, so do that in parallel and write the
+    # results as they come back (in order)
+    writer = SpecRecipeWriter(layerbranch, existing, updateobj, metapath, pn_overwrite=pn_overwrite)
+    total = len(specfiles)
+    for count, (specfile, (data, error)) in enumerate(zip(specfiles, parse_spec_files(specfiles, metapath, jobs))):
+        writer.add(specfile, data, error)
         if pwriter:
             pwriter.write(int(count / total * 100))
+    writer.flush()
     return speccount
 
 
-def import_specfiles(specfiles, layerbranch, existing, updateobj, reldir, pn_overwrite=False):
-    from layerindex.models import ClassicRecipe, ComparisonRecipeUpdate
-    recipes = []
-    for specfile in specfiles:
-        specfn = os.path.basename(specfile)
-        specpath = os.path.relpath(os.path.dirname(specfile), reldir)
-        if pn_overwrite:
-            recipe, created = ClassicRecipe.objects.get_or_create(layerbranch=layerbranch, pn=os.path.splitext(specfn)[0])
-            recipe.filepath = specpath
-            recipe.filename = specfn
-        else:
-            recipe, created = ClassicRecipe.objects.get_or_create(layerbranch=layerbranch, filepath=specpath, filename=specfn)
-        if created:
-            logger.info('Importing %s' % specfn)
-        elif recipe.deleted:
-            logger.info('Restoring and updating %s' % specpath)
-            recipe.deleted = False
-        else:
-            logger.info('Updating %s' % specpath)
-        recipe.layerbranch = layerbranch
-        recipe.filename = specfn
-        recipe.filepath = specpath
-        update_recipe_file(specfile, recipe, reldir)
-        recipe.save()
-        existingentry = (specpath, specfn)
-        if existingentry in existing:
-            existing.remove(existingentry)
-        if updateobj:
-            rupdate, _ = ComparisonRecipeUpdate.objects.get_or_create(update=updateobj, recipe=recipe)
-            rupdate.meta_updated = True
-            rupdate.save()
-        recipes.append(recipe)
-    return recipes
+def _extract_srpm_job(job):
+    # Extract a source RPM and parse the spec file(s) within it, for
+    # running in a process pool
+    srpm, srpmextpath, reldir = job
+    try:
+        shutil.rmtree(srpmextpath)
+    except FileNotFoundError:
+        pass
+    os.makedirs(srpmextpath)
+    try:
+        rpmfile.extract_rpm(srpm, srpmextpath)
+    except rpmfile.UnsupportedPayloadError as e:
+        # Much slower, so make sure this gets noticed
+        logger.warning('Using rpm2cpio to extract %s: %s' % (srpm, str(e)))
+        cmd = 'rpm2cpio %s | cpio -idm' % shlex.quote(srpm)
+        subprocess.check_output(cmd, shell=True, cwd=srpmextpath, stderr=subprocess.STDOUT)
+    specfiles = glob.glob(os.path.join(srpmextpath, '*.spec'))
+    return [(specfile, _parse_spec_job((specfile, reldir))) for specfile in specfiles]
 
 
 def import_pkgspec(args):
     utils.setup_django()
     import settings
-    from layerindex.models import LayerItem, LayerBranch, Recipe, ClassicRecipe, Machine, BBAppend, BBClass, ComparisonRecipeUpdate
+    from layerindex.models import LayerItem, LayerBranch, Recipe, ClassicRecipe, Machine, BBAppend, BBClass
     from django.db import transaction
 
     ret, layerbranch = check_branch_layer(args)
@@ -537,8 +905,8 @@ def import_pkgspec(args):
     try:
         with transaction.atomic():
             layerrecipes = ClassicRecipe.objects.filter(layerbranch=layerbranch)
-            existing = list(layerrecipes.filter(deleted=False).values_list('filepath', 'filename'))
-            count = import_specdir(metapath, layerbranch, existing, updateobj, pwriter)
+            existing = set(layerrecipes.filter(deleted=False).values_list('filepath', 'filename'))
+            count = import_specdir(metapath, layerbranch, existing, updateobj, pwriter, jobs=args.jobs or int(settings.PARALLEL_JOBS), force=args.force)
 
             if count == 0:
                 logger.error('No spec files found in directory %s' % metapath)
@@ -550,8 +918,7 @@ def import_pkgspec(args):
             if existing:
                 fpaths = sorted(['%s/%s' % (pth, fn) for pth, fn in existing])
                 logger.info('Marking as deleted:\n  %s' % '\n  '.join(fpaths))
-                for entry in existing:
-                    layerrecipes.filter(filepath=entry[0], filename=entry[1]).update(deleted=True)
+                mark_recipes_deleted(layerrecipes, existing)
 
             if args.description:
                 logger.debug('Setting description to "%s"' % args.description)
@@ -562,6 +929,7 @@ def import_pkgspec(args):
                 layer.summary = args.description
                 layer.save()
 
+            layerbranch.update_fingerprint()
             layerbranch.vcs_last_fetch = datetime.now()
             layerbranch.save()
 
@@ -636,40 +1004,29 @@ def import_deblist(args):
     try:
         with transaction.atomic():
             layerrecipes = ClassicRecipe.objects.filter(layerbranch=layerbranch)
-            existing = list(layerrecipes.filter(deleted=False).values_list('pn', flat=True))
+            existing = set(layerrecipes.filter(deleted=False).values_list('pn', flat=True))
+
+            pkgs = []
 
             def handle_pkg(pkg):
                 pkgname = pkg['Package']
-                recipe, created = ClassicRecipe.objects.get_or_create(layerbranch=layerbranch, pn=pkgname)
-                if created:
-                    logger.info('Importing %s' % pkgname)
-                elif recipe.deleted:
-                    logger.info('Restoring and updating %s' % pkgname)
-                    recipe.deleted = False
-                else:
-                    logger.info('Updating %s' % pkgname)
+                fields = {}
                 filename = pkg.get('Filename', '')
                 if filename:
-                    recipe.filename = os.path.basename(filename)
-                    recipe.filepath = os.path.dirname(filename)
-                recipe.section = pkg.get('Section', '')
+                    fields['filename'] = os.path.basename(filename)
+                    fields['filepath'] = os.path.dirname(filename)
+                fields['section'] = pkg.get('Section', '')
                 description = pkg.get('Description', '')
                 if description:
                     description = description.splitlines()
-                    recipe.summary = description.pop(0)
-                    recipe.description = ' '.join(description)
-                recipe.pv = pkg.get('Version', '')
-                recipe.homepage = pkg.get('Homepage', '')
-                recipe.license = pkg.get('License', '')
-                recipe.save()
-                if pkgname in existing:
-                    existing.remove(pkgname)
-                if updateobj:
-                    rupdate, _ = ComparisonRecipeUpdate.objects.get_or_create(update=updateobj, recipe=recipe)
-                    rupdate.meta_updated = True
-                    rupdate.save()
+                    fields['summary'] = description.pop(0)
+                    fields['description'] = ' '.join(description)
+                fields['pv'] = pkg.get('Version', '')
+                fields['homepage'] = pkg.get('Homepage', '')
+                fields['license'] = pkg.get('License', '')
+                pkgs.append((pkgname, fields, pkgname))
+                existing.discard(pkgname)
 
-            pkgs = []
             pkginfo = {}
             lastfield = ''
             with open(args.pkglistfile, 'r') as f:
@@ -696,10 +1053,14 @@ def import_deblist(args):
                     # Handle last package
                     handle_pkg(pkginfo)
 
+                write_package_recipes(layerbranch, pkgs, updateobj)
+
                 if existing:
-                    logger.info('Marking as deleted: %s' % ', '.join(existing))
-                    layerrecipes.filter(pn__in=existing).update(deleted=True)
+                    logger.info('Marking as deleted: %s' % ', '.join(sorted(existing)))
+                    for batch in _chunks(existing, BULK_BATCH_SIZE):
+                        layerrecipes.filter(pn__in=batch).update(deleted=True)
 
+                layerbranch.update_fingerprint()
                 layerbranch.vcs_last_fetch = datetime.now()
                 layerbranch.save()
 
@@ -716,7 +1077,7 @@ def import_deblist(args):
 def import_clearderiv(args):
     utils.setup_django()
     import settings
-    from layerindex.models import LayerItem, LayerBranch, Recipe, ClassicRecipe, Machine, BBAppend, BBClass, ComparisonRecipeUpdate
+    from layerindex.models import LayerItem, LayerBranch, Recipe, ClassicRecipe, Machine, BBAppend, BBClass
     from django.db import transaction
 
     ret, layerbranch = check_branch_layer(args)
@@ -746,10 +1107,10 @@ def import_clearderiv(args):
             layerrecipes = ClassicRecipe.objects.filter(layerbranch=layerbranch)
             layerrecipes.filter(deleted=True).delete()
 
-            existing = list(layerrecipes.filter(deleted=False).values_list('filepath', 'filename'))
+            existing = set(layerrecipes.filter(deleted=False).values_list('filepath', 'filename'))
 
             logger.info('Importing original packages')
-            import_specdir(args.pkgdir, layerbranch, existing, updateobj, pwriter, pn_overwrite=True)
+            import_specdir(args.pkgdir, layerbranch, existing, updateobj, pwriter, pn_overwrite=True, jobs=args.jobs or int(settings.PARALLEL_JOBS), force=args.force)
 
             srpmpath = os.path.join(srcpath, 'src', 'src-rpms')
             srpms = []
@@ -764,20 +1125,14 @@ def import_clearderiv(args):
 
                 # We assume it's OK to put stuff in the package source directory
                 extpath = args.pkgdir
-                for srpm in srpms:
-                    srpmextpath = os.path.join(extpath, os.path.basename(srpm).rsplit('.', 2)[0])
-                    try:
-                        shutil.rmtree(srpmextpath)
-                    except FileNotFoundError:
-                        pass
-                    os.makedirs(srpmextpath)
-                    cmd = 'rpm2cpio %s | cpio -idmv' % shlex.quote(srpm)
-                    output = subprocess.check_output(cmd, shell=True, cwd=srpmextpath).decode('utf-8').rstrip()
-
-                    specfiles = glob.glob(os.path.join(srpmextpath, '*.spec'))
-                    recipes = import_specfiles(specfiles, layerbranch, existing, updateobj, extpath, pn_overwrite=True)
-                    for recipe in recipes:
-                        specpns.append(recipe.pn)
+                jobargs = [(srpm, os.path.join(extpath, os.path.basename(srpm).rsplit('.', 2)[0]), extpath) for srpm in srpms]
+                # Extract and parse in parallel, writing the recipes as they come back
+                writer = SpecRecipeWriter(layerbranch, existing, updateobj, extpath, pn_overwrite=True)
+                for results in _run_jobs(_extract_srpm_job, jobargs, args.jobs or int(settings.PARALLEL_JOBS)):
+                    for specfile, (data, error) in results:
+                        writer.add(specfile, data, error)
+                writer.flush()
+                specpns = [recipe.pn for recipe in writer.recipes]
 
             rpms = []
             for root, dirs, files in os.walk(localrpmpath):
@@ -789,75 +1144,56 @@ def import_clearderiv(args):
             logger.info('Importing derivative binary RPMs')
             srpminfo = {}
             total = len(rpms)
-            for count, rpm in enumerate(rpms):
-                logger.debug('Processing %s' % rpm) 
-                cmd = ['rpm', '-qpi', rpm]
-                expanded = subprocess.check_output(cmd).decode('utf-8').rstrip()
-                description = []
-                indesc = False
-                rpminfo = {'Package': rpm}
-                for line in expanded.splitlines():
-                    if indesc:
-                        description.append(line)
-                    elif ':' in line:
-                        linesplit = line.split(':', 1)
-                        key = linesplit[0].rstrip()
-                        value = linesplit[1].strip()
-                        if key == 'Description':
-                            indesc = True
+            # Reading the headers is I/O bound, so threads will do
+            with multiprocessing.pool.ThreadPool(args.jobs or int(settings.PARALLEL_JOBS)) as pool:
+                rpmheaders = pool.imap(rpmfile.read_rpm_info, rpms, chunksize=PARSE_CHUNK_SIZE)
+                for count, (rpm, headerinfo) in enumerate(zip(rpms, rpmheaders)):
+                    logger.debug('Processing %s' % rpm)
+                    rpminfo = {'Package': rpm}
+                    for key, value in headerinfo.items():
+                        rpminfo[key] = value.strip()
+                    rpminfo['Description'] = ' '.join(headerinfo.get('Description', '').rstrip().splitlines())
+                    srpm = rpminfo['Source RPM']
+                    if srpm in srpminfo:
+                        if len(rpminfo['Name']) < len(srpminfo[srpm]['Name']):
+                            srpminfo[srpm] = rpminfo.copy()
                         else:
-                            rpminfo[key] = value
-                rpminfo['Description'] = ' '.join(description)
-                srpm = rpminfo['Source RPM']
-                if srpm in srpminfo:
-                    if len(rpminfo['Name']) < len(srpminfo[srpm]['Name']):
-                        srpminfo[srpm] = rpminfo.copy()
+                            logger.debug('Skipping %s (main package already present)' % rpm)
                     else:
-                        logger.debug('Skipping %s (main package already present)' % rpm) 
-                else:
-                    srpminfo[srpm] = rpminfo.copy()
+                        srpminfo[srpm] = rpminfo.copy()
 
-                if pwriter:
-                    pwriter.write(int(count / total * 100))
+                    if pwriter:
+                        pwriter.write(int(count / total * 100))
 
             srcsrcpath = os.path.join(srcpath, 'src')
+            specpns = set(specpns)
+            pkgs = []
             for vals in srpminfo.values():
                 pkgfn = os.path.basename(vals['Package'])
                 pkgpath = os.path.relpath(os.path.dirname(vals['Package']), srcsrcpath)
                 if vals['Name'] in specpns:
                     logger.info('Skipping %s (already imported source)' % pkgfn)
                     continue
-                recipe, created = ClassicRecipe.objects.get_or_create(layerbranch=layerbranch, pn=vals['Name'])
-                if created:
-                    logger.info('Importing %s' % pkgfn)
-                else:
-                    logger.info('Updating %s' % pkgfn)
-                recipe.filepath = pkgpath
-                recipe.filename = pkgfn
-                recipe.pn = vals['Name']
-                recipe.pv = vals['Version']
-                recipe.section = vals['Group']
-                recipe.license = vals['License']
-                recipe.summary = vals['Summary']
-                recipe.description = vals['Description']
-                recipe.homepage = vals.get('URL', '')
-                recipe.deleted = False
-                recipe.save()
-
-                existingentry = (pkgpath, pkgfn)
-                if existingentry in existing:
-                    existing.remove(existingentry)
-                if updateobj:
-                    rupdate, _ = ComparisonRecipeUpdate.objects.get_or_create(update=updateobj, recipe=recipe)
-                    rupdate.meta_updated = True
-                    rupdate.save()
+                fields = {
+                    'filepath': pkgpath,
+                    'filename': pkgfn,
+                    'pv': vals['Version'],
+                    'section': vals['Group'],
+                    'license': vals['License'],
+                    'summary': vals['Summary'],
+                    'description': vals['Description'],
+                    'homepage': vals.get('URL', ''),
+                }
+                pkgs.append((vals['Name'], fields, pkgfn))
+                existing.discard((pkgpath, pkgfn))
+            write_package_recipes(layerbranch, pkgs, updateobj)
 
             if existing:
                 fpaths = sorted(['%s/%s' % (pth, fn) for pth, fn in existing])
                 logger.info('Marking as deleted:\n  %s' % '\n  '.join(fpaths))
-                for entry in existing:
-                    layerrecipes.filter(filepath=entry[0], filename=entry[1]).update(deleted=True)
+                mark_recipes_deleted(layerrecipes, existing)
 
+            layerbranch.update_fingerprint()
             layerbranch.vcs_last_fetch = datetime.now()
             layerbranch.save()
 
@@ -903,6 +1239,8 @@ def main():
     parser_pkgspec.add_argument('--relative-path', help='Top level directory to set layerbranch path relative to')
     parser_pkgspec.add_argument('-u', '--update', help='Specify update record to link to')
     parser_pkgspec.add_argument('-n', '--dry-run', help='Don\'t write any data back to the database', action='store_true')
+    parser_pkgspec.add_argument('-j', '--jobs', type=int, help='Number of spec files to parse in parallel (default PARALLEL_JOBS setting)')
+    parser_pkgspec.add_argument('--force', help='Parse all spec files, even those that have not changed since the last import', action='store_true')
     parser_pkgspec.set_defaults(func=import_pkgspec)
 
 
@@ -937,6 +1275,8 @@ def main():
     parser_clearderiv.add_argument('--relative-path', help='Top level directory to set layerbranch path relative to')
     parser_clearderiv.add_argument('-u', '--update', help='Specify update record to link to')
     parser_clearderiv.add_argument('-n', '--dry-run', help='Don\'t write any data back to the database', action='store_true')
+    parser_clearderiv.add_argument('-j', '--jobs', type=int, help='Number of spec files and RPMs to process in parallel (default PARALLEL_JOBS setting)')
+    parser_clearderiv.add_argument('--force', help='Parse all spec files, even those that have not changed since the last import', action='store_true')
     parser_clearderiv.set_defaults(func=import_clearderiv)
 
 
@@ -18,6 +18,7 @@ import shutil
 import codecs
 import re
 import math
+import threading
 from datetime import datetime
 from bs4 import BeautifulSoup
 
@@ -481,6 +482,43 @@ def sha256_file(ifn):
             shash.update(line)
     return shash.hexdigest()
 
+def recipe_fingerprint(sha256sum, patches, sources):
+    """
+    Calculate a fingerprint of the content of a recipe (as opposed to
+    its metadata), such that two recipes with the same fingerprint would
+    not be considered modified with respect to each other. patches is an
+    iterable of (src_path, applied, sha256sum) in apply order, and sources
+    an iterable of (url, sha256sum).
+    """
+    import hashlib
+    applied_paths = set()
+    patch_checksums = {}
+    for src_path, applied, patch_sha256sum in patches:
+        if applied:
+            applied_paths.add(src_path)
+        patch_checksums.setdefault(src_path, patch_sha256sum)
+    source_checksums = {}
+    for url, source_sha256sum in sources:
+        source_checksums.setdefault(url, source_sha256sum)
+    shash = hashlib.sha256()
+    shash.update(('R %s\n' % sha256sum).encode('utf-8'))
+    for src_path in sorted(applied_paths):
+        shash.update(('P %s %s\n' % (src_path, patch_checksums[src_path])).encode('utf-8'))
+    for url in sorted(source_checksums):
+        shash.update(('S %s %s\n' % (url, source_checksums[url])).encode('utf-8'))
+    return shash.hexdigest()
+
+def layerbranch_fingerprint(recipes):
+    """
+    Calculate a fingerprint over a set of recipe fingerprints, given an
+    iterable of (pn, pv, recipe fingerprint) for each recipe
+    """
+    import hashlib
+    shash = hashlib.sha256()
+    for pn, pv, fingerprint in sorted(recipes):
+        shash.update(('%s %s %s\n' % (pn, pv, fingerprint)).encode('utf-8'))
+    return shash.hexdigest()
+
 def human_filesize(numbytes):
     if numbytes == 0:
         return '0 B'
@@ -565,6 +603,93 @@ class ProgressReader():
                 self.logger.warning('Failed to read progress: %s' % str(e))
         return result
 
+def get_notify_path(logdir, key):
+    return os.path.join(logdir, '%s.notify' % key)
+
+def notify_change(logdir, key, logger=None):
+    """
+    Wake up any requests blocked in wait_for_change() on the notify file
+    for the specified key (e.g. because a task's state has changed)
+    """
+    fn = get_notify_path(logdir, key)
+    try:
+        os.makedirs(logdir, exist_ok=True)
+        with open(fn + '.temp', 'w') as f:
+            f.write(str(time.time()))
+        os.rename(fn + '.temp', fn)
+    except Exception as e:
+        if logger is not None:
+            logger.warning('Failed to write to notify file %s: %s' % (fn, str(e)))
+
+def file_state(paths):
+    """
+    Get a snapshot of the state of the specified files, for passing to
+    wait_for_change()
+    """
+    state = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            state.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            state.append(None)
+    return state
+
+# Number of requests in this process currently blocked in wait_for_change()
+_change_waiters = 0
+_change_waiters_lock = threading.Lock()
+
+def wait_for_change(paths, timeout, initial_state=None, interval=0.25, max_waiters=0):
+    """
+    Block until any of the specified files is created, changed or replaced
+    relative to initial_state (as returned by file_state(), which should
+    be obtained *before* checking whatever the files signal in order to
+    avoid missing a change), or the timeout in seconds expires. Only
+    stats the files, but each waiting request still occupies a web server
+    thread; if max_waiters is non-zero and that many requests in this
+    process are already waiting, returns None immediately (the caller
+    should then tell the client to back off before asking again).
+    Returns True if something changed, False on timeout.
+    """
+    global _change_waiters
+    if initial_state is None:
+        initial_state = file_state(paths)
+    with _change_waiters_lock:
+        if max_waiters and _change_waiters >= max_waiters:
+            return None
+        _change_waiters += 1
+    try:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if file_state(paths) != initial_state:
+                return True
+            time.sleep(interval)
+        return file_state(paths) != initial_state
+    finally:
+        with _change_waiters_lock:
+            _change_waiters -= 1
+
+class CoverIndex():
+    """
+    Maps (cover layer name, cover PN) onto the ClassicRecipe covering it
+    on a comparison branch, loaded up-front with a single query so that
+    many lookups can be done without going back to the database.
+    """
+    def __init__(self, branch):
+        from layerindex.models import ClassicRecipe
+        self.index = {}
+        qs = ClassicRecipe.objects.filter(layerbranch__branch=branch).exclude(cover_layerbranch__isnull=True).exclude(cover_pn='')
+        qs = qs.select_related('layerbranch', 'cover_layerbranch__layer').order_by('id')
+        for recipe in qs:
+            # Same result as .first() on the equivalent query
+            self.index.setdefault((recipe.cover_layerbranch.layer.name, recipe.cover_pn), recipe)
+
+    def get(self, layername, pn):
+        """
+        Return the ClassicRecipe covering the specified recipe, or None
+        """
+        return self.index.get((layername, pn), None)
+
 def string_to_query(querystr, fieldnames):
     # Inspired by http://julienphalip.com/post/2825034077/adding-search-to-a-django-site-in-a-snap
     # (reimplemented a bit more simply)
@@ -945,7 +945,7 @@ class EditProfileFormView(SuccessMessageMixin, UpdateView):
 
 @receiver(pre_save, sender=reversion.models.Version)
 def annotate_revision_version(sender, instance, *args, **kwargs):
-    ignorefields = ['vcs_last_rev', 'vcs_last_fetch', 'vcs_last_commit', 'updated']
+    ignorefields = ['vcs_last_rev', 'vcs_last_fetch', 'vcs_last_commit', 'updated', 'fingerprint']
     changelist = []
     objclass = instance.content_type.model_class()
     currentVersion = instance.field_dict
@@ -1544,8 +1544,25 @@ def task_log_view(request, task_id):
 
     result = AsyncResult(task_id)
     start = int(request.GET.get('start', 0))
+    logfile = os.path.join(settings.TASK_LOG_DIR, 'task_%s.log' % task_id)
+    changed = False
+    poll_delay = 0
+    if request.GET.get('wait', ''):
+        # Long poll - hold the request until there's more log output, the
+        # progress changes or the task finishes (or we time out). Note that the
+        # snapshot needs to be taken before we check anything it guards.
+        paths = [logfile,
+                 os.path.join(settings.TASK_LOG_DIR, '%s.progress' % task_id),
+                 utils.get_notify_path(settings.TASK_LOG_DIR, 'task_%s' % task_id)]
+        state = utils.file_state(paths)
+        if state[0] and state[0][2] <= start and not Update.objects.filter(task_id=task_id, finished__isnull=False).exists():
+            changed = utils.wait_for_change(paths, getattr(settings, 'TASK_LONG_POLL_TIMEOUT', 10), state,
+                                            max_waiters=getattr(settings, 'TASK_LONG_POLL_MAX_WAITERS', 0))
+            if changed is None:
+                # Too many requests waiting already
+                poll_delay = getattr(settings, 'TASK_LONG_POLL_BUSY_DELAY', 3)
     try:
-        f = open(os.path.join(settings.TASK_LOG_DIR, 'task_%s.log' % task_id), 'rb')
+        f = open(logfile, 'rb')
     except FileNotFoundError:
         raise Http404
     try:
@@ -1556,18 +1573,30 @@ def task_log_view(request, task_id):
         origlen = len(datastr)
         data = escape(datastr)
         response = HttpResponse(data)
-        try:
-            ready = result.ready()
-        except ConnectionResetError:
-            # FIXME this shouldn't be happening so often, but ultimately we don't care -
-            # the frontend is polling so it'll likely succeed in a subsequent request
+        updateobj = Update.objects.filter(task_id=task_id).first()
+        if updateobj and updateobj.finished:
+            ready = True
+        elif changed:
+            # We just saw the task do something, so it's still running
             ready = False
+        else:
+            # The task records its completion in the Update object, but if the
+            # worker died without doing so we can still find out from celery
+            try:
+                ready = result.ready()
+            except ConnectionResetError:
+                # FIXME this shouldn't be happening so often, but ultimately we don't care -
+                # the frontend is polling so it'll likely succeed in a subsequent request
+                ready = False
         if ready:
             response['Task-Done'] = '1'
-            updateobj = get_object_or_404(Update, task_id=task_id)
+            if not updateobj:
+                raise Http404
             response['Task-Duration'] = utils.timesince2(updateobj.started, updateobj.finished)
             response['Task-Progress'] = 100
-            if result.info:
+            if updateobj.finished:
+                response['Task-Result'] = updateobj.retcode
+            elif result.info:
                 if isinstance(result.info, dict):
                     response['Task-Result'] = result.info.get('retcode', None)
                 else:
@@ -1577,6 +1606,8 @@ def task_log_view(request, task_id):
             preader = utils.ProgressReader(settings.TASK_LOG_DIR, task_id)
             response['Task-Progress'] = preader.read()
         response['Task-Log-Position'] = start + origlen
+        if poll_delay:
+            response['X-Poll-Delay'] = poll_delay
     finally:
         f.close()
     return response
@@ -0,0 +1,152 @@
+# layerindex-web - tests for artifact cache
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: these tests use a local HTTP server standing in for the real one,
+# so they don't need network access (or the database)
+
+import sys
+import os
+import hashlib
+import threading
+import http.server
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basepath)
+
+from layerindex import artifactcache
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.path.endswith('.missing'):
+            self.send_error(404)
+            return
+        etag = '"%s"' % hashlib.sha256(server.content).hexdigest()[:16]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        rangehdr = self.headers.get('Range', '')
+        if rangehdr and self.headers.get('If-Range') == etag:
+            start = int(rangehdr.split('=')[1].split('-')[0])
+        body = server.content[start:]
+        if start:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(server.content) - 1, len(server.content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.fail_after is not None:
+            # Simulate the connection dropping part way through
+            body = body[:server.fail_after]
+            server.fail_after = None
+            self.wfile.write(body)
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        server.bytes_sent += len(body)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def standin():
+    server = http.server.HTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.content = os.urandom(300000)
+    server.requests = []
+    server.bytes_sent = 0
+    server.fail_after = None
+    server.url = 'http://127.0.0.1:%d/derivative.tar.gz' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_conditional(standin, tmpdir):
+    cache = artifactcache.ArtifactCache(str(tmpdir))
+    path = cache.fetch(standin.url)
+    assert read_file(path) == standin.content
+    assert os.path.basename(path) == hashlib.sha256(standin.content).hexdigest()
+    assert standin.bytes_sent == len(standin.content)
+
+    # Fetching again should just check that nothing has changed
+    assert cache.fetch(standin.url) == path
+    assert 'If-None-Match' in standin.requests[-1]
+    assert standin.bytes_sent == len(standin.content)
+
+    # If it has changed, we should get the new content
+    standin.content = os.urandom(1000)
+    newpath = cache.fetch(standin.url)
+    assert newpath != path
+    assert read_file(newpath) == standin.content
+    assert cache.lookup(standin.url) == newpath
+
+
+def test_fetch_checksum(standin, tmpdir):
+    cache = artifactcache.ArtifactCache(str(tmpdir))
+    sha256sum = hashlib.sha256(standin.content).hexdigest()
+    path = cache.fetch(standin.url, sha256sum=sha256sum)
+    assert read_file(path) == standin.content
+
+    # No request at all if we already have the content
+    requests = len(standin.requests)
+    assert cache.fetch(standin.url, sha256sum=sha256sum.upper()) == path
+    assert len(standin.requests) == requests
+
+    # Corrupted content in the cache should be fetched again
+    with open(path, 'wb') as f:
+        f.write(b'corrupted')
+    assert read_file(cache.fetch(standin.url, sha256sum=sha256sum)) == standin.content
+    assert len(standin.requests) == requests + 1
+
+
+def test_fetch_checksum_mismatch(standin, tmpdir):
+    cache = artifactcache.ArtifactCache(str(tmpdir))
+    with pytest.raises(artifactcache.FetchError):
+        cache.fetch(standin.url, sha256sum='0' * 64)
+    assert cache.lookup(standin.url) is None
+
+
+def test_fetch_resume(standin, tmpdir):
+    # Without retries, the failure is reported but what we got is kept
+    cache = artifactcache.ArtifactCache(str(tmpdir), retries=0)
+    standin.fail_after = 100000
+    with pytest.raises(artifactcache.FetchError):
+        cache.fetch(standin.url)
+    path = cache.fetch(standin.url)
+    assert read_file(path) == standin.content
+    assert standin.requests[-1].get('Range') == 'bytes=100000-'
+    assert standin.bytes_sent == len(standin.content) - 100000
+
+    # With retries, it should resume within the same call
+    cache = artifactcache.ArtifactCache(str(tmpdir.join('retry')), retry_delay=0)
+    standin.fail_after = 5000
+    assert read_file(cache.fetch(standin.url)) == standin.content
+    assert standin.requests[-1].get('Range') == 'bytes=5000-'
+
+
+def test_fetch_not_found(standin, tmpdir):
+    cache = artifactcache.ArtifactCache(str(tmpdir))
+    with pytest.raises(artifactcache.FetchError):
+        cache.fetch(standin.url + '.missing')
+    # Client errors shouldn't be retried
+    assert len(standin.requests) == 1
@@ -0,0 +1,240 @@
+# layerindex-web - tests for directory diff engine
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: these tests don't need the database
+
+import sys
+import os
+import gzip
+import json
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basepath)
+
+from dissector import diff
+
+
+def write_tree(path, files):
+    for relpath, content in files.items():
+        fpath = os.path.join(path, relpath)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with open(fpath, 'wb') as f:
+            f.write(content)
+
+
+def lines_of(prefix, count):
+    return b''.join(b'%s line %d\n' % (prefix, i) for i in range(count))
+
+
+@pytest.fixture
+def trees(tmpdir):
+    from_path = str(tmpdir.join('a'))
+    to_path = str(tmpdir.join('b'))
+    write_tree(from_path, {
+        'same.c': lines_of(b'same', 10),
+        'modified.c': lines_of(b'mod', 20),
+        'deleted.c': lines_of(b'gone', 5),
+        'moved/exact.txt': lines_of(b'exact', 30),
+        'similar.txt': lines_of(b'similar', 40),
+        'image.bin': b'\x89PNG\0\0\0' + os.urandom(100),
+    })
+    write_tree(to_path, {
+        'same.c': lines_of(b'same', 10),
+        'modified.c': lines_of(b'mod', 20).replace(b'mod line 12\n', b'changed\n') + b'extra\n',
+        'added.c': lines_of(b'new', 5),
+        'exact.txt': lines_of(b'exact', 30),
+        'renamed.txt': lines_of(b'similar', 40).replace(b'similar line 7\n', b'different\n'),
+        'image.bin': b'\x89PNG\0\0\0' + os.urandom(100),
+    })
+    return from_path, to_path
+
+
+def run_diff(tmpdir, from_path, to_path, compress=False, **kwargs):
+    dirdiff = diff.DirectoryDiff(from_path, to_path, from_label='a', to_label='b', **kwargs)
+    outfile = str(tmpdir.join('out.diff'))
+    indexfile = str(tmpdir.join('out.index.json'))
+    changed = dirdiff.write(outfile, compress=compress, indexfile=indexfile)
+    with open(outfile, 'rb') as f:
+        data = f.read()
+    with open(indexfile, 'r') as f:
+        index = json.load(f)
+    return dirdiff, changed, data, index
+
+
+def test_diff_statuses(tmpdir, trees):
+    _, changed, data, index = run_diff(tmpdir, *trees)
+    assert changed
+    statuses = dict((entry['path'], entry['status']) for entry in index['files'])
+    assert statuses == {
+        'added.c': 'A',
+        'deleted.c': 'D',
+        'exact.txt': 'R',
+        'image.bin': 'M',
+        'modified.c': 'M',
+        'renamed.txt': 'R',
+    }
+    assert not index['truncated']
+    assert b'diff --git a/a/same.c' not in data
+
+
+def test_diff_renames(tmpdir, trees):
+    _, _, data, _ = run_diff(tmpdir, *trees)
+    assert b'similarity index 100%\nrename from a/moved/exact.txt\nrename to b/exact.txt\n' in data
+    assert b'rename from a/similar.txt\nrename to b/renamed.txt\n' in data
+    assert b'-similar line 7\n+different\n' in data
+    # An exact rename has no content
+    exact = data[data.index(b'rename to b/exact.txt\n'):]
+    assert exact.split(b'\n', 1)[1].startswith(b'diff --git')
+
+
+def test_diff_no_identical_rename(tmpdir):
+    # Deleted and added files of the same size but different content
+    from_path = str(tmpdir.join('a'))
+    to_path = str(tmpdir.join('b'))
+    write_tree(from_path, {'one': b'\0' * 100})
+    write_tree(to_path, {'two': b'\1' * 100})
+    _, _, _, index = run_diff(tmpdir, from_path, to_path)
+    assert sorted((entry['path'], entry['status']) for entry in index['files']) == [('one', 'D'), ('two', 'A')]
+
+
+def test_diff_binary(tmpdir, trees):
+    _, _, data, index = run_diff(tmpdir, *trees)
+    entry = [entry for entry in index['files'] if entry['path'] == 'image.bin'][0]
+    filediff = data[entry['offset']:entry['offset'] + entry['length']]
+    assert filediff.startswith(b'diff --git a/a/image.bin b/b/image.bin\nindex ')
+    # Only the header, no content
+    assert filediff.count(b'\n') == 2
+    assert entry['added'] == 0 and entry['removed'] == 0
+
+
+def test_diff_index_offsets(tmpdir, trees):
+    _, _, data, index = run_diff(tmpdir, *trees)
+    offset = 0
+    for entry in index['files']:
+        assert entry['offset'] == offset
+        filediff = data[entry['offset']:entry['offset'] + entry['length']]
+        assert filediff.startswith(b'diff --git ')
+        assert b'diff --git ' not in filediff[1:]
+        assert filediff.split(b'\n')[0].endswith(b'/%s' % entry['path'].encode())
+        offset += entry['length']
+    assert offset == len(data)
+    modified = [entry for entry in index['files'] if entry['path'] == 'modified.c'][0]
+    assert modified['added'] == 2
+    assert modified['removed'] == 1
+
+
+def test_diff_index_offsets_compressed(tmpdir, trees):
+    _, _, uncompressed, _ = run_diff(tmpdir.mkdir('plain'), *trees)
+    _, _, data, index = run_diff(tmpdir, *trees, compress=True)
+    assert index['compressed']
+    # Each file can be decompressed on its own, and all of them together
+    # are the same as the uncompressed diff
+    parts = [gzip.decompress(data[entry['offset']:entry['offset'] + entry['length']]) for entry in index['files']]
+    assert b''.join(parts) == uncompressed
+    assert gzip.decompress(data) == uncompressed
+
+
+def test_diff_max_file_size(tmpdir, trees, monkeypatch):
+    from_path, to_path = trees
+    write_tree(from_path, {'big.txt': lines_of(b'big', 1000)})
+    write_tree(to_path, {'big.txt': lines_of(b'big', 1001)})
+    read_files = []
+    orig_read = diff.DiffFile.read
+    def record_read(self):
+        read_files.append(self.relpath)
+        return orig_read(self)
+    monkeypatch.setattr(diff.DiffFile, 'read', record_read)
+    _, _, data, index = run_diff(tmpdir, from_path, to_path, max_file_size=1000)
+    entry = [entry for entry in index['files'] if entry['path'] == 'big.txt'][0]
+    filediff = data[entry['offset']:entry['offset'] + entry['length']]
+    # Just the header, and the content is never loaded
+    assert filediff == b'diff --git a/a/big.txt b/b/big.txt\n'
+    assert 'big.txt' not in read_files
+    assert 'modified.c' in read_files
+
+
+def test_diff_max_size(tmpdir, trees):
+    _, _, full, fullindex = run_diff(tmpdir.mkdir('full'), *trees)
+    limit = fullindex['files'][2]['offset'] + fullindex['files'][2]['length']
+    dirdiff, changed, data, index = run_diff(tmpdir, *trees, max_size=limit + 1)
+    assert changed
+    assert dirdiff.truncated
+    assert index['truncated']
+    assert len(index['files']) == 3
+    assert data == full[:limit]
+
+
+def test_diff_files(tmpdir):
+    from_file = str(tmpdir.join('x.spec'))
+    to_file = str(tmpdir.join('y.spec'))
+    write_tree(str(tmpdir), {'x.spec': b'Version: 1\n', 'y.spec': b'Version: 2\n'})
+    _, changed, data, index = run_diff(tmpdir, from_file, to_file)
+    assert changed
+    assert data.startswith(b'diff --git a/a b/b\n')
+    assert b'-Version: 1\n+Version: 2\n' in data
+    _, changed, data, index = run_diff(tmpdir, from_file, from_file)
+    assert not changed
+    assert data == b''
+    assert index['files'] == []
+
+
+def test_cache_key(tmpdir, trees, monkeypatch):
+    from_path, to_path = trees
+    cache = diff.DiffCache(str(tmpdir.join('cache')))
+    dirdiff = diff.DirectoryDiff(from_path, to_path)
+    key = cache.get_key(from_path, to_path, dirdiff)
+    assert cache.tree_hash(from_path) == diff.tree_hash(from_path)
+
+    # Looking up the key again shouldn't need to read any files
+    hashed = []
+    orig_hash = diff.DiffFile._hash
+    def record_hash(self):
+        hashed.append(self.relpath)
+        return orig_hash(self)
+    monkeypatch.setattr(diff.DiffFile, '_hash', record_hash)
+    assert cache.get_key(from_path, to_path, dirdiff) == key
+    assert hashed == []
+
+    # Only changed files should be read again
+    write_tree(to_path, {'added.c': b'something else\n'})
+    newkey = cache.get_key(from_path, to_path, dirdiff)
+    assert newkey != key
+    assert hashed == ['added.c']
+    assert cache.tree_hash(to_path) == diff.tree_hash(to_path)
+
+    # Options affect the output, so they should affect the key
+    assert cache.get_key(from_path, to_path, diff.DirectoryDiff(from_path, to_path, max_size=100)) != newkey
+
+
+def test_diff_concurrent_writers(tmpdir, trees):
+    # Writers of the same output use their own temporary files, so one
+    # finishing can't publish (or remove) another's partial output
+    dirdiffs = [diff.DirectoryDiff(*trees), diff.DirectoryDiff(*trees)]
+    outfile = str(tmpdir.join('out.diff'))
+    indexfile = str(tmpdir.join('out.index.json'))
+    open(indexfile + '.temp', 'w').close()
+    for dirdiff in dirdiffs:
+        dirdiff.write(outfile, indexfile=indexfile)
+    assert sorted(os.listdir(str(tmpdir))) == ['a', 'b', 'out.diff', 'out.index.json', 'out.index.json.temp']
+    with open(indexfile, 'r') as f:
+        assert len(json.load(f)['files']) == 6
+
+
+def test_cache_evict_tree_hashes(tmpdir, trees):
+    from_path, to_path = trees
+    cachedir = str(tmpdir.join('cache'))
+    cache = diff.DiffCache(cachedir, max_size=1)
+    dirdiff = diff.DirectoryDiff(from_path, to_path)
+    key = cache.get_key(from_path, to_path, dirdiff)
+    assert len(os.listdir(os.path.join(cachedir, diff.TREES_DIR_NAME))) == 2
+    # The recorded tree hashes count towards the size of the cache and
+    # are evicted like anything else
+    path = cache.store(key, dirdiff)
+    assert os.listdir(os.path.join(cachedir, diff.TREES_DIR_NAME)) == []
+    assert os.path.exists(path)
+    # Evicting them just means they'll be recalculated
+    assert cache.get_key(from_path, to_path, dirdiff) == key
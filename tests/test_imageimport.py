@@ -0,0 +1,148 @@
+# layerindex-web - tests for image comparison import
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository
+
+import sys
+import os
+import hashlib
+import tempfile
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basepath)
+
+
+@pytest.fixture(autouse=True)
+def enable_db_access_for_all_tests(db):
+    pass
+
+
+@pytest.fixture
+def comparison():
+    from django.contrib.auth.models import User
+    from layerindex.models import Branch
+    from dissector.models import ImageComparison
+    user = User.objects.create(username='imageuser')
+    from_branch = Branch.objects.create(name='image-test', bitbake_branch='-', comparison=True)
+    to_branch = Branch.objects.create(name='distro-test', bitbake_branch='-', comparison=True)
+    return ImageComparison.objects.create(user=user, name='test', from_branch=from_branch, to_branch=to_branch)
+
+
+def make_layerbranch(comparison, name):
+    from layerindex.models import LayerItem, LayerBranch
+    layer = LayerItem.objects.create(name=name, summary='N/A', description='N/A', vcs_url='-', comparison=True)
+    return LayerBranch.objects.create(layer=layer, branch=comparison.from_branch, local_path=str(comparison.id))
+
+
+def add_recipes(writer, comparison, layerbranch, count, prefix):
+    from layerindex.models import Source, Patch
+    from dissector.models import ImageComparisonRecipe
+    for i in range(count):
+        pn = '%s%d' % (prefix, i)
+        recipe = ImageComparisonRecipe(comparison=comparison, layerbranch=layerbranch, pn=pn, pv='1.%d' % i,
+                                       filepath='recipes-%s' % pn, filename='%s_1.%d.bb' % (pn, i), sha256sum=pn)
+        sources = [Source(url='http://example.com/%s.tar.gz' % pn, sha256sum='s')]
+        patches = [Patch(path='files/%s.patch' % pn, src_path='%s.patch' % pn, applied=True, sha256sum='p')]
+        writer.add(recipe, sources, patches, 'zlib %s-native' % pn, {'feature': 'w,wo,lib%s' % pn})
+
+
+@pytest.mark.parametrize('returns_ids', [True, False], ids=['returned-ids', 'recovered-ids'])
+def test_write_recipes(comparison, monkeypatch, returns_ids):
+    from django.db import connection
+    from layerindex.models import Recipe
+    from dissector.models import ImageComparisonRecipe
+    from dissector import imageimport
+    if returns_ids and not connection.features.can_return_ids_from_bulk_insert:
+        pytest.skip('Database does not return ids from bulk inserts')
+    monkeypatch.setattr(connection.features, 'can_return_ids_from_bulk_insert', returns_ids)
+
+    # Existing recipes in other layerbranches must not be picked up
+    other = make_layerbranch(comparison, 'other-layer')
+    Recipe.objects.create(layerbranch=other, pn='other', filepath='recipes-img0', filename='img0_1.0.bb')
+    layerbranch = make_layerbranch(comparison, 'image-layer')
+    corebranch = make_layerbranch(comparison, 'core-layer')
+    # Use a small batch size so that ids span several batches
+    writer = imageimport.ImageRecipeWriter(batch_size=7)
+    add_recipes(writer, comparison, layerbranch, 20, 'img')
+    add_recipes(writer, comparison, corebranch, 5, 'core')
+    writer.write()
+
+    recipes = ImageComparisonRecipe.objects.filter(comparison=comparison)
+    assert recipes.count() == 25
+    for recipe in recipes:
+        assert recipe.filename == '%s_%s.bb' % (recipe.pn, recipe.pv)
+        assert recipe.sha256sum == recipe.pn
+        assert recipe.fingerprint
+        assert [source.url for source in recipe.source_set.all()] == ['http://example.com/%s.tar.gz' % recipe.pn]
+        assert [patch.src_path for patch in recipe.patch_set.all()] == ['%s.patch' % recipe.pn]
+        assert sorted(dep.name for dep in recipe.staticbuilddep_set.all()) == sorted(['zlib', '%s-native' % recipe.pn])
+        assert [(pc.feature, pc.build_deps) for pc in recipe.packageconfig_set.all()] == [('feature', 'lib%s' % recipe.pn)]
+    assert Recipe.objects.get(layerbranch=other).pn == 'other'
+
+
+def test_write_recipes_mismatch(comparison, monkeypatch):
+    from django.db import connection
+    from layerindex.models import Recipe
+    from dissector import imageimport
+    monkeypatch.setattr(connection.features, 'can_return_ids_from_bulk_insert', False)
+    layerbranch = make_layerbranch(comparison, 'image-layer')
+    # Not something an import would do, but ids can't be recovered if the
+    # layerbranch already has a recipe that we'd write
+    Recipe.objects.create(layerbranch=layerbranch, pn='img0', filepath='recipes-img0', filename='img0_1.0.bb')
+    writer = imageimport.ImageRecipeWriter()
+    add_recipes(writer, comparison, layerbranch, 3, 'img')
+    with pytest.raises(imageimport.ImageImportError):
+        writer.write()
+
+
+def write_blob_file(blobdir, outfile, content):
+    from dissector import imageimport
+    fd, tmpfn = tempfile.mkstemp(dir=blobdir, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    sha256sum = hashlib.sha256(content).hexdigest()
+    imageimport._link_blob(blobdir, tmpfn, sha256sum, outfile)
+    return imageimport.get_blob_path(blobdir, sha256sum)
+
+
+def test_patch_blobs(tmpdir):
+    from dissector import imageimport
+    patchdir = str(tmpdir)
+    blobdir = os.path.join(patchdir, imageimport.BLOB_DIR_NAME)
+    os.makedirs(blobdir)
+    blobfn = write_blob_file(blobdir, os.path.join(patchdir, '1', 'pkg', 'fix.patch'), b'patch\n')
+    assert write_blob_file(blobdir, os.path.join(patchdir, '2', 'pkg', 'fix.patch'), b'patch\n') == blobfn
+    assert os.stat(blobfn).st_nlink == 3
+    assert [fn for fn in os.listdir(blobdir) if fn.startswith('.tmp')] == []
+    imageimport.delete_comparison_patches(patchdir, 1)
+    assert os.stat(blobfn).st_nlink == 2
+    imageimport.delete_comparison_patches(patchdir, 2)
+    assert not os.path.exists(blobfn)
+
+
+def test_patch_blobs_concurrent_delete(tmpdir, monkeypatch):
+    from dissector import imageimport
+    patchdir = str(tmpdir)
+    blobdir = os.path.join(patchdir, imageimport.BLOB_DIR_NAME)
+    os.makedirs(blobdir)
+    blobfn = write_blob_file(blobdir, os.path.join(patchdir, '1', 'pkg', 'fix.patch'), b'patch\n')
+    # Have the only other comparison using the blob deleted just as we
+    # go to link to it
+    orig_link = os.link
+    def link(src, dst):
+        if src == blobfn:
+            imageimport.delete_comparison_patches(patchdir, 1)
+        return orig_link(src, dst)
+    monkeypatch.setattr(os, 'link', link)
+    outfile = os.path.join(patchdir, '2', 'pkg', 'fix.patch')
+    write_blob_file(blobdir, outfile, b'patch\n')
+    with open(outfile, 'rb') as f:
+        assert f.read() == b'patch\n'
+    assert os.path.samefile(outfile, blobfn)
+    assert os.stat(blobfn).st_nlink == 2
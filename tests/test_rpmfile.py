@@ -0,0 +1,212 @@
+# layerindex-web - tests for RPM package reading
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: these tests don't need the database
+
+import sys
+import os
+import struct
+import gzip
+import lzma
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basepath)
+
+from layerindex import rpmfile
+
+
+RPM_INT32_TYPE = 4
+RPM_BIN_TYPE = 7
+
+
+def make_header(entries):
+    index = b''
+    store = b''
+    for tag, tagtype, value in entries:
+        if tagtype == RPM_INT32_TYPE:
+            store += b'\0' * (-len(store) % 4)
+            data = b''.join(struct.pack('>I', item) for item in value)
+            count = len(value)
+        elif tagtype == RPM_BIN_TYPE:
+            data = value
+            count = len(value)
+        elif tagtype == rpmfile.RPM_STRING_TYPE:
+            data = value.encode('utf-8') + b'\0'
+            count = 1
+        else:
+            data = b''.join(item.encode('utf-8') + b'\0' for item in value)
+            count = len(value)
+        index += struct.pack('>IIII', tag, tagtype, len(store), count)
+        store += data
+    return rpmfile.HEADER_MAGIC + b'\x01\0\0\0\0' + struct.pack('>II', len(entries), len(store)) + index + store
+
+
+def make_cpio(entries):
+    data = b''
+    for name, mode, content, ino, nlink in entries + [(rpmfile.CPIO_TRAILER, 0, b'', 0, 1)]:
+        namedata = name.encode('utf-8') + b'\0'
+        fields = [ino, mode, 0, 0, nlink, 1500000000, len(content), 0, 0, 0, 0, len(namedata), 0]
+        data += b'070701' + b''.join(b'%08X' % field for field in fields)
+        data += namedata + b'\0' * (-(rpmfile.CPIO_HEADER_SIZE + len(namedata)) % 4)
+        data += content + b'\0' * (-len(content) % 4)
+    return data
+
+
+def make_rpm(path, entries, payload=b''):
+    lead = rpmfile.LEAD_MAGIC + b'\x03\x00' + b'\0' * (rpmfile.LEAD_SIZE - 6)
+    sig = make_header([(1000, RPM_BIN_TYPE, b'x' * 13), (1004, RPM_BIN_TYPE, b'y' * 16)])
+    sig += b'\0' * (-len(sig) % 8)
+    with open(path, 'wb') as f:
+        f.write(lead + sig + make_header(entries) + payload)
+
+
+def make_srpm(path, files, compress):
+    entries = [
+        (rpmfile.RPMTAG_NAME, rpmfile.RPM_STRING_TYPE, 'foo'),
+        (rpmfile.RPMTAG_VERSION, rpmfile.RPM_STRING_TYPE, '1.0'),
+    ]
+    make_rpm(path, entries, compress(make_cpio(files)))
+
+
+@pytest.fixture
+def rpm(tmpdir):
+    path = str(tmpdir.join('foo-1.2.3-4.x86_64.rpm'))
+    make_rpm(path, [
+        (100, rpmfile.RPM_STRING_ARRAY_TYPE, ['C']),
+        (rpmfile.RPMTAG_NAME, rpmfile.RPM_STRING_TYPE, 'foo'),
+        (rpmfile.RPMTAG_VERSION, rpmfile.RPM_STRING_TYPE, '1.2.3'),
+        (rpmfile.RPMTAG_RELEASE, rpmfile.RPM_STRING_TYPE, '4'),
+        (rpmfile.RPMTAG_SUMMARY, rpmfile.RPM_I18NSTRING_TYPE, ['A summary', 'Eine Zusammenfassung']),
+        (rpmfile.RPMTAG_DESCRIPTION, rpmfile.RPM_I18NSTRING_TYPE, ['First line\nsecond line\n\nthird\n']),
+        (1006, RPM_INT32_TYPE, [1234567]),
+        (rpmfile.RPMTAG_LICENSE, rpmfile.RPM_STRING_TYPE, 'MIT'),
+        (rpmfile.RPMTAG_SOURCERPM, rpmfile.RPM_STRING_TYPE, 'foo-1.2.3-4.src.rpm'),
+        (1117, rpmfile.RPM_STRING_ARRAY_TYPE, ['file%d' % i for i in range(500)]),
+    ], os.urandom(1000))
+    return path
+
+
+# Typical source package contents: a hard link set (with the data on the
+# last entry only) and a symlink
+SRPM_FILES = [
+    ('.', 0o40755, b'', 1, 2),
+    ('./foo.spec', 0o100644, b'Name: foo\nVersion: 1.0\n', 2, 1),
+    ('./fix.patch', 0o100600, b'patch\n', 3, 1),
+    ('sub/x', 0o100644, b'', 5, 2),
+    ('sub/y', 0o100644, b'linked\n', 5, 2),
+    ('link.patch', 0o120777, b'fix.patch', 6, 1),
+]
+
+
+def test_read_rpm_header(rpm):
+    values = rpmfile.read_rpm_header(rpm, [rpmfile.RPMTAG_NAME, rpmfile.RPMTAG_SUMMARY, 1117, rpmfile.RPMTAG_URL])
+    assert values[rpmfile.RPMTAG_NAME] == 'foo'
+    # Only the first translation of an I18NSTRING
+    assert values[rpmfile.RPMTAG_SUMMARY] == 'A summary'
+    assert values[1117] == ['file%d' % i for i in range(500)]
+    # Missing tags are omitted
+    assert rpmfile.RPMTAG_URL not in values
+
+
+def test_read_rpm_header_unsupported_type(rpm):
+    with pytest.raises(rpmfile.RpmFileError):
+        rpmfile.read_rpm_header(rpm, [1006])
+
+
+def test_read_rpm_info(rpm):
+    info = rpmfile.read_rpm_info(rpm)
+    assert list(info.items()) == [
+        ('Name', 'foo'),
+        ('Version', '1.2.3'),
+        ('Release', '4'),
+        ('Group', ''),
+        ('License', 'MIT'),
+        ('Source RPM', 'foo-1.2.3-4.src.rpm'),
+        ('URL', ''),
+        ('Summary', 'A summary'),
+        ('Description', 'First line\nsecond line\n\nthird\n'),
+    ]
+
+
+def test_read_rpm_info_missing(tmpdir):
+    # Missing tags must not leave out fields that callers expect
+    path = str(tmpdir.join('bar-1-1.x86_64.rpm'))
+    make_rpm(path, [
+        (rpmfile.RPMTAG_NAME, rpmfile.RPM_STRING_TYPE, 'bar'),
+        (rpmfile.RPMTAG_SOURCERPM, rpmfile.RPM_STRING_TYPE, 'bar-1-1.src.rpm'),
+    ])
+    info = rpmfile.read_rpm_info(path)
+    assert list(info.keys()) == list(rpmfile.INFO_TAGS.keys())
+    assert info['Name'] == 'bar'
+    for name in ['Version', 'Group', 'License', 'Summary', 'Description', 'URL']:
+        assert info[name] == ''
+
+
+def test_read_rpm_invalid(tmpdir, rpm):
+    notrpm = str(tmpdir.join('foo.txt'))
+    with open(notrpm, 'w') as f:
+        f.write('Not an RPM package' * 10)
+    with pytest.raises(rpmfile.RpmFileError):
+        rpmfile.read_rpm_info(notrpm)
+    truncated = str(tmpdir.join('truncated.rpm'))
+    with open(rpm, 'rb') as f:
+        data = f.read(300)
+    with open(truncated, 'wb') as f:
+        f.write(data)
+    with pytest.raises(rpmfile.RpmFileError):
+        rpmfile.read_rpm_info(truncated)
+
+
+def zstd_compress(data):
+    zstandard = pytest.importorskip('zstandard')
+    return zstandard.ZstdCompressor().compress(data)
+
+
+@pytest.mark.parametrize('compress', [gzip.compress, lzma.compress, zstd_compress], ids=['gzip', 'xz', 'zstd'])
+def test_extract_rpm(tmpdir, compress):
+    srpm = str(tmpdir.join('foo-1.0-1.src.rpm'))
+    make_srpm(srpm, SRPM_FILES, compress)
+    destdir = str(tmpdir.join('extract'))
+    os.makedirs(destdir)
+    extracted = rpmfile.extract_rpm(srpm, destdir)
+    assert sorted(os.path.relpath(path, destdir) for path in extracted) == ['fix.patch', 'foo.spec', 'link.patch', 'sub/x', 'sub/y']
+    with open(os.path.join(destdir, 'foo.spec'), 'rb') as f:
+        assert f.read() == b'Name: foo\nVersion: 1.0\n'
+    assert os.stat(os.path.join(destdir, 'foo.spec')).st_mtime == 1500000000
+    assert os.stat(os.path.join(destdir, 'fix.patch')).st_mode & 0o777 == 0o600
+    assert os.readlink(os.path.join(destdir, 'link.patch')) == 'fix.patch'
+    # Hard links share the data from the last entry
+    with open(os.path.join(destdir, 'sub/x'), 'rb') as f:
+        assert f.read() == b'linked\n'
+    assert os.stat(os.path.join(destdir, 'sub/x')).st_ino == os.stat(os.path.join(destdir, 'sub/y')).st_ino
+
+
+@pytest.mark.parametrize('files', [
+    [('../evil', 0o100644, b'x', 1, 1)],
+    [('link', 0o120777, b'..', 1, 1), ('link/evil', 0o100644, b'x', 2, 1)],
+], ids=['dotdot', 'symlink'])
+def test_extract_rpm_outside(tmpdir, files):
+    srpm = str(tmpdir.join('foo-1.0-1.src.rpm'))
+    make_srpm(srpm, files, gzip.compress)
+    destdir = str(tmpdir.join('extract'))
+    os.makedirs(destdir)
+    with pytest.raises(rpmfile.RpmFileError) as excinfo:
+        rpmfile.extract_rpm(srpm, destdir)
+    assert not isinstance(excinfo.value, rpmfile.UnsupportedPayloadError)
+    assert not os.path.exists(str(tmpdir.join('evil')))
+
+
+def test_extract_rpm_unsupported(tmpdir, monkeypatch):
+    # Without the zstandard module, callers need to fall back to rpm2cpio
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    srpm = str(tmpdir.join('foo-1.0-1.src.rpm'))
+    make_srpm(srpm, SRPM_FILES, lambda data: b'\x28\xb5\x2f\xfd' + data)
+    destdir = str(tmpdir.join('extract'))
+    os.makedirs(destdir)
+    with pytest.raises(rpmfile.UnsupportedPayloadError):
+        rpmfile.extract_rpm(srpm, destdir)
+    assert os.listdir(destdir) == []
@@ -0,0 +1,101 @@
+# layerindex-web - tests for native evaluation of spec file shell macros
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: these tests don't need the database
+
+import sys
+import os
+import subprocess
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basepath)
+
+from layerindex import shellmacro
+
+
+# Idioms commonly found within %(...) in spec files, all of which should
+# give exactly the same output natively as through the shell
+NATIVE_COMMANDS = [
+    "echo 1.2.3",
+    "echo -n 1.2.3",
+    "echo",
+    "echo \"1.2.3\"",
+    "echo a\\ b",
+    "echo a#b",
+    "echo 1.2.3 | sed 's/\\./_/g'",
+    "echo 1.2.3 | sed -e 's/\\./_/'",
+    "echo 1.2.3 | sed 's/\\([0-9]*\\)\\.\\([0-9]*\\).*/\\2.\\1/'",
+    "echo 1.2.3 | sed -E 's/([0-9]+)\\.([0-9]+).*/\\1\\2/'",
+    "echo 1.2.3 | sed -r 's/^([^.]+)\\..*$/\\1/'",
+    "echo 1.2.3 | sed 's/\\.[^.]*$//'",
+    "echo 1.2.3 | sed 's|\\.|-|2'",
+    "echo 1.2.3.4 | sed 's/\\./-/2g'",
+    "echo abc | sed 's/b/[&]/'",
+    "echo aBc | sed 's/b/X/I'",
+    "echo 1.2.3 | sed -e 's/1/one/' -e 's/2/two/'",
+    "echo 1.2.3 | sed 's/1/one/;s/3/three/'",
+    "echo 1.2~rc1 | sed 's/~/-/'",
+    "echo 'a b  c' | sed 's/ \\+/_/g'",
+    "echo 1.2.3 | cut -d. -f1",
+    "echo 1.2.3 | cut -d . -f1,2",
+    "echo 1.2.3 | cut -d'.' -f2-",
+    "echo 1.2.3 | cut -d. -f-2",
+    "echo 1.2.3 | cut -c1-3",
+    "echo 123 | cut -d. -f2",
+    "echo 'x|y' | cut -d'|' -f2",
+    "echo 1.2.3 | awk -F. '{print $1\".\"$2}'",
+    "echo 1.2.3 | awk -F. '{print $1, $NF}'",
+    "echo 'a  b c' | awk '{print $2}'",
+    "echo 1.2.3 | awk -F '.' '{ print $3 }'",
+    "echo 1.2.3 | awk -F. '{print $0}'",
+    "echo 1.2.3 | tr . _",
+    "echo 1.2.3 | tr -d .",
+    "echo 1.2~rc1 | tr '~' _",
+    "echo ABC | tr '[:upper:]' '[:lower:]'",
+    "echo abc | tr a-c x",
+    "echo hello | tr a-y b-z",
+    "echo 1.2.3 | sed 's/\\./_/g' | tr _ -",
+]
+
+# Things that need a real shell (or that we don't handle exactly)
+SHELL_COMMANDS = [
+    "echo $HOME",
+    "echo `echo hi`",
+    "echo a; echo b",
+    "echo a && echo b",
+    "echo a > /dev/null",
+    "echo ~",
+    "echo a #b",
+    "X=1 echo a",
+    "printf '%s' x",
+    "echo -e 'a\\tb'",
+    "echo 1.2.3 | sed 's/\\(1\\)/\\U\\1/'",
+    "echo 1.2.3 | sed -n 's/1/x/p'",
+    "echo 1.2 | sed y/12/ab/",
+    "echo a.b | sed 's.a\\.b.x.'",
+    "echo 1.2.3 | awk -F. '{printf \"%s\", $1}'",
+    "echo 'unterminated",
+]
+
+
+@pytest.mark.parametrize('cmd', NATIVE_COMMANDS)
+def test_run_native(cmd):
+    assert shellmacro.run_native(cmd) == subprocess.check_output(cmd, shell=True).decode('utf-8')
+
+
+@pytest.mark.parametrize('cmd', SHELL_COMMANDS)
+def test_run_native_unsupported(cmd):
+    with pytest.raises(shellmacro.NotNativeError):
+        shellmacro.run_native(cmd)
+
+
+def test_evaluator():
+    evaluator = shellmacro.ShellMacroEvaluator()
+    assert evaluator.evaluate("echo 1.2.3 | cut -d. -f1,2") == '1.2'
+    assert evaluator.evaluate("echo a; echo b") == 'a\nb'
+    assert evaluator.evaluate("echo 1.2.3 | cut -d. -f1,2") == '1.2'
+    assert (evaluator.native_count, evaluator.shell_count) == (1, 1)
@@ -0,0 +1,148 @@
+# layerindex-web - tests for version comparison engine
+#
+# Copyright (C) 2019 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository
+
+import sys
+import os
+from datetime import datetime
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, basepath)
+
+
+@pytest.fixture(autouse=True)
+def enable_db_access_for_all_tests(db):
+    pass
+
+
+def make_layerbranch(layer, name):
+    from layerindex.models import Branch, LayerBranch
+    branch = Branch.objects.create(name=name, bitbake_branch='-', comparison=True)
+    return LayerBranch.objects.create(layer=layer, branch=branch)
+
+
+def make_recipe(layerbranch, pn, pv, sha256sum='a', patches=None, sources=None, deleted=False):
+    from layerindex.models import ClassicRecipe, Patch, Source
+    recipe = ClassicRecipe.objects.create(layerbranch=layerbranch, pn=pn, pv=pv, sha256sum=sha256sum, deleted=deleted)
+    for i, (src_path, applied, checksum) in enumerate(patches or []):
+        Patch.objects.create(recipe=recipe, path=src_path, src_path=src_path, applied=applied, sha256sum=checksum, apply_order=i)
+    for url, checksum in (sources or []):
+        Source.objects.create(recipe=recipe, url=url, sha256sum=checksum)
+    return recipe
+
+
+@pytest.fixture
+def layerbranches():
+    from layerindex.models import LayerItem
+    layer = LayerItem.objects.create(name='test-distro', summary='Test', description='Test', vcs_url='-')
+    from_lb = make_layerbranch(layer, 'distro-old')
+    to_lb = make_layerbranch(layer, 'distro-new')
+    for pn, pv in [('same', '1.0'), ('upgraded', '1.0'), ('downgraded', '2.0'), ('multi', '1.0'), ('Mixed-Case', '1.0'), ('onlyfrom', '1.0'), ('stable', '1.0'), ('dup', '1.0')]:
+        make_recipe(from_lb, pn, pv)
+    make_recipe(from_lb, 'patched', '1.0', patches=[('a.patch', True, 'x'), ('b.patch', False, 'x')])
+    make_recipe(from_lb, 'sourced', '1.0', sources=[('http://example.com/a.tar.gz', 's')])
+    make_recipe(from_lb, 'revived', '1.0', deleted=True)
+
+    for pn, pv in [('same', '1.0'), ('upgraded', '2.0'), ('downgraded', '1.0'), ('multi', '1.0'), ('multi', '1.1'), ('mixed-case', '1.0'), ('onlyto', '1.0'), ('stable', '1.0'), ('dup', '1.0'), ('revived', '1.0')]:
+        make_recipe(to_lb, pn, pv)
+    make_recipe(to_lb, 'patched', '1.0', patches=[('a.patch', True, 'y'), ('b.patch', False, 'x')])
+    make_recipe(to_lb, 'sourced', '1.0', sources=[('http://example.com/a.tar.gz', 't')])
+    return from_lb, to_lb
+
+
+def reimport(from_lb, to_lb):
+    """
+    Change the recipes on both sides in the ways an import would,
+    recording them as an import does
+    """
+    from layerindex.models import ClassicRecipe, Update, ComparisonRecipeUpdate
+    update = Update.objects.create(started=datetime.now())
+    updated = []
+    def change_recipe(layerbranch, pn, **kwargs):
+        recipe = ClassicRecipe.objects.get(layerbranch=layerbranch, pn=pn)
+        for name, value in kwargs.items():
+            setattr(recipe, name, value)
+        recipe.save()
+        updated.append(recipe)
+
+    change_recipe(to_lb, 'same', pv='3.0')
+    change_recipe(to_lb, 'upgraded', pv='1.0')
+    change_recipe(to_lb, 'stable', sha256sum='b')
+    change_recipe(from_lb, 'revived', deleted=False)
+    patch = ClassicRecipe.objects.get(layerbranch=to_lb, pn='patched').patch_set.get(src_path='a.patch')
+    patch.sha256sum = 'x'
+    patch.save()
+    updated.append(patch.recipe)
+    updated.append(make_recipe(to_lb, 'onlyfrom', '1.0'))
+    updated.append(make_recipe(to_lb, 'fresh', '1.0'))
+    updated.append(make_recipe(to_lb, 'dup', '1.1'))
+    # Deletions aren't recorded as updates
+    ClassicRecipe.objects.filter(layerbranch=to_lb, pn='multi', pv='1.1').update(deleted=True)
+    ClassicRecipe.objects.filter(layerbranch=to_lb, pn='onlyto').update(deleted=True)
+
+    for recipe in updated:
+        ComparisonRecipeUpdate.objects.create(update=update, recipe=recipe, meta_updated=True)
+    update.finished = datetime.now()
+    update.save()
+
+
+def get_differences(vercmp):
+    return [(diff.pn, diff.change_type, diff.oldvalue, diff.newvalue) for diff in vercmp.get_differences()]
+
+
+def test_generate_version_comparison(layerbranches):
+    from dissector.models import VersionComparison
+    from dissector import versioncompare
+    from_lb, to_lb = layerbranches
+    vercmp = VersionComparison.objects.create(from_branch=from_lb.branch, to_branch=to_lb.branch)
+    versioncompare.generate_version_comparison(vercmp)
+    assert get_differences(vercmp) == [
+        ('mixed-case', 'A', '', ''),
+        ('onlyto', 'A', '', ''),
+        ('revived', 'A', '', ''),
+        ('downgraded', 'D', '2.0', '1.0'),
+        ('multi', 'V', '1.0', '1.0, 1.1'),
+        ('upgraded', 'U', '1.0', '2.0'),
+        ('patched', 'M', '', ''),
+        ('sourced', 'M', '', ''),
+        ('Mixed-Case', 'R', '', ''),
+        ('onlyfrom', 'R', '', ''),
+    ]
+
+
+def test_update_version_comparison(layerbranches):
+    from dissector.models import VersionComparison
+    from dissector import versioncompare
+    from_lb, to_lb = layerbranches
+    vercmp = VersionComparison.objects.create(from_branch=from_lb.branch, to_branch=to_lb.branch)
+    versioncompare.generate_version_comparison(vercmp)
+    vercmp.status = 'S'
+    vercmp.save()
+    before = get_differences(vercmp)
+
+    reimport(from_lb, to_lb)
+    assert vercmp.needs_update()
+    versioncompare.update_version_comparison(vercmp)
+    vercmp.save()
+    incremental = get_differences(vercmp)
+
+    full = VersionComparison.objects.create(from_branch=from_lb.branch, to_branch=to_lb.branch)
+    versioncompare.generate_version_comparison(full)
+    assert incremental == get_differences(full)
+    assert incremental != before
+    assert incremental == [
+        ('fresh', 'A', '', ''),
+        ('mixed-case', 'A', '', ''),
+        ('downgraded', 'D', '2.0', '1.0'),
+        ('dup', 'V', '1.0', '1.0, 1.1'),
+        ('same', 'U', '1.0', '3.0'),
+        ('sourced', 'M', '', ''),
+        ('stable', 'M', '', ''),
+        ('Mixed-Case', 'R', '', ''),
+    ]